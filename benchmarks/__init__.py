@@ -0,0 +1 @@
+# Benchmarks for the trace tools.  See benchmarks/run.py.
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Check the tile downloader against the stub tile server: tiles come
+# through retries intact, cached tiles aren't fetched again, and failed
+# downloads leave nothing behind in the cache.  Exits with status 1 if any
+# check fails.
+#
+#   python -m benchmarks.check_tiles
+
+import os
+import sys
+import shutil
+import tempfile
+import requests
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if(repo_dir not in sys.path):
+    sys.path.insert(0, repo_dir)
+
+import map_tile_mgr
+from benchmarks import stub_server
+
+zoom = 15
+tiles = [(x, y) for y in range(100, 104) for x in range(200, 205)]
+
+failures = []
+
+def check(what, ok):
+    print('{}: {}'.format('INFO' if(ok) else 'ERROR', what))
+    if(not ok):
+        failures.append(what)
+
+def partial_files(cache):
+    return([f for f in os.listdir(cache) if(f.endswith('.part'))])
+
+# A server failing some of the requests: every tile still arrives intact,
+# and a second pass is served from the cache.
+def check_flaky(work_dir):
+    server = stub_server.stub_server(fail_rate=0.3)
+    try:
+        cache = os.path.join(work_dir, 'flaky')
+        os.makedirs(cache)
+        mtm = map_tile_mgr.map_tile_mgr(server.url, cache, 'key', retries=8, backoff_s=0.01)
+        files = mtm.get_tiles(zoom, tiles)
+        intact = True
+        for tile_file in files:
+            with open(tile_file, 'rb') as f_img:
+                intact = intact and (f_img.read() == server.png)
+        check('{} tiles fetched intact from a flaky server'.format(len(tiles)), intact)
+        check('failed requests were retried', server.num_requests > len(tiles))
+        num_requests = server.num_requests
+        check('cached tiles are not fetched again',
+                (mtm.get_tiles(zoom, tiles) == files) and (server.num_requests == num_requests))
+        check('no partial tiles are left in the cache', partial_files(cache) == [])
+    finally:
+        server.close()
+
+# A server failing every request: get_tiles() gives up after the retries
+# and caches nothing.
+def check_down(work_dir):
+    server = stub_server.stub_server(fail_rate=1.0)
+    try:
+        cache = os.path.join(work_dir, 'down')
+        os.makedirs(cache)
+        mtm = map_tile_mgr.map_tile_mgr(server.url, cache, 'key', retries=2, backoff_s=0.01)
+        try:
+            mtm.get_tiles(zoom, tiles[:3])
+            raised = False
+        except requests.HTTPError:
+            raised = True
+        check('a server that always fails raises HTTPError', raised)
+        check('each tile is tried retries + 1 times', server.num_requests == 3 * 3)
+        check('nothing is cached from a failing server', os.listdir(cache) == [])
+    finally:
+        server.close()
+
+# The tile's name in the cache is taken by a directory, so the downloaded
+# tile can't be renamed into place; the partial file must not stay behind.
+def check_blocked(work_dir):
+    server = stub_server.stub_server()
+    try:
+        cache = os.path.join(work_dir, 'blocked')
+        (x, y) = tiles[0]
+        os.makedirs(map_tile_mgr.tile_path(cache, zoom, x, y))
+        mtm = map_tile_mgr.map_tile_mgr(server.url, cache, 'key', retries=0)
+        try:
+            mtm.get_tile(zoom, x, y)
+            raised = False
+        except OSError:
+            raised = True
+        check('a tile that can\'t be stored raises OSError', raised)
+        check('and leaves no partial tile in the cache', partial_files(cache) == [])
+    finally:
+        server.close()
+
+def main():
+    work_dir = tempfile.mkdtemp(prefix='gtrace-tiles-')
+    try:
+        check_flaky(work_dir)
+        check_down(work_dir)
+        check_blocked(work_dir)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    if(len(failures) > 0):
+        print('ERROR: {} check(s) failed.'.format(len(failures)))
+        sys.exit(1)
+    print('INFO: All tile checks passed.')
+
+if(__name__ == '__main__'):
+    main()
@@ -0,0 +1,132 @@
+import os
+import math
+import random
+import zipfile
+import datetime
+
+# Synthetic corpus of Garmin .tcx traces and a waypoints file.  Traces are
+# noisy runs along a few shared routes, so they visit the same waypoints
+# the way real training logs do.
+
+tcx_head = '''<?xml version="1.0" encoding="UTF-8"?>
+<TrainingCenterDatabase xmlns="http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2">
+ <Activities>
+  <Activity Sport="Running">
+   <Id>{start}</Id>
+   <Lap StartTime="{start}">
+    <Track>
+'''
+tcx_tail = '''    </Track>
+   </Lap>
+  </Activity>
+ </Activities>
+</TrainingCenterDatabase>
+'''
+tcx_point = '''     <Trackpoint>
+      <Time>{time}</Time>
+      <Position>
+       <LatitudeDegrees>{lat:.7f}</LatitudeDegrees>
+       <LongitudeDegrees>{lon:.7f}</LongitudeDegrees>
+      </Position>
+      <AltitudeMeters>{alt:.1f}</AltitudeMeters>
+      <DistanceMeters>{dist:.1f}</DistanceMeters>
+      <HeartRateBpm>
+       <Value>{hr}</Value>
+      </HeartRateBpm>
+     </Trackpoint>
+'''
+tcx_point_nopos = '''     <Trackpoint>
+      <Time>{time}</Time>
+      <AltitudeMeters>{alt:.1f}</AltitudeMeters>
+      <DistanceMeters>{dist:.1f}</DistanceMeters>
+     </Trackpoint>
+'''
+
+m_per_deg = 111320.0
+
+def _iso(t):
+    return(datetime.datetime.fromtimestamp(t, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+
+# A route of n points about step_m apart, as a smoothly turning random walk
+# from (lat0, lon0).
+def make_route(rnd, lat0, lon0, n, step_m=3.0):
+    route = []
+    (lat, lon) = (lat0, lon0)
+    heading = rnd.uniform(0.0, 2.0 * math.pi)
+    turn = 0.0
+    for i in range(n):
+        route.append((lat, lon))
+        turn = 0.9 * turn + rnd.gauss(0.0, 0.01)
+        heading += turn
+        lat += step_m * math.cos(heading) / m_per_deg
+        lon += step_m * math.sin(heading) / (m_per_deg * math.cos(math.radians(lat)))
+    return(route)
+
+# Write one trace of num_points along route, starting at epoch start.
+# About gap_rate of the trackpoints carry no position.
+def write_tcx(f, rnd, route, num_points, start, gap_rate=0.002):
+    f.write(tcx_head.format(start=_iso(start)))
+    offset = rnd.randrange(max(1, len(route) - num_points))
+    (dist, t) = (0.0, start)
+    jitter = rnd.uniform(1.0, 4.0)
+    for i in range(num_points):
+        (lat, lon) = route[(offset + i) % len(route)]
+        lat += rnd.gauss(0.0, jitter) / m_per_deg
+        lon += rnd.gauss(0.0, jitter) / m_per_deg
+        dist += rnd.uniform(2.0, 4.0)
+        t += 1
+        alt = 100.0 + 30.0 * math.sin((offset + i) / 400.0)
+        if(rnd.random() < gap_rate):
+            f.write(tcx_point_nopos.format(time=_iso(t), alt=alt, dist=dist))
+        else:
+            f.write(tcx_point.format(time=_iso(t), lat=lat, lon=lon, alt=alt, dist=dist,
+                    hr=int(140 + 20 * math.sin(i / 300.0))))
+    f.write(tcx_tail)
+
+def write_waypoints(filename, rnd, routes, spacing_m):
+    with open(filename, 'w') as f:
+        f.write('<waypoints>\n')
+        k = 0
+        for route in routes:
+            step = max(1, int(spacing_m / 3.0))
+            for i in range(step // 2, len(route), step):
+                k += 1
+                (lat, lon) = route[i]
+                f.write('<wpt id="w{0}"><name>Waypoint {0}</name><lat>{1:.6f}</lat><lon>{2:.6f}</lon>'
+                        '<elev_ft>{3}</elev_ft></wpt>\n'.format(k, lat, lon, rnd.randrange(200, 900)))
+        f.write('</waypoints>\n')
+    return(k)
+
+# Write num_traces traces of points_per_trace points and a waypoints file
+# with a waypoint every waypoint_spacing_m along each route into out_dir.
+# About zip_fraction of the traces are zipped.  Returns a dict with the
+# file names.
+def make_corpus(out_dir, num_traces=20, points_per_trace=5000, waypoint_spacing_m=400.0,
+        num_routes=4, zip_fraction=0.25, seed=1):
+    rnd = random.Random(seed)
+    os.makedirs(out_dir, exist_ok=True)
+    (lat0, lon0) = (44.56, -123.26)
+    routes = []
+    for r in range(num_routes):
+        routes.append(make_route(rnd, lat0 + rnd.uniform(-0.02, 0.02), lon0 + rnd.uniform(-0.02, 0.02),
+                points_per_trace + 2000))
+
+    waypoints_file = os.path.join(out_dir, 'waypoints.xml')
+    num_waypoints = write_waypoints(waypoints_file, rnd, routes, waypoint_spacing_m)
+
+    trace_files = []
+    start = 1483228800
+    for i in range(num_traces):
+        base = 'trace{:05d}'.format(i)
+        tcx_file = os.path.join(out_dir, base + '.tcx')
+        with open(tcx_file, 'w') as f:
+            write_tcx(f, rnd, routes[i % num_routes], points_per_trace, start + i * 86400)
+        if(rnd.random() < zip_fraction):
+            zip_name = os.path.join(out_dir, base + '.zip')
+            with zipfile.ZipFile(zip_name, 'w', zipfile.ZIP_DEFLATED) as z:
+                z.write(tcx_file, base + '.tcx')
+            os.remove(tcx_file)
+            tcx_file = zip_name
+        trace_files.append(tcx_file)
+
+    return({'trace_files': trace_files, 'waypoints_file': waypoints_file, 'num_waypoints': num_waypoints})
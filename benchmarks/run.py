@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+# Time the main stages of the trace tools on a synthetic corpus and write
+# the results as JSON, so runs of different versions can be compared.
+#
+#   python -m benchmarks.run -t 50 -n 5000 -o bench.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if(repo_dir not in sys.path):
+    sys.path.insert(0, repo_dir)
+
+import numpy as np
+import garmin
+import map_render
+import map_tile_mgr
+import path_store
+import simplify
+import trace_cache
+import trace2csv
+import waypoint_mgr
+from map_tile_mgr import deg2num, deg2pixel
+from benchmarks import corpus
+from benchmarks import stub_server
+
+def parse_cmd_line():
+    ap = argparse.ArgumentParser(description='Benchmark the trace tools on a synthetic corpus')
+    ap.add_argument('-t', '--num-traces', help='Number of traces', type=int, default=20)
+    ap.add_argument('-n', '--points-per-trace', help='Trackpoints per trace', type=int, default=5000)
+    ap.add_argument('-w', '--waypoint-spacing', help='Distance (m) between waypoints along routes',
+            type=float, default=400.0)
+    ap.add_argument('-z', '--zoom-factor', help='Zoom of overlay projection and tiles', type=int, default=15)
+    ap.add_argument('-k', '--num-tiles', help='Number of tiles to fetch from the stub server', type=int, default=200)
+    ap.add_argument('-f', '--tile-fail-rate', help='Fraction of stub tile requests that fail', type=float,
+            default=0.05)
+    ap.add_argument('-s', '--seed', help='Seed of the corpus generator', type=int, default=1)
+    ap.add_argument('-d', '--work-dir', help='Keep the corpus and caches in this directory')
+    ap.add_argument('-o', '--output-file', help='JSON results file (default: stdout)')
+    args = ap.parse_args()
+    return(args)
+
+def git_version():
+    try:
+        out = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=repo_dir,
+                capture_output=True, text=True, check=True).stdout
+        return(out.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return(None)
+
+# Runs fn() and records its wall time under name in results, along with
+# the number of items it handled.  Returns what fn() returns.
+def timed(results, name, items, fn):
+    print('INFO: {} ...'.format(name), file=sys.stderr)
+    t0 = time.perf_counter()
+    ret = fn()
+    seconds = time.perf_counter() - t0
+    results[name] = {'seconds': round(seconds, 6), 'items': items,
+            'items_per_s': round(items / seconds, 3) if(seconds > 0) else None}
+    return(ret)
+
+def bench_parse(results, files, cache):
+    return(timed(results, 'garmin_parse' if(cache is None) else 'garmin_parse_cache_store', len(files),
+            lambda: [garmin.garmin(f, cache=cache) for f in files]))
+
+def bench_trace2csv(results, files, waypoints_file, cache_dir, store_file):
+    trace2csv.init_worker(waypoints_file, {'trace_cache': cache_dir}, waypoint_mgr.visit_radius_m, [])
+    found = timed(results, 'trace2csv_find_paths', len(files), lambda: [trace2csv.find_paths(f) for f in files])
+    store = path_store.open_store(store_file)
+    for r in found:
+        store.add_paths(r['gps_file'], r['activity_datestamp'], r['paths'])
+    store.export_csv(store_file)
+    store.close()
+    return(sum([len(r['paths']) for r in found]))
+
+def bench_csv2paths(results, waypoints_file, store_file, home_dir, num_paths):
+    env = dict(os.environ, HOME=home_dir)
+    cmd = [sys.executable, os.path.join(repo_dir, 'csv2paths.py'), '-w', waypoints_file, '-p', store_file]
+    timed(results, 'csv2paths', num_paths,
+            lambda: subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, check=True))
+
+def bench_overlay(results, traces, zoom, cache):
+    def project():
+        layers = []
+        for gt in traces:
+            pos = gt.has_position()
+            keep = simplify.select(simplify.trace_significance(gt, cache), zoom)
+            (x, y) = deg2pixel(gt.lat[pos][keep], gt.lon[pos][keep], zoom)
+            (x, y) = (np.floor(x).astype(np.int64), np.floor(y).astype(np.int64))
+            layers.append(map_render.clip_polyline(x, y, int(x.min()), int(y.min()),
+                    int(x.max() - x.min()) + 1, int(y.max() - y.min()) + 1, 6))
+        return(layers)
+    return(timed(results, 'overlay_projection', len(traces), project))
+
+def bench_tiles(results, work_dir, zoom, num_tiles, fail_rate, center):
+    server = stub_server.stub_server(fail_rate=fail_rate)
+    cache = os.path.join(work_dir, 'tiles')
+    os.makedirs(cache, exist_ok=True)
+    mtm = map_tile_mgr.map_tile_mgr(server.url, cache, 'key', ignore_cache=True, backoff_s=0.01)
+    (x0, y0) = deg2num(center, zoom)
+    side = int(np.ceil(np.sqrt(num_tiles)))
+    tiles = [(x0 + i % side, y0 + i // side) for i in range(num_tiles)]
+    try:
+        timed(results, 'tile_fetch', num_tiles, lambda: mtm.get_tiles(zoom, tiles))
+    finally:
+        server.close()
+
+def main():
+    args = parse_cmd_line()
+    work_dir = args.work_dir
+    if(work_dir is None):
+        work_dir = tempfile.mkdtemp(prefix='gtrace-bench-')
+    results = {}
+    try:
+        made = timed(results, 'corpus_generate', args.num_traces,
+                lambda: corpus.make_corpus(os.path.join(work_dir, 'corpus'), args.num_traces,
+                    args.points_per_trace, args.waypoint_spacing, seed=args.seed))
+        files = made['trace_files']
+        waypoints_file = made['waypoints_file']
+        cache_dir = os.path.join(work_dir, 'trace-cache')
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        cache = trace_cache.trace_cache(cache_dir)
+
+        traces = bench_parse(results, files, None)
+        bench_parse(results, files, cache)
+        traces = timed(results, 'garmin_parse_cached', len(files),
+                lambda: [garmin.garmin(f, cache=cache) for f in files])
+        bboxes = timed(results, 'get_bbox', len(traces), lambda: [gt.get_bbox() for gt in traces])
+        timed(results, 'waypoints_load', made['num_waypoints'],
+                lambda: waypoint_mgr.waypoint_store(waypoints_file).get_index(waypoint_mgr.visit_radius_m))
+
+        store_file = os.path.join(work_dir, 'paths.csv')
+        if(os.path.exists(store_file)):
+            os.remove(store_file)
+        num_paths = bench_trace2csv(results, files, waypoints_file, cache_dir, store_file)
+        bench_csv2paths(results, waypoints_file, store_file, work_dir, num_paths)
+
+        bench_overlay(results, traces, args.zoom_factor, cache)
+        center = [(bboxes[0][0] + bboxes[0][2]) / 2.0, (bboxes[0][1] + bboxes[0][3]) / 2.0]
+        bench_tiles(results, work_dir, args.zoom_factor, args.num_tiles, args.tile_fail_rate, center)
+    finally:
+        if(args.work_dir is None):
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {'version': git_version(),
+            'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'params': vars(args),
+            'corpus': {'trackpoints': args.num_traces * args.points_per_trace,
+                'waypoints': made['num_waypoints'], 'paths': num_paths},
+            'stages': results}
+    if(args.output_file):
+        with open(args.output_file, 'w') as f_out:
+            json.dump(report, f_out, indent=2)
+            f_out.write('\n')
+    else:
+        print(json.dumps(report, indent=2))
+
+if(__name__ == '__main__'):
+    main()
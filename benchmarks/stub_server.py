@@ -0,0 +1,57 @@
+import time
+import zlib
+import struct
+import random
+import threading
+import http.server
+
+# Local stand-in for a tile server.  Every request gets the same blank
+# 256x256 PNG, png, after delay_s; fail_rate of them get a 503 instead.
+# num_requests counts the requests served.
+
+# A blank, pale green tile as PNG.
+def _blank_png():
+    def chunk(kind, data):
+        return(struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data)))
+    row = b'\x00' + bytes((200, 220, 200)) * 256
+    return(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', 256, 256, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(row * 256)) + chunk(b'IEND', b''))
+
+class stub_server(object):
+
+    def __init__(self, fail_rate=0.0, delay_s=0.0, seed=1):
+        png = _blank_png()
+        rnd = random.Random(seed)
+        lock = threading.Lock()
+        self.png = png
+        self.num_requests = 0
+        stub = self
+
+        class handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if(delay_s > 0.0):
+                    time.sleep(delay_s)
+                with lock:
+                    stub.num_requests += 1
+                    fail = rnd.random() < fail_rate
+                if(fail):
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(png)))
+                self.end_headers()
+                self.wfile.write(png)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.url = 'http://127.0.0.1:{}/tiles'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
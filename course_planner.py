@@ -0,0 +1,147 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+import segment_stats
+
+# Shortest routes between waypoints over the segments in a path store.
+# Each segment 'wA:wB' is an edge wA -> wB weighted by its median distance
+# and time; a segment only ever run the other way stands in for the reverse
+# edge too.  Shortest distance and time between all pairs of waypoints are
+# computed once with Floyd-Warshall, along with the next waypoint of each
+# route, so a route is then found in time proportional to its length.
+
+# Bump when the way the tables are computed changes.
+cache_version = 1
+
+by_options = ('time', 'distance')
+
+# Shortest path lengths between all nodes of a graph given as a matrix of
+# edge weights (inf where there is no edge), and the next node on each of
+# those paths (-1 where there is none).
+def floyd_warshall(w):
+    n = len(w)
+    d = w.copy()
+    nodes = np.arange(n)
+    nxt = np.where(np.isfinite(w), nodes[None, :], -1).astype(np.int32)
+    d[nodes, nodes] = 0.0
+    nxt[nodes, nodes] = nodes
+    via = np.empty_like(d)
+    better = np.empty((n, n), dtype=bool)
+    for k in range(n):
+        np.add(d[:, k, None], d[None, k, :], out=via)
+        np.less(via, d, out=better)
+        np.copyto(d, via, where=better)
+        np.copyto(nxt, nxt[:, k, None], where=better)
+    return(d, nxt)
+
+class course_planner(object):
+
+    # tables as made by _tables(): waypoints, edge_dist_m, edge_time_s,
+    # reverse, dist_m, next_dist, time_s, next_time
+    def __init__(self, tables):
+        self.waypoints = tables['waypoints'].tolist()
+        self.index = {wpt: i for (i, wpt) in enumerate(self.waypoints)}
+        self.edge_dist_m = tables['edge_dist_m']
+        self.edge_time_s = tables['edge_time_s']
+        self.reverse = tables['reverse']
+        self.dist_m = tables['dist_m']
+        self.time_s = tables['time_s']
+        self.next_hop = {'distance': tables['next_dist'], 'time': tables['next_time']}
+
+    # Waypoints of the shortest (by time or distance) route from wpt_a to
+    # wpt_b, both included, or None if there is none.
+    def route(self, wpt_a, wpt_b, by='time'):
+        if((wpt_a not in self.index) or (wpt_b not in self.index)):
+            return(None)
+        nxt = self.next_hop[by]
+        (i, j) = (self.index[wpt_a], self.index[wpt_b])
+        if(nxt[i, j] < 0):
+            return(None)
+        route = [i]
+        while(i != j):
+            i = nxt[i, j]
+            route.append(i)
+        return([self.waypoints[i] for i in route])
+
+    # (dist_m, time_s, reverse) of the edge from wpt_a to wpt_b, where
+    # reverse tells it was only run the other way; None if there is none.
+    def hop(self, wpt_a, wpt_b):
+        if((wpt_a not in self.index) or (wpt_b not in self.index)):
+            return(None)
+        (i, j) = (self.index[wpt_a], self.index[wpt_b])
+        if(not np.isfinite(self.edge_time_s[i, j])):
+            return(None)
+        return(self.edge_dist_m[i, j], self.edge_time_s[i, j], bool(self.reverse[i, j]))
+
+    # Length (m) and duration (s) of the shortest route from wpt_a to wpt_b
+    # by distance or time; inf if there is none.
+    def shortest(self, wpt_a, wpt_b, by='time'):
+        if((wpt_a not in self.index) or (wpt_b not in self.index)):
+            return(np.inf)
+        (i, j) = (self.index[wpt_a], self.index[wpt_b])
+        if(by == 'distance'):
+            return(self.dist_m[i, j])
+        return(self.time_s[i, j])
+
+# Edge and all-pairs tables from a segment_stats table.
+def _tables(stats):
+    ends = [path_id.split(':') for path_id in stats['path_id'].tolist()]
+    waypoints = sorted(set([wpt for e in ends for wpt in e]))
+    index = {wpt: i for (i, wpt) in enumerate(waypoints)}
+    n = len(waypoints)
+    edge_dist_m = np.full((n, n), np.inf)
+    edge_time_s = np.full((n, n), np.inf)
+    reverse = np.zeros((n, n), dtype=bool)
+    a = np.array([index[e[0]] for e in ends], dtype=np.int64)
+    b = np.array([index[e[1]] for e in ends], dtype=np.int64)
+    if(len(ends) > 0):
+        edge_dist_m[a, b] = stats['dist_m_median']
+        edge_time_s[a, b] = stats['time_s_median']
+        back = ~np.isfinite(edge_time_s[b, a])
+        edge_dist_m[b[back], a[back]] = stats['dist_m_median'][back]
+        edge_time_s[b[back], a[back]] = stats['time_s_median'][back]
+        reverse[b[back], a[back]] = True
+    (dist_m, next_dist) = floyd_warshall(edge_dist_m)
+    (time_s, next_time) = floyd_warshall(edge_time_s)
+    return({'waypoints': np.array(waypoints, dtype=str), 'edge_dist_m': edge_dist_m, 'edge_time_s': edge_time_s,
+            'reverse': reverse, 'dist_m': dist_m, 'next_dist': next_dist, 'time_s': time_s,
+            'next_time': next_time})
+
+# Planner from a segment_stats table.
+def build(stats):
+    return(course_planner(_tables(stats)))
+
+def _cache_key(store_file):
+    st = os.stat(store_file)
+    key = [cache_version, segment_stats.cache_version, st.st_size, st.st_mtime_ns]
+    return(hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+# Planner for the segments in store_file.  Its tables are cached in
+# cache_dir, next to the segment statistics, and rebuilt when the store
+# changes.
+def load(store_file, cache_dir=segment_stats.default_cache_dir):
+    cache_file = None
+    if((cache_dir is not None) and os.path.isfile(store_file)):
+        name = hashlib.sha1(os.path.abspath(store_file).encode('utf-8')).hexdigest()
+        cache_file = os.path.join(cache_dir, name + '.routes.npz')
+        key = _cache_key(store_file)
+        try:
+            with np.load(cache_file) as cached:
+                if(str(cached['key']) == key):
+                    return(course_planner({name: cached[name] for name in cached.files if(name != 'key')}))
+        except (OSError, ValueError, KeyError):
+            pass
+
+    tables = _tables(segment_stats.load(store_file, cache_dir=cache_dir))
+
+    if(cache_file is not None):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            (fd, tmp_path) = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-', suffix='.npz')
+            with os.fdopen(fd, 'wb') as f_npz:
+                np.savez(f_npz, key=np.array(key), **tables)
+            os.replace(tmp_path, cache_file)
+        except OSError:
+            pass
+    return(course_planner(tables))
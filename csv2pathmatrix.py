@@ -3,6 +3,8 @@
 import os
 import argparse
 import dateutil.parser as DP
+import profiler
+import segment_stats
 import waypoint_mgr
 
 # TODO: Add option to use min, max, or avg times.
@@ -24,8 +26,10 @@ def read_rc_file():
 def parse_cmd_line():
     ap = argparse.ArgumentParser(description='Summarize raw paths data from .csv file.')
     ap.add_argument('-p', '--waypoints-file', help='Name of waypoint .xml file')
-    ap.add_argument('-b', '--path-csv-file', help='Name of path csv file')
+    ap.add_argument('-b', '--path-csv-file', help='Name of path store (.csv file or SQLite database)')
     ap.add_argument('-c', '--course-file', help='File containing list of waypoints in course')
+    ap.add_argument('--profile', help='Print time spent per stage; also write a Chrome trace to TRACE_JSON if given',
+            nargs='?', const='', metavar='TRACE_JSON')
     args = ap.parse_args()
     return(args)
 
@@ -39,6 +43,8 @@ def s2minsec(t):
 
 if(__name__ == '__main__'):
     args = parse_cmd_line()
+    if(args.profile is not None):
+        profiler.enable(args.profile)
 
     rc = read_rc_file()
 
@@ -56,48 +62,27 @@ if(__name__ == '__main__'):
         if('path_csv_file' in rc.keys()):
             path_csv_file = rc['path_csv_file']
 
-    total_dist_m = {}
-    total_time_s = {}
-    path_id_cnts = {}
-    if(os.path.isfile(path_csv_file)):
-        with open(path_csv_file, 'r') as f_csv:
-            for line in f_csv:
-                (gps_file, activity_datestamp, path_id, dist_m, time_s) = line.strip().split(',')
-
-                if(path_id not in path_id_cnts):
-                    path_id_cnts[path_id] = 0
-                path_id_cnts[path_id] += 1
-
-                if(path_id not in total_dist_m):
-                    total_dist_m[path_id] = 0
-                total_dist_m[path_id] += float(dist_m)
-
-                if(path_id not in total_time_s):
-                    total_time_s[path_id] = 0
-                total_time_s[path_id] += float(time_s)
-
-    avg_dist_m = {}
-    avg_time_s = {}
-    for path_id in total_dist_m.keys():
-        avg_dist_m[path_id] = total_dist_m[path_id] / path_id_cnts[path_id]
-        avg_time_s[path_id] = total_time_s[path_id] / path_id_cnts[path_id]
+    with profiler.span('segment_stats'):
+        stats = segment_stats.load(path_csv_file, cache_dir=segment_stats.cache_dir_from_rc(rc))
+    avg_dist_m = stats['dist_m_mean']
+    avg_time_s = stats['time_s_mean']
 
+    # Rows of the matrix: the paths leaving each waypoint, by the waypoint
+    # they lead to.
+    rows = {}
     max_waypt = 0
-    for path_id in total_dist_m.keys():
+    for (i, path_id) in enumerate(stats['path_id'].tolist()):
         (wpt1, wpt2) = path_id.split(':')
         wpt1 = int(wpt1[1:].strip())
         wpt2 = int(wpt2[1:].strip())
-        if(wpt1 > max_waypt):
-            max_waypt = wpt1
-        if(wpt2 > max_waypt):
-            max_waypt = wpt2
+        rows.setdefault(wpt1, []).append((wpt2, i))
+        max_waypt = max(max_waypt, wpt1, wpt2)
     for wpt1 in range(1, max_waypt+1):
         print('{:5s}: '.format('w%s' % wpt1), end='')
-        for wpt2 in range(1, max_waypt+1):
-            path_id = 'w%s:w%s' % (wpt1, wpt2)
-            if(path_id in total_dist_m.keys()):
-                print('w%s %3.2f %s (%s)  ' % 
-                    (wpt2, m2mi(avg_dist_m[path_id]), s2minsec(avg_time_s[path_id]), path_id_cnts[path_id]), 
-                    end='')
+        for (wpt2, i) in sorted(rows.get(wpt1, [])):
+            print('w%s %3.2f %s (%s)  ' %
+                (wpt2, m2mi(avg_dist_m[i]), s2minsec(avg_time_s[i]), stats['count'][i]),
+                end='')
         print('')
 
+    profiler.report()
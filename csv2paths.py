@@ -2,8 +2,10 @@
 
 import os
 import argparse
-import statistics
 import dateutil.parser as DP
+import profiler
+import course_planner
+import segment_stats
 import waypoint_mgr
 
 rc_file = '{}/.trace.rc'.format(os.environ['HOME'])
@@ -22,8 +24,14 @@ def read_rc_file():
 def parse_cmd_line():
     ap = argparse.ArgumentParser(description='Summarize raw paths data from .csv file.')
     ap.add_argument('-w', '--waypoints-file', help='Name of waypoint .xml file')
-    ap.add_argument('-p', '--path-csv-file', help='Name of path csv file')
+    ap.add_argument('-p', '--path-csv-file', help='Name of path store (.csv file or SQLite database)')
     ap.add_argument('-c', '--course-file', help='File containing list of waypoints in course')
+    ap.add_argument('-r', '--route', help='Print the shortest route between two waypoints', nargs=2,
+            metavar=('FROM', 'TO'))
+    ap.add_argument('-s', '--shortest', help='Shortest by time or distance, for routes and course gaps',
+            choices=course_planner.by_options, default='time')
+    ap.add_argument('--profile', help='Print time spent per stage; also write a Chrome trace to TRACE_JSON if given',
+            nargs='?', const='', metavar='TRACE_JSON')
     args = ap.parse_args()
     return(args)
 
@@ -39,6 +47,8 @@ def s2hms(t):
 
 if(__name__ == '__main__'):
     args = parse_cmd_line()
+    if(args.profile is not None):
+        profiler.enable(args.profile)
 
     rc = read_rc_file()
 
@@ -57,37 +67,33 @@ if(__name__ == '__main__'):
         if('path_csv_file' in rc.keys()):
             path_csv_file = rc['path_csv_file']
 
-    pop_dist_m = {}
-    pop_time_s = {}
-    if(os.path.isfile(path_csv_file)):
-        with open(path_csv_file, 'r') as f_csv:
-            for line in f_csv:
-                (gps_file, activity_datestamp, path_id, dist_m, time_s) = line.strip().split(',')
-                dist_m = float(dist_m)
-                time_s = float(time_s)
-
-                if(path_id not in pop_dist_m.keys()):
-                    pop_dist_m[path_id] = []
-                    pop_time_s[path_id] = []
-                pop_dist_m[path_id].append(dist_m)
-                pop_time_s[path_id].append(time_s)
+    with profiler.span('segment_stats'):
+        stats = segment_stats.load(path_csv_file, cache_dir=segment_stats.cache_dir_from_rc(rc))
+    seg = segment_stats.index(stats)
+    median_dist_m = stats['dist_m_median']
+    median_time_s = stats['time_s_median']
 
+    # Shortest routes, only loaded for --route and gaps in a course.
+    planner = None
+    if(args.route):
+        with profiler.span('course_planner'):
+            planner = course_planner.load(path_csv_file, cache_dir=segment_stats.cache_dir_from_rc(rc))
 
     course = []
     if(args.course_file):
         with open(args.course_file, 'r') as f_c:
             for l in f_c:
                 course.append(l.strip())
-
-    median_dist_m = {}
-    median_time_s = {}
-    for path_id in pop_dist_m.keys():
-        median_dist_m[path_id] = statistics.median_low(pop_dist_m[path_id])
-        median_time_s[path_id] = statistics.median_low(pop_time_s[path_id])
-
-        if(not args.course_file):
+    elif(args.route):
+        course = planner.route(args.route[0], args.route[1], by=args.shortest)
+        if(course is None):
+            print('ERROR: No route from %s to %s' % (args.route[0], args.route[1]))
+            course = []
+
+    if((not args.course_file) and (not args.route)):
+        for (i, path_id) in enumerate(stats['path_id'].tolist()):
             print('%s %3.2f mi %s min (%s)' %
-		        (path_id, m2mi(median_dist_m[path_id]), s2hms(median_time_s[path_id]), len(pop_dist_m[path_id])))
+                    (path_id, m2mi(median_dist_m[i]), s2hms(median_time_s[i]), stats['count'][i]))
 
     course_dist_m = 0
     course_time_s = 0
@@ -96,18 +102,33 @@ if(__name__ == '__main__'):
         if(wpt_prev):
             path_id = '%s:%s' % (wpt_prev, wpt)
             rev_path_id = '%s:%s' % (wpt, wpt_prev)
-            if(path_id in pop_dist_m.keys()):
-                course_dist_m += median_dist_m[path_id]
-                course_time_s += median_time_s[path_id]
+            if(path_id in seg):
+                course_dist_m += median_dist_m[seg[path_id]]
+                course_time_s += median_time_s[seg[path_id]]
                 print('[%-4s] %-40s %5.2f %s' % (wpt, wpts[wpt]['name'], m2mi(course_dist_m), s2hms(course_time_s)))
-            elif(rev_path_id in pop_dist_m.keys()):
-                course_dist_m += median_dist_m[rev_path_id]
-                course_time_s += median_time_s[rev_path_id]
+            elif(rev_path_id in seg):
+                course_dist_m += median_dist_m[seg[rev_path_id]]
+                course_time_s += median_time_s[seg[rev_path_id]]
                 print('[%-4s] %-40s %5.2f %s *' % (wpt, wpts[wpt]['name'], m2mi(course_dist_m), s2hms(course_time_s)))
             else:
-                print('ERROR: Missing data')
+                # Not run between these two; fill in the shortest route.
+                if(planner is None):
+                    with profiler.span('course_planner'):
+                        planner = course_planner.load(path_csv_file, cache_dir=segment_stats.cache_dir_from_rc(rc))
+                route = planner.route(wpt_prev, wpt, by=args.shortest)
+                if(route is None):
+                    print('ERROR: Missing data')
+                else:
+                    for (wpt_a, wpt_b) in zip(route[:-1], route[1:]):
+                        (dist_m, time_s, reverse) = planner.hop(wpt_a, wpt_b)
+                        course_dist_m += dist_m
+                        course_time_s += time_s
+                        print('[%-4s] %-40s %5.2f %s +' %
+                                (wpt_b, wpts[wpt_b]['name'], m2mi(course_dist_m), s2hms(course_time_s)))
         else:
             print('[%-4s] %-40s  0.00 0:00:00' % (wpt, wpts[wpt]['name']))
         wpt_prev = wpt
 
+    profiler.report()
+
 # TODO: Add option to print data in matrix form.
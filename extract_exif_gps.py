@@ -1,47 +1,143 @@
 #!/usr/bin/env python3
 # $Id$
 
-import argparse
-import subprocess
+import os
+import struct
+import threading
+import concurrent.futures
 
-# Requires ImageMagick.
-imcmd = 'identify -verbose'.split()
+# Reads the GPS position from the EXIF data of JPEG and TIFF files.  Only
+# the file header, IFD0 and the GPS IFD are read, never the image data.
+
+tag_gps_ifd = 0x8825
+tag_gps_lat_ref = 1
+tag_gps_lat = 2
+tag_gps_lon_ref = 3
+tag_gps_lon = 4
+
+# Size in bytes of one value of each TIFF field type.
+type_sizes = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
 
 class extract_exif_gps(object):
-    def __init__(self):
-        pass
+    def __init__(self, max_workers=16):
+        self.max_workers = max_workers
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+
 
+    # Returns the offset of the TIFF header in f, or None if f is neither a
+    # TIFF file nor a JPEG file with an EXIF segment.
+    def _tiff_base(self, f):
+        head = f.read(4)
+        if(head[:4] in (b'II*\x00', b'MM\x00*')):
+            return(0)
+        if(head[:2] != b'\xff\xd8'):
+            return(None)
+        f.seek(2)
+        while(True):
+            marker = f.read(4)
+            if((len(marker) < 4) or (marker[0] != 0xff)):
+                return(None)
+            # Start of scan or end of image: no EXIF before the image data.
+            if(marker[1] in (0xda, 0xd9)):
+                return(None)
+            (length,) = struct.unpack('>H', marker[2:])
+            if(marker[1] == 0xe1):
+                start = f.tell()
+                if(f.read(6) == b'Exif\x00\x00'):
+                    return(start + 6)
+                f.seek(start)
+            f.seek(length - 2, os.SEEK_CUR)
 
-    def _slash_conv(self, s):
-        (nm, dv) = s.split('/')
-        return(float(nm) / float(dv))
 
+    # Reads the entries of the IFD at offset, keeping those in tags, as a
+    # dict of tag: (type, count, value bytes).
+    def _read_ifd(self, f, base, bo, offset, tags):
+        f.seek(base + offset)
+        (num_entries,) = struct.unpack(bo + 'H', f.read(2))
+        data = f.read(12 * num_entries)
+        entries = {}
+        for i in range(num_entries):
+            (tag, typ, count, value) = struct.unpack(bo + 'HHI4s', data[12*i:12*i+12])
+            if((tag not in tags) or (typ not in type_sizes)):
+                continue
+            entries[tag] = (typ, count, value)
+        for (tag, (typ, count, value)) in entries.items():
+            size = type_sizes[typ] * count
+            if(size > 4):
+                f.seek(base + struct.unpack(bo + 'I', value)[0])
+                value = f.read(size)
+            entries[tag] = (typ, count, value[:size])
+        return(entries)
 
-    def _hms2dec(self, s):
-        (hr, mn, sd) = s.split(', ')
-        dec = self._slash_conv(hr) + self._slash_conv(mn) / 60.0 + self._slash_conv(sd) / 3600.0
+
+    # Converts degrees, minutes and seconds given as three RATIONALs.
+    def _hms2dec(self, bo, value):
+        (hn, hd, mn, md, sn, sd) = struct.unpack(bo + '6I', value)
+        if((hd == 0) or (md == 0) or (sd == 0)):
+            return(None)
+        dec = float(hn) / hd + float(mn) / md / 60.0 + float(sn) / sd / 3600.0
         return(dec)
 
 
+    def _read_coords(self, jpg_file):
+        with open(jpg_file, 'rb') as f:
+            base = self._tiff_base(f)
+            if(base is None):
+                return(None, None)
+            f.seek(base)
+            header = f.read(8)
+            bo = '<' if(header[:2] == b'II') else '>'
+            (ifd0,) = struct.unpack(bo + 'I', header[4:8])
+            ifd = self._read_ifd(f, base, bo, ifd0, (tag_gps_ifd,))
+            if(tag_gps_ifd not in ifd):
+                return(None, None)
+            (typ, count, value) = ifd[tag_gps_ifd]
+            gps_ifd = struct.unpack(bo + 'I', value)[0]
+            gps = self._read_ifd(f, base, bo, gps_ifd,
+                    (tag_gps_lat_ref, tag_gps_lat, tag_gps_lon_ref, tag_gps_lon))
+
+        coords = []
+        for (tag, ref_tag, negative) in ((tag_gps_lat, tag_gps_lat_ref, b'S'), (tag_gps_lon, tag_gps_lon_ref, b'W')):
+            if((tag not in gps) or (gps[tag][0] != 5) or (gps[tag][1] != 3)):
+                return(None, None)
+            dec = self._hms2dec(bo, gps[tag][2])
+            if(dec is None):
+                return(None, None)
+            if((ref_tag in gps) and gps[ref_tag][2].startswith(negative)):
+                dec *= (-1)
+            coords.append(dec)
+        return(tuple(coords))
+
+
+    # Returns (lat, lon) in decimal degrees, or (None, None) if the file has
+    # no GPS position.  Results are cached until the file changes.
     def get_coords(self, jpg_file):
-        lat = 1.0
-        lon = 1.0
-        p = subprocess.Popen(imcmd + [jpg_file], stdout=subprocess.PIPE).communicate()[0]
-        for line in p.decode('utf-8').split('\n'):
-            val = line.split(':')
-            if('exif:GPS' in line):
-                if('GPSLatitude' == val[1]):
-                    lat *= self._hms2dec(val[2])
-                if('GPSLatitudeRef' == val[1]):
-                    if(val[2].strip() == 'S'):
-                        lat *= (-1)
-                if('GPSLongitude' == val[1]):
-                    lon = self._hms2dec(val[2])
-                if('GPSLongitudeRef' == val[1]):
-                    if(val[2].strip() == 'W'):
-                        lon *= (-1)
-
-        return(lat, lon)
+        try:
+            st = os.stat(jpg_file)
+        except OSError:
+            return(None, None)
+        key = (st.st_mtime_ns, st.st_size)
+        with self.cache_lock:
+            cached = self.cache.get(jpg_file)
+        if((cached is not None) and (cached[0] == key)):
+            return(cached[1])
+        try:
+            coords = self._read_coords(jpg_file)
+        except (OSError, struct.error):
+            coords = (None, None)
+        with self.cache_lock:
+            self.cache[jpg_file] = (key, coords)
+        return(coords)
+
+
+    # get_coords() of each file, read in parallel.  Returns a list in the
+    # order of jpg_files.
+    def get_coords_batch(self, jpg_files):
+        if(len(jpg_files) < 2):
+            return([self.get_coords(jpg_file) for jpg_file in jpg_files])
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+            return(list(executor.map(self.get_coords, jpg_files)))
 
 
 if(__name__ == '__main__'):
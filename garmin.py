@@ -1,85 +1,239 @@
 import os
 import math
 import zipfile
+import datetime
 import xml.etree.ElementTree as ET
+import numpy as np
+import dateutil.parser
+import geodesy
+import profiler
 
 ns = {'garmin': 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'}
 
+# Trackpoint columns, in the order they are kept by read_tcx().  Missing
+# values are NaN for the float columns and 0 for the integer ones.
+columns = {
+    'lat': np.float64,
+    'lon': np.float64,
+    'alt': np.float64,
+    'dist': np.float64,
+    'time': np.int64,
+    'hr': np.int16,
+}
+
+def _tag(name):
+    return('{%s}%s' % (ns['garmin'], name))
+
+def _float(elem):
+    if((elem is None) or (elem.text is None)):
+        return(math.nan)
+    return(float(elem.text))
+
+def _iso2epoch(t_iso):
+    t_iso = t_iso.strip()
+    if(t_iso.endswith('Z')):
+        t_iso = t_iso[:-1] + '+00:00'
+    try:
+        t = datetime.datetime.fromisoformat(t_iso)
+    except ValueError:
+        t = dateutil.parser.parse(t_iso)
+    return(int(t.timestamp()))
+
+# Days from 1970-01-01 to the given dates of the proleptic Gregorian
+# calendar (H. Hinnant's days_from_civil), on whole arrays.
+def _days_from_civil(year, month, day):
+    y = year - (month <= 2)
+    era = y // 400
+    yoe = y - era * 400
+    doy = (153 * ((month + 9) % 12) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return(era * 146097 + doe - 719468)
+
+# Decode timestamps of Garmin's form, YYYY-MM-DDTHH:MM:SS(.fff)Z, all of
+# the same length, straight from their bytes.  Returns None if any of them
+# is in some other form.
+def _utc2epoch(times):
+    n = len(times)
+    width = len(times[0])
+    raw = np.frombuffer(('\n'.join(times) + '\n').encode('ascii', 'replace'), dtype=np.uint8)
+    if((width < 20) or (width == 21) or (raw.size != n * (width + 1))):
+        return(None)
+    c = raw.reshape(n, width + 1)
+    seps = {4: '-', 7: '-', 10: 'T', 13: ':', 16: ':', width - 1: 'Z', width: '\n'}
+    if(width > 20):
+        seps[19] = '.'
+    for (i, ch) in seps.items():
+        if(np.any(c[:, i] != ord(ch))):
+            return(None)
+    digit_cols = [i for i in range(width - 1) if(i not in seps)]
+    d = c[:, digit_cols].astype(np.int64) - ord('0')
+    if(np.any((d < 0) | (d > 9))):
+        return(None)
+    num = lambda k, m: d[:, k:k+m] @ (10 ** np.arange(m - 1, -1, -1))
+    (year, month, day, hour, minute, sec) = (num(0, 4), num(4, 2), num(6, 2), num(8, 2), num(10, 2), num(12, 2))
+    if(np.any((month < 1) | (month > 12) | (day < 1) | (day > 31) | (hour > 23) | (minute > 59) | (sec > 59))):
+        return(None)
+    days = _days_from_civil(year, month, day)
+    if(np.any(days >= _days_from_civil(year + (month == 12), month % 12 + 1, 1))):
+        return(None)
+    epoch = days * 86400 + hour * 3600 + minute * 60 + sec
+    # Truncate toward zero, as int() does.
+    if(width > 20):
+        epoch += (epoch < 0) & np.any(d[:, 14:] != 0, axis=1)
+    return(epoch)
+
+# Convert a list of ISO-8601 timestamps to an int64 array of Unix times,
+# with 0 for None.  Timestamps as Garmin writes them are decoded in bulk;
+# anything else is handed to the general parsers one at a time.
+def iso2epoch(times):
+    epoch = np.zeros(len(times), dtype=np.int64)
+    have = np.ones(len(times), dtype=bool)
+    if(None in times):
+        have = np.array([t is not None for t in times], dtype=bool)
+        times = [t for t in times if(t is not None)]
+    if(len(times) == 0):
+        return(epoch)
+    bulk = _utc2epoch(times)
+    if(bulk is None):
+        bulk = [_iso2epoch(t) for t in times]
+    epoch[have] = bulk
+    return(epoch)
+
+def open_trace(trace_file):
+    if(trace_file.lower().endswith('.zip')):
+        zip_file = zipfile.ZipFile(trace_file)
+        return(zip_file.open(os.path.basename(trace_file.replace('.zip', '.tcx'))))
+    return(open(trace_file, 'rb'))
+
+# Make a single streaming pass over a .tcx file and return the activity id
+# and a dict of typed numpy columns (see 'columns' above).  Each trackpoint
+# element is discarded as soon as it has been decoded.
+def read_tcx(trace_file):
+    activity_id = None
+    track = None
+    cols = {name: [] for name in columns.keys()}
+    track_tag = _tag('Track')
+    tp_tag = _tag('Trackpoint')
+    id_tag = _tag('Id')
+    pos_tag = _tag('Position')
+    lat_tag = _tag('LatitudeDegrees')
+    lon_tag = _tag('LongitudeDegrees')
+    alt_tag = _tag('AltitudeMeters')
+    dist_tag = _tag('DistanceMeters')
+    time_tag = _tag('Time')
+    hr_tag = _tag('HeartRateBpm')
+    value_tag = _tag('Value')
+
+    with open_trace(trace_file) as f_trace:
+        for (event, elem) in ET.iterparse(f_trace, events=('start', 'end')):
+            if(event == 'start'):
+                if(elem.tag == track_tag):
+                    track = elem
+                continue
+            if(elem.tag == tp_tag):
+                pos = elem.find(pos_tag)
+                if(pos is None):
+                    cols['lat'].append(math.nan)
+                    cols['lon'].append(math.nan)
+                else:
+                    cols['lat'].append(_float(pos.find(lat_tag)))
+                    cols['lon'].append(_float(pos.find(lon_tag)))
+                cols['alt'].append(_float(elem.find(alt_tag)))
+                cols['dist'].append(_float(elem.find(dist_tag)))
+                t = elem.find(time_tag)
+                cols['time'].append(None if t is None else t.text)
+                hr = elem.find(hr_tag)
+                if(hr is not None):
+                    hr = hr.find(value_tag)
+                cols['hr'].append(0 if hr is None else int(hr.text))
+                # Drop the decoded trackpoint so the tree never grows.
+                if(track is not None):
+                    track.clear()
+                else:
+                    elem.clear()
+            elif((elem.tag == id_tag) and (activity_id is None)):
+                activity_id = elem.text
+
+    cols['time'] = iso2epoch(cols['time'])
+    for name in columns.keys():
+        cols[name] = np.array(cols[name], dtype=columns[name])
+    return(activity_id, cols)
+
 class garmin(object):
 
-    def __init__(self, trace_file):
-        if(trace_file.lower().endswith('.zip')):
-            zip_file = zipfile.ZipFile(trace_file)
-            zip_trace_file = zip_file.open(os.path.basename(trace_file.replace('.zip', '.tcx')))
-            self.trace = ET.parse(zip_trace_file)
+    # If a trace_cache is given, decoded columns are loaded from (and saved
+    # to) it instead of re-parsing the trace file.
+    def __init__(self, trace_file, cache=None):
+        self.trace_file = trace_file
+        cached = None
+        if(cache is not None):
+            with profiler.span('trace_cache.load', cat='io', file=trace_file):
+                cached = cache.load(trace_file)
+        if(cached is None):
+            with profiler.span('garmin.parse', cat='parse', file=trace_file):
+                (self.activity_id, cols) = read_tcx(trace_file)
+            profiler.count('trackpoints_parsed', len(cols['lat']))
+            if(cache is not None):
+                profiler.count('trace_cache.misses')
+                with profiler.span('trace_cache.store', cat='io', file=trace_file):
+                    cache.store(trace_file, self.activity_id, cols)
         else:
-            self.trace = ET.parse(trace_file)
+            (self.activity_id, cols) = cached
+            profiler.count('trace_cache.hits')
+        self.lat = cols['lat']
+        self.lon = cols['lon']
+        self.alt = cols['alt']
+        self.dist = cols['dist']
+        self.time = cols['time']
+        self.hr = cols['hr']
+
+    # Boolean mask of trackpoints that carry a position.
+    def has_position(self):
+        return(~(np.isnan(self.lat) | np.isnan(self.lon)))
 
     def get_activity_start_datestamp(self):
-        id = self.trace.findall('.//garmin:Id', ns)[0].text
         # TODO: Convert to current time zone.
-        return(id)
+        return(self.activity_id)
 
     def get_starting_coord(self):
-        first_pos = self.trace.findall('.//garmin:Position', ns)[0]
-        start_lat = first_pos.findall('garmin:LatitudeDegrees', ns)[0].text
-        start_lon = first_pos.findall('garmin:LongitudeDegrees', ns)[0].text
-        start_coord = [float(start_lat), float(start_lon)]
+        idx = np.flatnonzero(self.has_position())
+        if(len(idx) == 0):
+            raise IndexError('no position in trace')
+        start_coord = [float(self.lat[idx[0]]), float(self.lon[idx[0]])]
         return(start_coord)
 
     def get_bbox(self):
-        gps_lat_N = None
-        gps_lat_S = None
-        gps_lon_W = None
-        gps_lon_E = None
-        for pos in self.trace.findall('.//garmin:LatitudeDegrees', ns):
-            gps_lat = float(pos.text)
-            if((gps_lat_N is None) or (gps_lat > gps_lat_N)):
-                gps_lat_N = gps_lat
-            if((gps_lat_S is None) or (gps_lat < gps_lat_S)):
-                gps_lat_S = gps_lat
-
-        for pos in self.trace.findall('.//garmin:LongitudeDegrees', ns):
-            gps_lon = float(pos.text)
-            if((gps_lon_W is None) or (gps_lon < gps_lon_W)):
-                gps_lon_W = gps_lon
-            if((gps_lon_E is None) or (gps_lon > gps_lon_E)):
-                gps_lon_E = gps_lon
-
+        if(np.all(np.isnan(self.lat)) or np.all(np.isnan(self.lon))):
+            return(None, None, None, None)
+        gps_lat_N = float(np.nanmax(self.lat))
+        gps_lat_S = float(np.nanmin(self.lat))
+        gps_lon_W = float(np.nanmin(self.lon))
+        gps_lon_E = float(np.nanmax(self.lon))
         return(gps_lat_N, gps_lon_W, gps_lat_S, gps_lon_E)
 
+    # Yields (time, lat, lon, alt, dist, hr) for every trackpoint.
     def iter_position(self):
-        for tp in self.trace.findall('.//garmin:Trackpoint', ns):
-            yield(tp)
+        for i in range(len(self.lat)):
+            yield(self.get_trackpoint(i))
+
+    def get_trackpoint(self, i):
+        return((int(self.time[i]), float(self.lat[i]), float(self.lon[i]),
+                float(self.alt[i]), float(self.dist[i]), int(self.hr[i])))
 
     def calc_elev_gain(self):
-        total_gain = 0.0
-        prev_alt = None
-        for alt in self.trace.findall('.//garmin:AltitudeMeters', ns):
-            if (prev_alt is not None):
-                gain = float(alt.text) - float(prev_alt)
-                if (gain > 0):
-                    total_gain += gain
-            prev_alt = alt.text
+        alt = self.alt[~np.isnan(self.alt)]
+        gain = np.diff(alt)
+        total_gain = float(np.sum(gain[gain > 0]))
         return(total_gain)
 
     def get_trackpoint_count(self):
-        trackpoints = self.trace.findall('.//garmin:Trackpoint', ns)
-        return(len(trackpoints))
+        return(len(self.lat))
 
     def get_trackpoints(self):
-        return(self.trace.findall('.//garmin:Trackpoint', ns))
+        return(list(self.iter_position()))
 
     def deg2rad(self, x):
         return(math.pi * x / 180.0)
 
     def calc_dist_m(self, pt0, pt1):
-        R = 6371
-        delta_lat = self.deg2rad(pt1[0] - pt0[0])
-        delta_lon = self.deg2rad(pt1[1] - pt0[1])
-        lat0 = self.deg2rad(pt0[0])
-        lat1 = self.deg2rad(pt1[0])
-        a = math.pow(math.sin(delta_lat/2), 2) + math.pow(math.sin(delta_lon/2), 2) * math.cos(lat0) * math.cos(lat1)
-        c = 2 * math.atan2(math.sqrt(a), math.sqrt(1.0 - a))
-        d = 1000.0 * R * c
-        return(d)
+        return(float(geodesy.haversine_m(pt0[0], pt0[1], pt1[0], pt1[1])))
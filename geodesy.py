@@ -0,0 +1,45 @@
+import numpy as np
+
+# Mean earth radius in meters.
+R_m = 6371000.0
+
+# Great-circle distance in meters between (lat0, lon0) and (lat1, lon1),
+# given in degrees.  Arguments may be scalars or arrays; they are broadcast
+# against each other as usual for numpy.
+def haversine_m(lat0, lon0, lat1, lon1):
+    lat0 = np.radians(lat0)
+    lat1 = np.radians(lat1)
+    delta_lat = lat1 - lat0
+    delta_lon = np.radians(lon1) - np.radians(lon0)
+    a = np.sin(delta_lat / 2) ** 2 + np.sin(delta_lon / 2) ** 2 * np.cos(lat0) * np.cos(lat1)
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1.0 - a))
+    return(R_m * c)
+
+# Distances from one [lat, lon] point to each of the given points.
+def dist_to_many(pt, lats, lons):
+    return(haversine_m(pt[0], pt[1], np.asarray(lats), np.asarray(lons)))
+
+# Matrix of distances, shape (len(lats0), len(lats1)), between two sets of
+# points.
+def dist_matrix(lats0, lons0, lats1, lons1):
+    lats0 = np.asarray(lats0)[:, np.newaxis]
+    lons0 = np.asarray(lons0)[:, np.newaxis]
+    return(haversine_m(lats0, lons0, np.asarray(lats1), np.asarray(lons1)))
+
+# Distance along the track from the first point to each point.  Points
+# without a position (NaN) are skipped and take the distance of the last
+# point that had one.
+def cumulative_dist(lats, lons):
+    lats = np.asarray(lats)
+    lons = np.asarray(lons)
+    valid = np.flatnonzero(~(np.isnan(lats) | np.isnan(lons)))
+    cum = np.zeros(len(lats))
+    if(len(valid) < 2):
+        return(cum)
+    step = haversine_m(lats[valid[:-1]], lons[valid[:-1]], lats[valid[1:]], lons[valid[1:]])
+    cum[valid[1:]] = np.cumsum(step)
+    # Carry the running total forward over points without a position.
+    last = np.zeros(len(lats), dtype=np.int64)
+    last[valid] = valid
+    last = np.maximum.accumulate(last)
+    return(cum[last])
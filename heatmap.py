@@ -0,0 +1,73 @@
+import numpy as np
+
+# Color ramp of the heatmap, from rarely to most often travelled: stops on
+# 0..1 and their (r, g, b, a).
+ramp_stops = [0.0, 0.33, 0.66, 1.0]
+ramp_colors = [(40, 0, 120, 110), (200, 0, 60, 160), (255, 140, 0, 210), (255, 255, 180, 250)]
+
+# Counts, per pixel of a width x height image whose top left is global
+# pixel (x0, y0), how many traces pass within radius pixels of it.  Traces
+# are added one at a time, so only the count grid is kept in memory.
+class heatmap(object):
+
+    def __init__(self, width, height, x0, y0, radius=0):
+        self.width = width
+        self.height = height
+        self.x0 = x0
+        self.y0 = y0
+        self.radius = radius
+        self.grid = np.zeros(width * height, dtype=np.uint32)
+        self.num_traces = 0
+        r = np.arange(-radius, radius + 1)
+        (dx, dy) = np.meshgrid(r, r)
+        disc = (dx * dx + dy * dy) <= radius * radius
+        self.offsets = list(zip(dx[disc].tolist(), dy[disc].tolist()))
+
+    # Add the polyline (x, y), in global pixels.  Segments are sampled every
+    # half pixel and each pixel is counted once per trace.
+    def add(self, x, y):
+        x = np.asarray(x, dtype=np.float64) - self.x0
+        y = np.asarray(y, dtype=np.float64) - self.y0
+        self.num_traces += 1
+        if(len(x) == 0):
+            return
+        if(len(x) > 1):
+            n = np.maximum(1, np.ceil(2.0 * np.hypot(np.diff(x), np.diff(y)))).astype(np.int64)
+            seg = np.repeat(np.arange(len(n)), n)
+            t = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) / np.repeat(n, n)
+            x = np.append(x[seg] + t * (x[seg+1] - x[seg]), x[-1])
+            y = np.append(y[seg] + t * (y[seg+1] - y[seg]), y[-1])
+
+        # Pixels on the line, widened by radius, as indices into a grid
+        # with a radius wide border, then without duplicates.
+        r = self.radius
+        (w, h) = (self.width + 2 * r, self.height + 2 * r)
+        px = np.floor(x).astype(np.int64) + r
+        py = np.floor(y).astype(np.int64) + r
+        inside = (px >= 0) & (px < w) & (py >= 0) & (py < h)
+        cells = np.unique(py[inside] * w + px[inside])
+        (px, py) = (cells % w - r, cells // w - r)
+        parts = []
+        for (dx, dy) in self.offsets:
+            (qx, qy) = (px + dx, py + dy)
+            on_map = (qx >= 0) & (qx < self.width) & (qy >= 0) & (qy < self.height)
+            parts.append(qy[on_map] * self.width + qx[on_map])
+        idx = np.unique(np.concatenate(parts))
+        self.grid[idx] += 1
+
+    def max_count(self):
+        return(int(self.grid.max()))
+
+    # The heatmap as a height x width x 4 RGBA array.  Counts are shown on
+    # a log scale that tops out at the given percentile of the non-zero
+    # counts, so a few very busy pixels don't wash out the rest.
+    def to_rgba(self, percentile=99.0):
+        rgba = np.zeros((self.width * self.height, 4), dtype=np.uint8)
+        hit = np.flatnonzero(self.grid)
+        if(len(hit) > 0):
+            counts = self.grid[hit].astype(np.float64)
+            top = max(np.percentile(counts, percentile), 1.0)
+            t = np.clip(np.log1p(counts) / np.log1p(top), 0.0, 1.0)
+            for c in range(4):
+                rgba[hit, c] = np.interp(t, ramp_stops, [color[c] for color in ramp_colors]).astype(np.uint8)
+        return(rgba.reshape(self.height, self.width, 4))
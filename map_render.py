@@ -0,0 +1,339 @@
+import io
+import os
+import math
+import re
+import shutil
+import subprocess
+import tempfile
+import numpy as np
+import profiler
+
+# Pillow is optional; without it only the ImageMagick renderer is available.
+try:
+    from PIL import Image, ImageDraw, ImageFont
+except ImportError:
+    Image = None
+
+tile_size = 256
+
+waypoint_circle_stroke = 'rgba(0,255,0,0.6)'
+waypoint_circle_fill = 'rgba(200,0,0,0.6)'
+waypoint_text_color = 'rgba(15,10,15,0.6)'
+waypoint_text_size = 26
+photo_stroke = 'rgba(255,255,255,0.9)'
+photo_fill = 'rgba(0,90,200,0.8)'
+photo_text_color = 'rgba(255,255,255,1)'
+photo_text_size = 14
+legend_height = 18
+
+# Radius of a photo marker standing for count photos.
+def photo_radius(count):
+    return(int(7 + 3 * math.log2(count)))
+
+# Image coordinates of the polyline (x, y), in global pixels, clipped to a
+# width x height window whose top left is global pixel (x0, y0).  Only
+# segments that reach into the window (widened by pad) are kept; returns
+# the runs of consecutive kept segments as lists of (x, y) points.
+def clip_polyline(x, y, x0, y0, width, height, pad):
+    x = x - x0
+    y = y - y0
+    if(len(x) < 2):
+        return([])
+    (xa, xb) = (x[:-1], x[1:])
+    (ya, yb) = (y[:-1], y[1:])
+    seg = ((np.maximum(xa, xb) >= -pad) & (np.minimum(xa, xb) < width + pad) &
+            (np.maximum(ya, yb) >= -pad) & (np.minimum(ya, yb) < height + pad))
+    seg = np.flatnonzero(seg)
+    if(len(seg) == 0):
+        return([])
+    breaks = np.flatnonzero(np.diff(seg) > 1) + 1
+    lines = []
+    for run in np.split(seg, breaks):
+        idx = np.append(run, run[-1] + 1)
+        lines.append(list(zip(x[idx].tolist(), y[idx].tolist())))
+    return(lines)
+
+# Convert an ImageMagick style 'rgba(r,g,b,a)' (a in 0..1) or 'rgb(r,g,b)'
+# string to an (r, g, b, a) tuple of ints.
+def parse_color(color):
+    m = re.match(r'\s*rgba?\(([^)]*)\)\s*$', color)
+    if(m is None):
+        raise ValueError('unknown color {}'.format(color))
+    parts = [float(p) for p in m.group(1).split(',')]
+    if(len(parts) == 3):
+        parts.append(1.0)
+    (r, g, b, a) = parts
+    return((int(round(r)), int(round(g)), int(round(b)), int(round(255 * a))))
+
+def _font(size):
+    try:
+        return(ImageFont.load_default(size=size))
+    except TypeError:
+        return(ImageFont.load_default())
+
+# Renders the map in memory with Pillow: tiles are pasted into one image,
+# each overlay is drawn on a layer no larger than its own extent and
+# alpha-composited in call order, and the result is encoded once by save().
+class pil_renderer(object):
+
+    def __init__(self, width, height, out_file_name, background=(255, 255, 255, 255)):
+        self.width = width
+        self.height = height
+        self.out_file_name = out_file_name
+        self.image = Image.new('RGBA', (width, height), background)
+        self.work_dir = None
+
+    def base_map(self, tiles_list, tiles_x, tiles_y, base_map_filename=None, rebuild=False):
+        for (i, tile_file) in enumerate(tiles_list):
+            with Image.open(tile_file) as tile:
+                x = tile_size * (i % tiles_x)
+                y = tile_size * (i // tiles_x)
+                self.image.paste(tile.convert('RGBA'), (x, y))
+
+    # Draw a layer covering the box (x0, y0, x1, y1) of a width x height
+    # image with draw_fn(draw, dx, dy).  Returns (x0, y0, layer), or None if
+    # the box is off the image.
+    @staticmethod
+    def _draw_layer(width, height, box, draw_fn):
+        x0 = max(0, int(box[0]))
+        y0 = max(0, int(box[1]))
+        x1 = min(width, int(box[2]) + 1)
+        y1 = min(height, int(box[3]) + 1)
+        if((x1 <= x0) or (y1 <= y0)):
+            return(None)
+        layer = Image.new('RGBA', (x1 - x0, y1 - y0), (0, 0, 0, 0))
+        draw_fn(ImageDraw.Draw(layer), -x0, -y0)
+        return((x0, y0, layer))
+
+    def _composite(self, box, draw_fn):
+        drawn = self._draw_layer(self.width, self.height, box, draw_fn)
+        if(drawn is not None):
+            (x0, y0, layer) = drawn
+            self.image.alpha_composite(layer, dest=(x0, y0))
+
+    # Rasterize a trace, given as a list of polylines, onto a layer cropped
+    # to its extent.  The result is plain data, (x0, y0, width, height, rgba
+    # bytes) or None, so it can be produced in a worker process and passed
+    # to add_layer().
+    @staticmethod
+    def render_trace(lines, color, stroke_width, width, height, name=None, work_dir=None):
+        lines = [points for points in lines if(len(points) >= 2)]
+        if(len(lines) == 0):
+            return(None)
+        xs = [p[0] for points in lines for p in points]
+        ys = [p[1] for points in lines for p in points]
+        pad = stroke_width + 1
+        rgba = parse_color(color)
+        def draw_fn(draw, dx, dy):
+            for points in lines:
+                draw.line([(x + dx, y + dy) for (x, y) in points], fill=rgba, width=stroke_width, joint='curve')
+        drawn = pil_renderer._draw_layer(width, height,
+                (min(xs) - pad, min(ys) - pad, max(xs) + pad, max(ys) + pad), draw_fn)
+        if(drawn is None):
+            return(None)
+        (x0, y0, layer) = drawn
+        return((x0, y0, layer.width, layer.height, layer.tobytes()))
+
+    def add_layer(self, layer):
+        if(layer is None):
+            return
+        (x0, y0, w, h, data) = layer
+        self.image.alpha_composite(Image.frombytes('RGBA', (w, h), data), dest=(x0, y0))
+
+    # Composite a height x width x 4 RGBA array covering the whole image.
+    def add_raster(self, rgba):
+        self.image.alpha_composite(Image.fromarray(rgba, 'RGBA'))
+
+    def add_trace(self, points, color, stroke_width, name=None):
+        self.add_layer(self.render_trace([points], color, stroke_width, self.width, self.height, name))
+
+    # markers is a list of (x, y, label).
+    def add_waypoints(self, markers):
+        if(len(markers) == 0):
+            return
+        font = _font(waypoint_text_size)
+        stroke = parse_color(waypoint_circle_stroke)
+        fill = parse_color(waypoint_circle_fill)
+        text = parse_color(waypoint_text_color)
+        def draw_fn(draw, dx, dy):
+            for (x, y, label) in markers:
+                (x, y) = (x + dx, y + dy)
+                draw.ellipse((x - 5, y - 5, x + 5, y + 5), outline=stroke, fill=fill, width=5)
+                draw.text((x + 10, y + 5), label, font=font, fill=text, anchor='ls')
+        self._composite((0, 0, self.width - 1, self.height - 1), draw_fn)
+
+    # markers is a list of (x, y, count); markers of several photos show
+    # the count.
+    def add_photos(self, markers):
+        if(len(markers) == 0):
+            return
+        font = _font(photo_text_size)
+        stroke = parse_color(photo_stroke)
+        fill = parse_color(photo_fill)
+        text = parse_color(photo_text_color)
+        def draw_fn(draw, dx, dy):
+            for (x, y, count) in markers:
+                (x, y, r) = (x + dx, y + dy, photo_radius(count))
+                draw.ellipse((x - r, y - r, x + r, y + r), outline=stroke, fill=fill, width=2)
+                if(count > 1):
+                    draw.text((x, y), str(count), font=font, fill=text, anchor='mm')
+        self._composite((0, 0, self.width - 1, self.height - 1), draw_fn)
+
+    def flatten(self):
+        pass
+
+    # Append a strip with the given text and background below the image.
+    def add_legend(self, text, color):
+        (w, h) = self.image.size
+        image = Image.new('RGBA', (w, h + legend_height), parse_color(color))
+        image.paste(self.image, (0, 0))
+        draw = ImageDraw.Draw(image)
+        draw.text((w / 2, h + legend_height - 2), text, font=_font(legend_height - 4), fill=(0, 0, 0, 255), anchor='ms')
+        self.image = image
+
+    def save(self):
+        self.image.save(self.out_file_name)
+
+    def to_png(self):
+        buf = io.BytesIO()
+        self.image.save(buf, format='PNG')
+        return(buf.getvalue())
+
+# Run an ImageMagick command, timed as a span named after the tool.
+def _im_call(cmd, shell=True):
+    tool = cmd.split()[0] if(shell) else cmd[0]
+    with profiler.span(tool, cat='imagemagick'):
+        return(subprocess.call(cmd, shell=shell))
+
+# Renders the map by running ImageMagick's montage and convert.  Overlays
+# and other intermediate files go in a private temporary directory, so
+# several maps can be rendered at once.
+class im_renderer(object):
+
+    def __init__(self, width, height, out_file_name):
+        self.width = width
+        self.height = height
+        self.out_file_name = out_file_name
+        self.overlay_files = []
+        self.work_dir = tempfile.mkdtemp(prefix='gtrace-')
+        self.waypoints_overlay_filename = os.path.join(self.work_dir, 'waypoints_overlay.png')
+
+    def base_map(self, tiles_list, tiles_x, tiles_y, base_map_filename, rebuild):
+        if(rebuild):
+            # Concatenate tiles to form whole map.
+            print('INFO: Concat\'ing {} tiles to form base map ...'.format(tiles_x * tiles_y))
+            cmd = 'montage -mode concatenate -tile %sx%s' % (tiles_x, tiles_y)
+            for tile in tiles_list:
+                cmd += ' %s' % tile
+            cmd += ' %s' % base_map_filename
+            _im_call(cmd.split(), shell=False)
+        else:
+            print('INFO: Base map already exists: {}'.format(base_map_filename))
+        os.rename(base_map_filename, self.out_file_name)
+
+    # Writes the overlay file for a trace, given as a list of polylines, in
+    # work_dir and returns its name, for add_layer().
+    @staticmethod
+    def render_trace(lines, color, stroke_width, width, height, name, work_dir):
+        cmd = 'convert -size {}x{}'.format(width, height)
+        cmd += ' xc:transparent -fill transparent -stroke "{}"'.format(color)
+        cmd += ' -strokewidth {}'.format(stroke_width)
+        for points in lines:
+            # IM freaks out when x coords are same between adjacent points.
+            coords = []
+            prev_x = None
+            for (x, y) in points:
+                if(x != prev_x):
+                    coords.append('{},{}'.format(x, y))
+                    prev_x = x
+            cmd += ' -draw "polyline {}"'.format(' '.join(coords))
+        # Traces in different directories may share a base name, and layers
+        # are rendered in parallel, so each gets a file of its own.
+        prefix = os.path.splitext(os.path.basename(name))[0] + '-'
+        (fd, overlay_filename) = tempfile.mkstemp(dir=work_dir, prefix=prefix, suffix='.png')
+        os.close(fd)
+        cmd += ' {}'.format(overlay_filename)
+        _im_call(cmd)
+        return(overlay_filename)
+
+    def add_layer(self, layer):
+        self.overlay_files.append(layer)
+
+    # Overlay a height x width x 4 RGBA array covering the whole image.
+    # The array is written out with Pillow if it is there, else handed to
+    # convert as raw RGBA bytes.
+    def add_raster(self, rgba):
+        overlay_filename = os.path.join(self.work_dir, 'raster{}.png'.format(len(self.overlay_files)))
+        if(Image is not None):
+            Image.fromarray(rgba, 'RGBA').save(overlay_filename)
+        else:
+            raw_filename = os.path.join(self.work_dir, 'raster.rgba')
+            np.ascontiguousarray(rgba, dtype=np.uint8).tofile(raw_filename)
+            _im_call(['convert', '-size', '{}x{}'.format(rgba.shape[1], rgba.shape[0]), '-depth', '8',
+                    'rgba:' + raw_filename, overlay_filename], shell=False)
+            os.remove(raw_filename)
+        self.add_layer(overlay_filename)
+
+    def add_trace(self, points, color, stroke_width, name):
+        self.add_layer(self.render_trace([points], color, stroke_width, self.width, self.height, name,
+                self.work_dir))
+
+    def add_waypoints(self, markers):
+        circle_parms = ' -stroke "{}" -strokewidth 5 -fill "{}"'.format(waypoint_circle_stroke, waypoint_circle_fill)
+        text_parms = ' -stroke "{}" -strokewidth 1 -fill "{}" -pointsize {}'.format(waypoint_text_color,
+                waypoint_text_color, waypoint_text_size)
+        cmd = 'convert -size {}x{} xc:transparent'.format(self.width, self.height)
+        for (x, y, label) in markers:
+            cmd += circle_parms + ' -draw "circle %d,%d %d,%d"' % (x, y, x+5, y)
+            cmd += text_parms + ' -annotate +%d+%d "%s"' % (x+10, y+5, label)
+        self.overlay_files.append(self.waypoints_overlay_filename)
+        cmd += ' ' + self.waypoints_overlay_filename
+        _im_call(cmd)
+
+    def add_photos(self, markers):
+        circle_parms = ' -stroke "{}" -strokewidth 2 -fill "{}"'.format(photo_stroke, photo_fill)
+        text_parms = ' -stroke none -fill "{}" -pointsize {}'.format(photo_text_color, photo_text_size)
+        cmd = 'convert -size {}x{} xc:transparent -gravity NorthWest'.format(self.width, self.height)
+        for (x, y, count) in markers:
+            cmd += circle_parms + ' -draw "circle %d,%d %d,%d"' % (x, y, x+photo_radius(count), y)
+            if(count > 1):
+                cmd += text_parms + ' -annotate +%d+%d "%d"' % (x-4*len(str(count)), y-photo_text_size//2, count)
+        overlay_filename = os.path.join(self.work_dir, 'photos_overlay.png')
+        self.overlay_files.append(overlay_filename)
+        cmd += ' ' + overlay_filename
+        _im_call(cmd)
+
+    # Create composite map with overlay file(s) over base map.
+    # To save resources, applies overlays one at a time.
+    def flatten(self):
+        for overlay_filename in self.overlay_files:
+            print('INFO: Applying overlay "%s".' % overlay_filename)
+            cmd = 'convert -page +0+0 {}'.format(self.out_file_name)
+            cmd += ' -page +0+0 {}'.format(overlay_filename)
+            cmd += ' -layers flatten {}'.format(self.out_file_name)
+            _im_call(cmd)
+
+    def add_legend(self, text, color):
+        temp_output_file = os.path.join(self.work_dir, 'legend.png')
+        # TODO: <prw>: Fix transparent bkgnd of annotation lines.
+        cmd = 'convert {} -gravity South -background "{}"'.format(self.out_file_name, color)
+        cmd += ' -splice 0x{} -annotate +0+2 \'{}\' {}'.format(legend_height, text, temp_output_file)
+        _im_call(cmd)
+        shutil.move(temp_output_file, self.out_file_name)
+
+    def save(self):
+        # Clean up overlay files.
+        shutil.rmtree(self.work_dir)
+
+renderers = {'pillow': pil_renderer, 'imagemagick': im_renderer}
+
+# Returns the name of the renderer to use, falling back to ImageMagick when
+# Pillow is not installed.
+def resolve_renderer(name):
+    if((name == 'pillow') and (Image is None)):
+        print('WARNING: Pillow not available, using ImageMagick.')
+        name = 'imagemagick'
+    return(name)
+
+def new_renderer(name, width, height, out_file_name):
+    return(renderers[resolve_renderer(name)](width, height, out_file_name))
@@ -1,6 +1,14 @@
+import os
 import math
-import os.path
+import time
+import tempfile
+import threading
+import urllib.parse
+import concurrent.futures
+import numpy as np
 import requests
+import requests.adapters
+import profiler
 
 # From <http://wiki.openstreetmap.org/wiki/Slippy_map_tilenames>
 # Given geo coordinates, return the OpenStreetMap tile X-Y numbers.
@@ -21,33 +29,118 @@ def num2deg(xtile, ytile, zoom):
   lat_deg = math.degrees(lat_rad)
   return ([lat_deg, lon_deg])
 
+# Web Mercator pixel coordinates, measured from the NW corner of tile (0, 0),
+# of whole arrays of lat/lon points at the given zoom.
+def deg2pixel(lats, lons, zoom):
+    lat_rad = np.radians(np.asarray(lats, dtype=np.float64))
+    n = 256.0 * 2.0 ** zoom
+    x = (np.asarray(lons, dtype=np.float64) + 180.0) / 360.0 * n
+    y = (1.0 - np.log(np.tan(lat_rad) + 1.0 / np.cos(lat_rad)) / math.pi) / 2.0 * n
+    return(x, y)
+
+# Name of the cached file for tile (x, y) at zoom.
+def tile_path(cache, zoom, x, y):
+    tile_name = '{}-{}-{}.png'.format(zoom, x, y)
+    return('{}/{}'.format(cache, tile_name))
+
 class map_tile_mgr(object):
 
-    def __init__(self, url, cache, api_key, ignore_cache=False):
+    def __init__(self, url, cache, api_key, ignore_cache=False, max_workers=8, per_host=4,
+            retries=3, backoff_s=0.5):
         self.tiles_url = url
         self.tiles_cache = cache
         self.api_key = api_key
         self.ignore_cache = ignore_cache
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff_s = backoff_s
         print('ignore_cache = {}'.format(self.ignore_cache))
 
-    def get_tile(self, zoom, x, y):
-        tile_name = '{}-{}-{}.png'.format(zoom, x, y)
-        tile_cache_full_path = '{}/{}'.format(self.tiles_cache, tile_name)
+        # One keep-alive session shared by all download threads.
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.per_host = per_host
+        self.host_limits = {}
+        self.host_limits_lock = threading.Lock()
 
-        if(self.ignore_cache or not os.path.isfile(tile_cache_full_path)):
-            print('INFO: Downloading tile {} ...'.format(tile_name))
-            tile_url = '{}/{}/{}/{}.png?apikey={}'.format(self.tiles_url, zoom, x, y, self.api_key)
-            r = requests.get(tile_url)
-            with open(tile_cache_full_path, 'wb') as f_img:
-                for chunk in r.iter_content(100):
-                    f_img.write(chunk)
+    def _tile_path(self, zoom, x, y):
+        return(tile_path(self.tiles_cache, zoom, x, y))
+
+    def _host_limit(self, url):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.host_limits_lock:
+            if(host not in self.host_limits):
+                self.host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return(self.host_limits[host])
+
+    # Fetch one tile into the cache, retrying with exponential backoff on
+    # connection errors and on 429/5xx responses.  The tile is written to a
+    # temporary file and renamed so the cache never holds a partial tile.
+    def _download(self, zoom, x, y):
+        with profiler.span('tile.download', cat='net', tile='{}-{}-{}'.format(zoom, x, y)):
+            return(self._fetch(zoom, x, y))
+
+    def _fetch(self, zoom, x, y):
+        tile_cache_full_path = self._tile_path(zoom, x, y)
+        print('INFO: Downloading tile {}-{}-{}.png ...'.format(zoom, x, y))
+        tile_url = '{}/{}/{}/{}.png?apikey={}'.format(self.tiles_url, zoom, x, y, self.api_key)
+        for attempt in range(self.retries + 1):
+            try:
+                with self._host_limit(self.tiles_url):
+                    r = self.session.get(tile_url, timeout=30)
+                    if((r.status_code == 429) or (r.status_code >= 500)):
+                        raise requests.HTTPError('HTTP {}'.format(r.status_code), response=r)
+                    r.raise_for_status()
+                    content = r.content
+                break
+            except (requests.ConnectionError, requests.Timeout, requests.HTTPError) as e:
+                retryable = (e.response is None) or (e.response.status_code == 429) or (e.response.status_code >= 500)
+                if((not retryable) or (attempt == self.retries)):
+                    raise
+                profiler.count('tiles.retries')
+                time.sleep(self.backoff_s * (2 ** attempt))
 
+        (fd, tmp_path) = tempfile.mkstemp(dir=self.tiles_cache, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f_img:
+                f_img.write(content)
+            os.replace(tmp_path, tile_cache_full_path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        profiler.count('tiles.fetched')
+        profiler.count('tiles.bytes', len(content))
         return(tile_cache_full_path)
 
+    def get_tile(self, zoom, x, y):
+        tile_cache_full_path = self._tile_path(zoom, x, y)
+        if(self.ignore_cache or not os.path.isfile(tile_cache_full_path)):
+            self._download(zoom, x, y)
+        else:
+            profiler.count('tiles.cache_hits')
+        return(tile_cache_full_path)
+
+    # Get every (x, y) tile in tile_list, downloading the missing ones in
+    # parallel.  Returns the cached file names in the order of tile_list.
+    def get_tiles(self, zoom, tile_list):
+        tile_files = [self._tile_path(zoom, x, y) for (x, y) in tile_list]
+        missing = []
+        for ((x, y), tile_file) in zip(tile_list, tile_files):
+            if(self.ignore_cache or not os.path.isfile(tile_file)):
+                missing.append((x, y))
+        profiler.count('tiles.cache_hits', len(tile_list) - len(missing))
+        if(len(missing) > 0):
+            with concurrent.futures.ThreadPoolExecutor(self.max_workers) as executor:
+                futures = [executor.submit(self._download, zoom, x, y) for (x, y) in missing]
+                for future in futures:
+                    future.result()
+        return(tile_files)
+
     def get_tile_timestamp(self, zoom, x, y):
-        tile_name = '{}-{}-{}.png'.format(zoom, x, y)
-        tile_cache_full_path = '{}/{}'.format(self.tiles_cache, tile_name)
-        
+        tile_cache_full_path = self._tile_path(zoom, x, y)
+
         tile_timestamp = None
         if(os.path.isfile(tile_cache_full_path)):
             tile_timestamp = os.path.getmtime(tile_cache_full_path)
@@ -1,64 +1,79 @@
 #!/usr/bin/env python3
 
+import heapq
 import argparse
+import path_store
+import profiler
 
 def parse_cmd_line():
     ap = argparse.ArgumentParser(description='List trace files with most segments.')
-    ap.add_argument('-f', '--paths-file', help='Name of paths file.', required=True)
+    ap.add_argument('-f', '--paths-file', help='Name of path store (.csv file or SQLite database).', required=True)
+    ap.add_argument('--profile', help='Print time spent per stage; also write a Chrome trace to TRACE_JSON if given',
+            nargs='?', const='', metavar='TRACE_JSON')
     args = ap.parse_args()
     return(args)
 
+# Greedy set cover: repeatedly takes the trace covering the most segments
+# not yet covered, until all are.  trace_segments holds a set of segment
+# numbers per trace.  Gains only shrink as segments get covered, so a
+# trace's gain in the heap is an upper bound and only the trace on top
+# needs to be rechecked (lazy greedy).  Ties go to the trace seen first.
+# Returns (trace, segments it newly covers) in the order taken.
+def greedy_cover(trace_segments):
+    heap = [(-len(segs), t) for (t, segs) in enumerate(trace_segments) if(len(segs) > 0)]
+    heapq.heapify(heap)
+    covered = set()
+    order = []
+    while(len(heap) > 0):
+        (neg_gain, t) = heapq.heappop(heap)
+        new = trace_segments[t] - covered
+        if(len(new) == 0):
+            continue
+        if(len(new) < -neg_gain):
+            heapq.heappush(heap, (-len(new), t))
+            continue
+        covered |= new
+        order.append((t, new))
+    return(order)
+
 def main():
     args = parse_cmd_line()
-    with open(args.paths_file, 'r') as f_path:
-        segments = []
-        segments_in_trace = {}
-        segments_to_trace = {}
-        for l in f_path:
-            (trace_file, timestamp, segment, _, _) = l.split(',')
-
+    if(args.profile is not None):
+        profiler.enable(args.profile)
+    store = path_store.open_store(args.paths_file, read_only=True)
+    segment_num = {}
+    segment_names = []
+    trace_num = {}
+    trace_files = []
+    trace_segments = []
+    with profiler.span('path_store.read', cat='io'):
+        for (trace_file, timestamp, segment, _, _) in store.iter_paths():
             # Sort endpoints so wA:wB == wB:wA
             end_pts = sorted(segment.split(':'))
             segment = '%s:%s' % (end_pts[0], end_pts[1])
 
-            if(segment not in segments):
-                segments.append(segment)
-
-            if(segment not in segments_to_trace.keys()):
-                segments_to_trace[segment] = []
-            segments_to_trace[segment].append(trace_file)
-
-            if(trace_file not in segments_in_trace.keys()):
-                segments_in_trace[trace_file] = []
-            segments_in_trace[trace_file].append(segment)
-
-#    for segment in segments:
-#        print(segment)
-
-#    for trace_file in segments_in_trace.keys():
-#        print('%s has %d segments' % (trace_file, len(segments_in_trace[trace_file])))
-
-#    for segment in segments_to_trace.keys():
-#        print('%s appears in %d tracefiles' % (segment,
-#        len(segments_to_trace[segment])))
+            if(segment not in segment_num):
+                segment_num[segment] = len(segment_names)
+                segment_names.append(segment)
+            if(trace_file not in trace_num):
+                trace_num[trace_file] = len(trace_files)
+                trace_files.append(trace_file)
+                trace_segments.append(set())
+            trace_segments[trace_num[trace_file]].add(segment_num[segment])
+    store.close()
 
-    for segment in segments:
-        max_num = 0
-        for trace_file in segments_to_trace[segment]:
-            if(len(segments_in_trace[trace_file]) > max_num):
-                trace_file_with_max = trace_file
-                max_num = len(segments_in_trace[trace_file])
-        print('segment %s taken from %s' % (segment, trace_file_with_max))
+    with profiler.span('cover'):
+        order = greedy_cover(trace_segments)
 
-        # TODO: <prw>: Some how duplicates make it into the list.
-        print('Removing the following segments from master list.')
-        for seg in segments_in_trace[trace_file]:
-            if(seg in segments):
-                print('  %s' % seg, end='')
-                segments.remove(seg)
-        print('')
+    num_covered = 0
+    for (t, new) in order:
+        num_covered += len(new)
+        print('%s adds %d segments (%d of %d)' % (trace_files[t], len(new), num_covered, len(segment_names)))
+        print('  ' + ' '.join([segment_names[i] for i in sorted(new)]))
+    print('INFO: %d of %d trace files cover all %d segments' % (len(order), len(trace_files), len(segment_names)))
 
 if(__name__ == '__main__'):
     main()
+    profiler.report()
 
 # vi:set ts=4 et sw=4:
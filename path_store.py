@@ -0,0 +1,302 @@
+import os
+import json
+import math
+import errno
+import sqlite3
+import urllib.request
+import quantile_sketch
+
+# Store of paths (segments between two waypoints) found in trace files.
+# Each row is one traversal: trace file, activity date, path id 'wA:wB',
+# distance (m) and time (s).  Any file name not ending in '.csv' is an
+# SQLite database; see open_store() for the .csv compatibility mode.
+#
+# Alongside the rows the store keeps a summary of each segment (see
+# segment_summary), updated in the same transaction as the rows, so reports
+# can read per-segment statistics without scanning the rows.
+
+schema = '''
+CREATE TABLE IF NOT EXISTS paths (
+    gps_file TEXT NOT NULL,
+    activity_datestamp TEXT,
+    path_id TEXT NOT NULL,
+    path_start TEXT NOT NULL,
+    path_end TEXT NOT NULL,
+    dist_m REAL,
+    time_s INTEGER
+);
+CREATE INDEX IF NOT EXISTS paths_path_id ON paths (path_id);
+CREATE INDEX IF NOT EXISTS paths_gps_file ON paths (gps_file);
+CREATE INDEX IF NOT EXISTS paths_date ON paths (activity_datestamp);
+'''
+
+# Created as a TEMP table, for this connection only, when a database
+# opened read-only predates the summaries.
+segments_schema = '''
+CREATE {}TABLE IF NOT EXISTS segments (
+    path_id TEXT PRIMARY KEY,
+    first_row INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    dist_sum REAL NOT NULL,
+    dist_sumsq REAL NOT NULL,
+    dist_min REAL,
+    dist_max REAL,
+    time_sum REAL NOT NULL,
+    time_sumsq REAL NOT NULL,
+    time_min REAL,
+    time_max REAL,
+    sketches TEXT NOT NULL
+);
+'''
+
+# SQL condition for usable() rows; NaN is stored as NULL.
+usable_sql = 'dist_m IS NOT NULL AND time_s IS NOT NULL AND ABS(dist_m) < 1e308 AND ABS(time_s) < 1e308'
+
+# Stored as PRAGMA user_version; databases from before the summaries get
+# them built when opened.
+summary_version = 1
+
+def _number(s):
+    try:
+        return(int(s))
+    except ValueError:
+        return(float(s))
+
+# Whether a traversal's distance and time are both numbers, not NULL (as
+# NaN is stored), NaN or infinite.
+def usable(dist_m, time_s):
+    return((dist_m is not None) and (time_s is not None) and math.isfinite(dist_m) and math.isfinite(time_s))
+
+# Summary of the traversals of one segment: count, sum, sum of squares,
+# minimum and maximum of distance and time, and quantile sketches of
+# distance, time and pace (s/m) that values can be added to and removed
+# from.  first_row is the rowid of the segment's first row in the store.
+# Traversals with a missing or non-finite distance or time (a trace without
+# DistanceMeters) are left out, so count is that of the usable ones.
+class segment_summary(object):
+
+    def __init__(self, path_id, first_row=None):
+        self.path_id = path_id
+        self.first_row = first_row
+        self.count = 0
+        self.dist_sum = 0.0
+        self.dist_sumsq = 0.0
+        self.dist_min = None
+        self.dist_max = None
+        self.time_sum = 0.0
+        self.time_sumsq = 0.0
+        self.time_min = None
+        self.time_max = None
+        self.dist_sketch = quantile_sketch.quantile_sketch()
+        self.time_sketch = quantile_sketch.quantile_sketch()
+        self.pace_sketch = quantile_sketch.quantile_sketch()
+
+    def add(self, dist_m, time_s):
+        if(not usable(dist_m, time_s)):
+            return
+        self.count += 1
+        self.dist_sum += dist_m
+        self.dist_sumsq += dist_m * dist_m
+        self.time_sum += time_s
+        self.time_sumsq += time_s * time_s
+        self.dist_min = dist_m if(self.dist_min is None) else min(self.dist_min, dist_m)
+        self.dist_max = dist_m if(self.dist_max is None) else max(self.dist_max, dist_m)
+        self.time_min = time_s if(self.time_min is None) else min(self.time_min, time_s)
+        self.time_max = time_s if(self.time_max is None) else max(self.time_max, time_s)
+        self.dist_sketch.add(dist_m)
+        self.time_sketch.add(time_s)
+        if(dist_m > 0):
+            self.pace_sketch.add(time_s / dist_m)
+
+    # Remove a traversal added before.  The sums may then carry rounding
+    # errors and the minimum and maximum be stale; the store refreshes them
+    # from the rows.
+    def remove(self, dist_m, time_s):
+        if(not usable(dist_m, time_s)):
+            return
+        self.count -= 1
+        self.dist_sum -= dist_m
+        self.dist_sumsq -= dist_m * dist_m
+        self.time_sum -= time_s
+        self.time_sumsq -= time_s * time_s
+        self.dist_sketch.remove(dist_m)
+        self.time_sketch.remove(time_s)
+        if(dist_m > 0):
+            self.pace_sketch.remove(time_s / dist_m)
+
+    def to_row(self):
+        sketches = {'dist_m': self.dist_sketch.to_json(), 'time_s': self.time_sketch.to_json(),
+                'pace': self.pace_sketch.to_json()}
+        return((self.path_id, self.first_row, self.count, self.dist_sum, self.dist_sumsq,
+                self.dist_min, self.dist_max, self.time_sum, self.time_sumsq, self.time_min, self.time_max,
+                json.dumps(sketches, separators=(',', ':'))))
+
+def _summary_from_row(row):
+    s = segment_summary(row[0], row[1])
+    (s.count, s.dist_sum, s.dist_sumsq, s.dist_min, s.dist_max,
+            s.time_sum, s.time_sumsq, s.time_min, s.time_max) = row[2:11]
+    sketches = json.loads(row[11])
+    s.dist_sketch = quantile_sketch.from_json(sketches['dist_m'])
+    s.time_sketch = quantile_sketch.from_json(sketches['time_s'])
+    s.pace_sketch = quantile_sketch.from_json(sketches['pace'])
+    return(s)
+
+class path_store(object):
+
+    def __init__(self, db_file, read_only=False):
+        self.db_file = db_file
+        self.read_only = read_only
+        if(read_only):
+            uri = 'file:{}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(db_file)))
+            self.conn = sqlite3.connect(uri, uri=True)
+        else:
+            self.conn = sqlite3.connect(db_file)
+            self.conn.executescript(schema + segments_schema.format(''))
+        if(self.conn.execute('PRAGMA user_version').fetchone()[0] < summary_version):
+            if(read_only):
+                self.conn.executescript(segments_schema.format('TEMP '))
+            self.rebuild_segments()
+
+    def close(self):
+        self.conn.close()
+
+    def has_trace(self, gps_file):
+        cur = self.conn.execute('SELECT 1 FROM paths WHERE gps_file = ? LIMIT 1', (gps_file,))
+        return(cur.fetchone() is not None)
+
+    def traces(self):
+        return(set([r[0] for r in self.conn.execute('SELECT DISTINCT gps_file FROM paths')]))
+
+    # Replace all paths of gps_file with the given (path_id, dist_m, time_s)
+    # tuples in a single transaction.
+    def add_paths(self, gps_file, activity_datestamp, paths):
+        with self.conn:
+            removed = self._delete_trace(gps_file)
+            last_row = self._last_row()
+            self.conn.executemany('INSERT INTO paths VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(gps_file, activity_datestamp, path_id) + tuple(path_id.split(':')) + (dist_m, time_s)
+                        for (path_id, dist_m, time_s) in paths])
+            self._update_segments(removed, paths, last_row)
+
+    def remove_trace(self, gps_file):
+        with self.conn:
+            self._update_segments(self._delete_trace(gps_file), [], self._last_row())
+
+    # Deletes the rows of gps_file; returns their (path_id, dist_m, time_s).
+    def _delete_trace(self, gps_file):
+        removed = self.conn.execute('SELECT path_id, dist_m, time_s FROM paths WHERE gps_file = ?',
+                (gps_file,)).fetchall()
+        if(len(removed) > 0):
+            self.conn.execute('DELETE FROM paths WHERE gps_file = ?', (gps_file,))
+        return(removed)
+
+    def _last_row(self):
+        return(self.conn.execute('SELECT COALESCE(MAX(rowid), 0) FROM paths').fetchone()[0])
+
+    # Apply removed and added (path_id, dist_m, time_s) traversals to the
+    # summaries of their segments; the added rows are those after last_row.
+    # Touches only the segments concerned, and their rows only when
+    # something was removed from them.
+    def _update_segments(self, removed, added, last_row):
+        changes = {}
+        for (path_id, dist_m, time_s) in removed:
+            changes.setdefault(path_id, ([], []))[0].append((dist_m, time_s))
+        for (path_id, dist_m, time_s) in added:
+            changes.setdefault(path_id, ([], []))[1].append((dist_m, time_s))
+        first_row = {}
+        if(len(added) > 0):
+            first_row = dict(self.conn.execute('SELECT path_id, MIN(rowid) FROM paths WHERE rowid > ? AND ' +
+                    usable_sql + ' GROUP BY path_id', (last_row,)))
+        for (path_id, (rem, add)) in changes.items():
+            s = self.segment(path_id)
+            if(s is None):
+                s = segment_summary(path_id, first_row.get(path_id))
+            for (dist_m, time_s) in rem:
+                s.remove(dist_m, time_s)
+            for (dist_m, time_s) in add:
+                s.add(dist_m, time_s)
+            if(s.count == 0):
+                self.conn.execute('DELETE FROM segments WHERE path_id = ?', (path_id,))
+                continue
+            if(len(rem) > 0):
+                (s.first_row, s.dist_sum, s.dist_sumsq, s.dist_min, s.dist_max,
+                        s.time_sum, s.time_sumsq, s.time_min, s.time_max) = self.conn.execute(
+                        'SELECT MIN(rowid), TOTAL(dist_m), TOTAL(dist_m * dist_m), MIN(dist_m), MAX(dist_m), '
+                        'TOTAL(time_s), TOTAL(time_s * time_s), MIN(time_s), MAX(time_s) FROM paths '
+                        'WHERE path_id = ? AND ' + usable_sql, (path_id,)).fetchone()
+            self.conn.execute('INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    s.to_row())
+
+    # Recompute all summaries from the rows.
+    def rebuild_segments(self):
+        summaries = {}
+        cur = self.conn.execute('SELECT rowid, path_id, dist_m, time_s FROM paths ORDER BY rowid')
+        for (rowid, path_id, dist_m, time_s) in cur:
+            if(not usable(dist_m, time_s)):
+                continue
+            if(path_id not in summaries):
+                summaries[path_id] = segment_summary(path_id, rowid)
+            summaries[path_id].add(dist_m, time_s)
+        with self.conn:
+            self.conn.execute('DELETE FROM segments')
+            self.conn.executemany('INSERT INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [s.to_row() for s in summaries.values()])
+            if(not self.read_only):
+                self.conn.execute('PRAGMA user_version = {}'.format(summary_version))
+
+    # Summary of path_id, or None if it hasn't been traversed.
+    def segment(self, path_id):
+        row = self.conn.execute('SELECT * FROM segments WHERE path_id = ?', (path_id,)).fetchone()
+        if(row is None):
+            return(None)
+        return(_summary_from_row(row))
+
+    # Yields the summaries of all segments in the order they first appear
+    # in the rows.
+    def iter_segments(self):
+        for row in self.conn.execute('SELECT * FROM segments ORDER BY first_row'):
+            yield(_summary_from_row(row))
+
+    # Yields (gps_file, activity_datestamp, path_id, dist_m, time_s) in the
+    # order the rows were added, optionally for one path only.
+    def iter_paths(self, path_id=None):
+        sql = 'SELECT gps_file, activity_datestamp, path_id, dist_m, time_s FROM paths'
+        if(path_id is None):
+            cur = self.conn.execute(sql + ' ORDER BY rowid')
+        else:
+            cur = self.conn.execute(sql + ' WHERE path_id = ? ORDER BY rowid', (path_id,))
+        for row in cur:
+            yield(row)
+
+    def import_csv(self, csv_file):
+        rows = []
+        with open(csv_file, 'r') as f_csv:
+            for line in f_csv:
+                (gps_file, activity_datestamp, path_id, dist_m, time_s) = line.strip().split(',')
+                rows.append((gps_file, activity_datestamp, path_id) + tuple(path_id.split(':')) +
+                        (float(dist_m), _number(time_s)))
+        with self.conn:
+            last_row = self._last_row()
+            self.conn.executemany('INSERT INTO paths VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self._update_segments([], [(r[2], r[5], r[6]) for r in rows], last_row)
+
+    def export_csv(self, csv_file):
+        tmp_file = csv_file + '.tmp'
+        with open(tmp_file, 'w') as f_csv:
+            for row in self.iter_paths():
+                f_csv.write('%s,%s,%s,%s,%s\n' % row)
+        os.replace(tmp_file, csv_file)
+
+# Open the path store in filename.  A '.csv' file is loaded into an
+# in-memory database; callers that modify it should export_csv() it back.
+# A store that doesn't exist yet is created empty, unless read_only is
+# set, in which case it must exist and a database is opened read-only.
+def open_store(filename, read_only=False):
+    if(read_only and (not os.path.isfile(filename))):
+        raise FileNotFoundError(errno.ENOENT, 'No such path store', filename)
+    if(filename.lower().endswith('.csv')):
+        store = path_store(':memory:')
+        if(os.path.isfile(filename)):
+            store.import_csv(filename)
+        return(store)
+    return(path_store(filename, read_only))
@@ -2,23 +2,28 @@
 # $Id: plot-gps-traces.py,v 1.2 2017/01/16 06:06:44 paulw Exp paulw $
 # Paul R. Woods, Corvallis, Oregon
 
-# TODO: Add pool to process layers in parallel.
 # TODO: Add options for plotting dist tics, time tics, stops, min/max elev, etc.
-# TODO: Add option for accepting a list of photos, extract GPS info, and plot location of photos on map.
 
 import os
 import time
-import math
+import hashlib
 import argparse
+import collections
 import colorsys
+import multiprocessing as mp
+import numpy as np
 import requests
-import subprocess
 import extract_exif_gps
 import garmin
+import heatmap
+import trace_cache
+import map_render
+import simplify
 import map_tile_mgr
+import profiler
+import tile_pyramid
 import waypoint_mgr
-from map_tile_mgr import deg2num, num2deg
-from garmin import ns
+from map_tile_mgr import deg2num, deg2pixel
 
 alpha = 0.6
 rc_file = '{}/.trace.rc'.format(os.environ['HOME'])
@@ -35,6 +40,15 @@ def parse_cmd_line():
     ap.add_argument('-c', '--tile-cache', help='Directory where downloaded tiles are stored locally.',
             default='tile-cache/')
     ap.add_argument('-j', '--ignore-cache', help='Download tiles, ignoring any in cache', action='store_true')
+    ap.add_argument('-d', '--download-threads', help='Number of tiles to download in parallel', type=int, default=8)
+    ap.add_argument('-r', '--renderer', help='Rendering engine', choices=sorted(map_render.renderers.keys()),
+            default='pillow')
+    ap.add_argument('-n', '--jobs', help='Number of trace layers to render in parallel', type=int, default=1)
+    ap.add_argument('-y', '--pyramid',
+            help='Write trace and waypoint overlay tiles to this directory (z/x/y.png) or .mbtiles file')
+    ap.add_argument('-m', '--min-zoom', help='Lowest zoom of the tile pyramid (default: the zoom factor)', type=int)
+    ap.add_argument('-e', '--heatmap', help='Draw traces as one heatmap of how often each spot was visited',
+            action='store_true')
     ap.add_argument('-s', '--stroke-width', help='Width of drawn trace', type=int, default=5)
     ap.add_argument('-l', '--legend', help='Add legend', action='store_true')
     ap.add_argument('-b', '--buffer', help='Add small buffer to map extent', action='store_true')
@@ -42,6 +56,8 @@ def parse_cmd_line():
     ap.add_argument('-p', '--waypoints-file', help='Name of waypoints .xml file')
     ap.add_argument('-x', '--tiles-per-frame', help='Tiles per frame')
     ap.add_argument('-w', '--waypoint-extents', help='Use waypoints for map extent', nargs='*', default=[])
+    ap.add_argument('--profile', help='Print time spent per stage; also write a Chrome trace to TRACE_JSON if given',
+            nargs='?', const='', metavar='TRACE_JSON')
     args = ap.parse_args()
     return(args)
 
@@ -50,6 +66,12 @@ def trace_color(hue):
     ret_val = 'rgba({},{},{},{})'.format(170 * r, 170 * g, 170 * b, alpha)
     return (ret_val)
 
+# Color of a trace in a tile pyramid.  It follows from the trace file alone,
+# so adding or removing a trace leaves the tiles of the others as they are.
+def file_color(gps_file):
+    h = hashlib.sha1(gps_file.encode('utf-8')).digest()
+    return(trace_color(int.from_bytes(h[:4], 'big') / 2**32))
+
 def read_rc_file():
     rc = {}
     if(os.path.exists(rc_file)):
@@ -61,215 +83,358 @@ def read_rc_file():
                 rc[a.strip()] = b.strip()
     return(rc)
 
-def generate_map(rc, args, nw_tile, se_tile, frm_x=None, frm_y=None):
-    # Create map tile manager object.
-    mtm = map_tile_mgr.map_tile_mgr(args.tiles_url, args.tile_cache, rc['map_api_key'], args.ignore_cache)
-
-    if(args.waypoints_file):
-        waypoints_file = args.waypoints_file
+# Per-process state, set up by init_worker(): the renderer, the loaded
+# traces, the waypoints, the photo positions and the trace cache, shared by
+# every frame, layer and tile.
+renderer_name = None
+layer_renderer = None
+traces = None
+wp_markers = None
+photos = None
+t_cache = None
+
+# Photos in the same square of this many pixels, on a grid fixed to the
+# map, are drawn as one marker.  Photos close together on either side of a
+# grid line get markers of their own.
+photo_cluster_px = 32
+
+def init_worker(name, trace_list, markers, photo_ll=None, cache=None):
+    global renderer_name, layer_renderer, traces, wp_markers, photos, t_cache
+    renderer_name = name
+    layer_renderer = map_render.renderers[name]
+    traces = trace_list
+    wp_markers = markers
+    photos = photo_ll
+    t_cache = cache
+
+# Parse each trace once.  Returns a list of dicts with the file name, the
+# bbox and the legend annotation, and unless points is False the 'lat' and
+# 'lon' arrays of its positioned points and their simplification ranks
+# 'sig' (see trace_points()).
+def load_traces(gps_files, t_cache, points=True):
+    trace_list = []
+    for gps_file in gps_files:
+        print('INFO: Processing file {} ...'.format(gps_file))
+        gt = garmin.garmin(gps_file, cache=t_cache)
+        pos = gt.has_position()
+        start_time = gt.get_activity_start_datestamp()
+        elev_gain_ft = gt.calc_elev_gain() * 3.28084
+        try:
+            start_coord = gt.get_starting_coord()
+        except IndexError:
+            start_coord = None
+        profiler.count('trackpoints_loaded', int(pos.sum()))
+        # TODO: <prw>: Add more info to annot string.
+        trace = {'gps_file': gps_file, 'bbox': gt.get_bbox(), 'start_coord': start_coord,
+                'start_time': start_time, 'legend': '{} {} {}'.format(gps_file, start_time, elev_gain_ft)}
+        if(points):
+            trace.update(trace_points(gt, t_cache))
+        trace_list.append(trace)
+    return(trace_list)
+
+# The positioned points of a parsed trace and their simplification ranks.
+def trace_points(gt, t_cache):
+    pos = gt.has_position()
+    return({'lat': gt.lat[pos], 'lon': gt.lon[pos], 'sig': simplify.trace_significance(gt, t_cache)})
+
+# Global pixel coordinates at zoom of a trace, simplified for that zoom.
+# Only the points kept are projected.
+def project_trace(trace, zoom):
+    keep = simplify.select(trace['sig'], zoom)
+    (x, y) = deg2pixel(trace['lat'][keep], trace['lon'][keep], zoom)
+    return(np.floor(x).astype(np.int64), np.floor(y).astype(np.int64))
+
+# Group the points (x, y) by the cell x cell pixel square they fall in.
+# Returns the mean x, mean y and number of points of each group.
+def cluster_points(x, y, cell):
+    if(len(x) == 0):
+        return(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    cells = np.stack((x // cell, y // cell), axis=1)
+    (cells, inverse, counts) = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    mean_x = np.floor(np.bincount(inverse, weights=x) / counts).astype(np.int64)
+    mean_y = np.floor(np.bincount(inverse, weights=y) / counts).astype(np.int64)
+    return(mean_x, mean_y, counts)
+
+# Waypoints and photo clusters projected to global pixels at one zoom,
+# kept for the last zoom asked for: ((wp_x, wp_y), (photo_x, photo_y,
+# photo_count)).
+marker_projection = {}
+
+def projected_markers(zoom):
+    if(zoom not in marker_projection):
+        marker_projection.clear()
+        (wp_x, wp_y) = deg2pixel(wp_markers[0], wp_markers[1], zoom)
+        wp_xy = (np.floor(wp_x).astype(np.int64), np.floor(wp_y).astype(np.int64))
+        photo_xyn = cluster_points(np.zeros(0), np.zeros(0), photo_cluster_px)
+        if(photos is not None):
+            (photo_x, photo_y) = deg2pixel(photos[0], photos[1], zoom)
+            photo_xyn = cluster_points(np.floor(photo_x), np.floor(photo_y), photo_cluster_px)
+        marker_projection[zoom] = (wp_xy, photo_xyn)
+    return(marker_projection[zoom])
+
+# Traces, waypoints and photo clusters projected to global pixels at one
+# zoom, kept for the last zoom asked for: ([(x, y) per trace], (wp_x, wp_y),
+# (photo_x, photo_y, photo_count)).
+projection = {}
+
+def projected(zoom):
+    if(zoom not in projection):
+        projection.clear()
+        trace_xy = [project_trace(t, zoom) for t in traces]
+        projection[zoom] = (trace_xy,) + projected_markers(zoom)
+    return(projection[zoom])
+
+# Markers, (x, y, label), of the points xy in a width x height window whose
+# top left is global pixel (x0, y0), widened by margin so markers and
+# labels spilling over from outside are drawn too.
+def window_markers(xy, labels, x0, y0, width, height, margin=0):
+    x_in_img = xy[0] - x0
+    y_in_img = xy[1] - y0
+    on_map = ((x_in_img >= -margin) & (x_in_img < width + margin) &
+            (y_in_img >= -margin) & (y_in_img < height + margin))
+    markers = []
+    for i in np.flatnonzero(on_map):
+        markers.append((int(x_in_img[i]), int(y_in_img[i]), labels[i]))
+    return(markers)
+
+# Clip and rasterize one trace.  Runs in a worker process when layers are
+# rendered in parallel; the returned layer is composited in trace order.
+@profiler.profiled('render_layer')
+def render_layer(job):
+    (i, color, zoom, nw_tile, stroke_width, width, height, work_dir) = job
+    (x, y) = projected(zoom)[0][i]
+    lines = map_render.clip_polyline(x, y, 256 * nw_tile[0], 256 * nw_tile[1], width, height, stroke_width+1)
+    return(layer_renderer.render_trace(lines, color, stroke_width, width, height,
+            traces[i]['gps_file'], work_dir))
+
+# Render one transparent overlay tile of the pyramid with the traces that
+# touch it and the waypoints on it.  Returns (zoom, x, y, png data).
+@profiler.profiled('render_tile')
+def render_tile(job):
+    (zoom, tx, ty, trace_idx, stroke_width) = job
+    (trace_xy, wp_xy) = projected(zoom)[:2]
+    if(map_render.Image is None):
+        raise RuntimeError('Rendering pyramid tiles needs Pillow')
+    tile = map_render.pil_renderer(256, 256, None, background=(0, 0, 0, 0))
+    for i in trace_idx:
+        (x, y) = trace_xy[i]
+        lines = map_render.clip_polyline(x, y, 256 * tx, 256 * ty, 256, 256, stroke_width+1)
+        tile.add_layer(tile.render_trace(lines, file_color(traces[i]['gps_file']), stroke_width, 256, 256))
+    tile.add_waypoints(window_markers(wp_xy, wp_markers[2], 256 * tx, 256 * ty, 256, 256, margin=128))
+    return((zoom, tx, ty, tile.to_png()))
+
+# Write the trace and waypoint overlays as a tile pyramid from min_zoom to
+# max_zoom.  Only tiles touched by a trace are rendered, each on its own,
+# and tiles whose inputs haven't changed since they were written are
+# skipped.
+def generate_pyramid(args, waypoints_file, min_zoom, max_zoom):
+    writer = tile_pyramid.open_writer(args.pyramid)
+    writer.set_metadata({'name': os.path.basename(args.pyramid), 'format': 'png', 'type': 'overlay',
+            'minzoom': min_zoom, 'maxzoom': max_zoom})
+    inputs = []
+    for trace in traces:
+        inputs.append((trace['gps_file'], os.path.getmtime(trace['gps_file']), file_color(trace['gps_file'])))
+    common = (args.stroke_width, simplify.default_tol_px, os.path.getmtime(waypoints_file))
+
+    pool = None
+    if(args.jobs > 1):
+        pool = mp.Pool(args.jobs, initializer=init_worker, initargs=(renderer_name, traces, wp_markers, photos))
+    for zoom in range(min_zoom, max_zoom+1):
+        (trace_xy, wp_xy) = projected(zoom)[:2]
+        touched = {}
+        for (i, (x, y)) in enumerate(trace_xy):
+            for tile in tile_pyramid.touched_tiles(x, y, args.stroke_width+1):
+                touched.setdefault(tile, []).append(i)
+        jobs = []
+        signatures = {}
+        for (tile, trace_idx) in sorted(touched.items()):
+            sig = tile_pyramid.signature(common + tuple(inputs[i] for i in trace_idx))
+            signatures[tile] = sig
+            if(args.ignore_cache or (writer.get_signature(zoom, tile[0], tile[1]) != sig)):
+                jobs.append((zoom, tile[0], tile[1], trace_idx, args.stroke_width))
+        stale = [tile for tile in writer.tiles(zoom) if(tile not in touched)]
+        for (x, y) in stale:
+            writer.remove(zoom, x, y)
+        print('INFO: z={}: {} tiles touched, {} to render, {} removed'.format(zoom, len(touched),
+                len(jobs), len(stale)))
+
+        if(pool is not None):
+            results = pool.imap_unordered(render_tile, jobs, chunksize=16)
+        else:
+            results = map(render_tile, jobs)
+        for (z, x, y, data) in results:
+            with profiler.span('pyramid.write', cat='io'):
+                writer.write(z, x, y, data, signatures[(x, y)])
+    if(pool is not None):
+        pool.close()
+        pool.join()
+    writer.close()
+    print('INFO: Tile pyramid "{}" is ready.'.format(args.pyramid))
+
+# Tiles, in row order, of the window from nw_tile to se_tile.
+def window_tiles(nw_tile, se_tile):
+    tiles_xy = []
+    for y in range(nw_tile[1], se_tile[1]+1):
+        for x in range(nw_tile[0], se_tile[0]+1):
+            tiles_xy.append((x, y))
+    return(tiles_xy)
+
+# Results of func over jobs from pool, in order, like pool.imap(), but with
+# at most window of them submitted and not yet taken, so results don't pile
+# up in this process while it is busy with earlier ones.
+def bounded_imap(pool, func, jobs, window):
+    pending = collections.deque()
+    for job in jobs:
+        if(len(pending) >= window):
+            yield(pending.popleft().get())
+        pending.append(pool.apply_async(func, (job,)))
+    while(len(pending) > 0):
+        yield(pending.popleft().get())
+
+# Create trace overlays.  Layers are rendered in worker processes when
+# asked to, but composited here in trace order so colors stack the same as
+# for a serial run.  Each layer is a full-size image, so no more than one
+# per worker, plus one, waits here to be composited at a time.
+def draw_traces(args, renderer, nw_tile, image_width, image_height, jobs):
+    num_traces = len(traces)
+    if(num_traces == 0):
+        num_traces = 1;
+    layer_jobs = []
+    for i in range(len(traces)):
+        layer_jobs.append((i, trace_color(i / num_traces), args.zoom_factor, list(nw_tile), args.stroke_width,
+                image_width, image_height, renderer.work_dir))
+    pool = None
+    if((jobs > 1) and (len(layer_jobs) > 1)):
+        num_workers = min(jobs, len(layer_jobs))
+        pool = mp.Pool(num_workers, initializer=init_worker,
+                initargs=(renderer_name, traces, wp_markers, photos))
+        layers = bounded_imap(pool, render_layer, layer_jobs, num_workers + 1)
     else:
-        if('waypoints_file' in rc.keys()):
-            waypoints_file = rc['waypoints_file']
-    w_mgr = waypoint_mgr.waypoint_mgr(waypoints_file)
-    waypoints = w_mgr.read_waypoints()
-    tile2wp = w_mgr.get_tile_to_waypoint_map(args.zoom_factor)
-
+        layers = map(render_layer, layer_jobs)
+    for trace in traces:
+        print('INFO: Building trace layer from file {} ...'.format(trace['gps_file']))
+        renderer.add_layer(next(layers))
+    if(pool is not None):
+        pool.close()
+        pool.join()
+
+# Render the map of the window from nw_tile to se_tile.  Tiles must already
+# be in the cache and init_worker() must have been called.  Trace layers
+# are rendered by up to jobs worker processes.
+def generate_map(args, nw_tile, se_tile, frm_x=None, frm_y=None, jobs=1):
     tiles_x = se_tile[0] - nw_tile[0] + 1
     tiles_y = se_tile[1] - nw_tile[1] + 1
     base_map_filename = args.tile_cache+'{}-{}-{}-{}-{}.png'.format(args.zoom_factor,
             nw_tile[0], se_tile[0], nw_tile[1], se_tile[1])
 
-    # Sanity check number of tiles to be used.  If too many, assume it's an error.
-    num_tiles = tiles_x * tiles_y
-    if(num_tiles > 2500):
-        raise Exception ('ERROR: Too many tiles ({}) required (z={}).'.format(num_tiles, args.zoom_factor))
-
-    # Download the tiles, if necessary.
-    tiles_list = []
-    tiles_obtained = 0
-    newest_tile_mod_time = None
-    for y in range(nw_tile[1], se_tile[1]+1):
-        for x in range(nw_tile[0], se_tile[0]+1):
-            tile_name = args.tile_cache+'{}-{}-{}.png'.format(args.zoom_factor, x, y)
-            tiles_list.append(tile_name)
-            mtm.get_tile(args.zoom_factor, x, y)
-            tiles_obtained += 1
-            print('INFO: {} % of tiles obtained'.format(int(100 * tiles_obtained / num_tiles)))
+    tiles_list = [map_tile_mgr.tile_path(args.tile_cache, args.zoom_factor, x, y)
+            for (x, y) in window_tiles(nw_tile, se_tile)]
+
+    # Find latest timestamp of all tiles.
+    newest_tile_mod_time = max([os.path.getmtime(tile_file) for tile_file in tiles_list])
+    print('  Latest tile timestamp = %s' % newest_tile_mod_time)
+
+    image_width = tiles_x * 256
+    image_height = tiles_y * 256
 
-            # Find latest timestamp of all tiles.
-            tile_timestamp = mtm.get_tile_timestamp(args.zoom_factor, x, y)
-            if((newest_tile_mod_time is None) or (tile_timestamp > newest_tile_mod_time)):
-                newest_tile_mod_time = tile_timestamp
-                print('  Latest tile timestamp = %s' % newest_tile_mod_time)
+    # Generate output file name.
+    (out_file_name, out_file_ext) = args.output_file.split('.')
+    if(args.tiles_per_frame is not None):
+        out_file_name += '-%dx%d' % (frm_x, frm_y)
+    out_file_name += '.%s' % out_file_ext
 
+    renderer = map_render.new_renderer(renderer_name, image_width, image_height, out_file_name)
 
     # Create base map if we're ignoring the cache of tiles, or there isn't
     # already a base map, or if the existing base map is older than the
     # newest tile in it.
+    rebuild = True
     if(os.path.isfile(base_map_filename)):
         base_map_mod_time = os.path.getmtime(base_map_filename)
         print('  Timestamp = %s' % base_map_mod_time)
-
-    if((not os.path.isfile(base_map_filename)) or args.ignore_cache or (base_map_mod_time < newest_tile_mod_time)):
-        # Concatenate tiles to form whole map.
-        print('INFO: Concat\'ing {} tiles to form base map ...'.format(tiles_x * tiles_y))
-        cmd = 'montage -mode concatenate -tile %sx%s' % (tiles_x, tiles_y)
-        for tile in tiles_list:
-            cmd += ' %s' % tile
-        cmd += ' %s' % base_map_filename
-        subprocess.call(cmd.split())
+        rebuild = args.ignore_cache or (base_map_mod_time < newest_tile_mod_time)
+    with profiler.span('base_map'):
+        renderer.base_map(tiles_list, tiles_x, tiles_y, base_map_filename, rebuild)
+
+    if(args.heatmap):
+        # Stream the traces through one count grid, parsing and projecting
+        # one at a time so only one trace's points are in memory, and
+        # composite the grid once.  Traces whose bbox misses the frame are
+        # neither parsed nor projected.
+        (x0, y0) = (256 * nw_tile[0], 256 * nw_tile[1])
+        margin = args.stroke_width // 2 + 1
+        in_frame = []
+        for trace in traces:
+            (bb_n, bb_w, bb_s, bb_e) = trace['bbox']
+            (bb_x, bb_y) = deg2pixel([bb_n, bb_s], [bb_w, bb_e], args.zoom_factor)
+            if((bb_x[1] >= x0 - margin) and (bb_x[0] < x0 + image_width + margin) and
+                    (bb_y[1] >= y0 - margin) and (bb_y[0] < y0 + image_height + margin)):
+                in_frame.append(trace)
+        print('INFO: Accumulating heatmap of {} of {} traces ...'.format(len(in_frame), len(traces)))
+        with profiler.span('heatmap'):
+            heat = heatmap.heatmap(image_width, image_height, x0, y0, args.stroke_width // 2)
+            for trace in in_frame:
+                if('lat' in trace):
+                    points = trace
+                else:
+                    points = trace_points(garmin.garmin(trace['gps_file'], cache=t_cache), t_cache)
+                heat.add(*project_trace(points, args.zoom_factor))
+            renderer.add_raster(heat.to_rgba())
     else:
-        print('INFO: Base map already exists: {}'.format(base_map_filename))
-
-    image_width = tiles_x * 256
-    image_height = tiles_y * 256
-
-    # Create IM run strings to create trace overlay images.
-    overlay_files = []
-    cc = 0
-    prev_x_in_img = None
-    prev_y_in_img = None
-    num_traces = len(args.gps_file)
-    if(num_traces == 0):
-        num_traces = 1;
-    for gps_file in args.gps_file:
-        print('INFO: Building trace layer from file {} ...'.format(gps_file))
-        gt = garmin.garmin(gps_file)
-
-        cmd = 'convert -size {}x{}'.format(image_width, image_height)
-        cmd += ' xc:transparent -fill transparent -stroke "{}"'.format(trace_color(cc / num_traces))
-        cmd += ' -strokewidth {} -draw "polyline '.format(args.stroke_width)
-        cc += 1
-
-        for tp in gt.iter_position():
-            try:
-                lat = float(tp.find('.//garmin:LatitudeDegrees', ns).text)
-                lon = float(tp.find('.//garmin:LongitudeDegrees', ns).text)
-            except AttributeError:
-                continue
-
-            # Calculate the tile number that it's found on.
-            tile = deg2num([lat, lon], args.zoom_factor)
-
-            # Calculate the lat/lon of the corners of the tile.
-            (tile_N, tile_W) = num2deg(tile[0], tile[1], args.zoom_factor)
-            (tile_S, tile_E) = num2deg(tile[0]+1, tile[1]+1, args.zoom_factor)
-
-            # Calculate the x,y pixel within that tile.
-            x_in_tile = int(256.0 * (lon - tile_W) / (tile_E - tile_W))
-            y_in_tile = int(256.0 * (lat - tile_N) / (tile_S - tile_N))
-
-            # Add the offsets from edge of bounding box.
-            offset_x = 256.0 * (tile[0] - nw_tile[0])
-            offset_y = 256.0 * (tile[1] - nw_tile[1])
-
-            x_in_img = int(offset_x + x_in_tile)
-            y_in_img = int(offset_y + y_in_tile)
-            if(prev_x_in_img is None):
-                cmd += ' {},{}'.format(x_in_img, y_in_img)
-                prev_x_in_img = x_in_img
-                prev_y_in_img = y_in_img
-            else:
-                dist_to_new = math.sqrt((x_in_img - prev_x_in_img)**2 +
-                        (y_in_img - prev_y_in_img)**2)
-                # IM freaks out when x coords are same between adjacent points.
-                if((x_in_img != prev_x_in_img) and (dist_to_new > args.stroke_width+1)):
-                    cmd += ' {},{}'.format(x_in_img, y_in_img)
-                    prev_x_in_img = x_in_img
-                    prev_y_in_img = y_in_img
-
-        overlay_filename = gps_file.replace('.tcx', '.png')
-        overlay_filename = overlay_filename.replace('.zip', '.png')
-        overlay_files.append(overlay_filename)
-        cmd += '" {}'.format(overlay_filename)
-        subprocess.call(cmd, shell=True)
-
-    # Create overlay of points showing location of geo-coded jpg images.
-    if(args.images is not None):
-        for jpg_file in args.images:
-            (lat, lon) = jpg_gps_ex.get_coords(jpg_file)
-            print('DEBUG: Photo {} taken at ({}, {})'.format(jpg_file, lat, lon))
-            # TODO: <prw>: Create mark on overlay layer.
+        with profiler.span('draw_traces'):
+            draw_traces(args, renderer, nw_tile, image_width, image_height, jobs)
 
     # Create layer of waypoints.
-    circle_parms = ' -stroke "rgba(0,255,0,0.6)" -strokewidth 5 -fill "rgba(200,0,0,0.6)"'
-    text_parms = ' -stroke "rgba(15,10,15,0.6)" -strokewidth 1 -fill "rgba(15,10,15,0.6)" -pointsize 26'
-    cmd = 'convert -size {}x{} xc:transparent'.format(image_width, image_height)
-    for y in range(nw_tile[1], se_tile[1]+1):
-        offset_y = 256.0 * (y - nw_tile[1])
-        for x in range(nw_tile[0], se_tile[0]+1):
-            offset_x = 256.0 * (x - nw_tile[0])
-            if(x in tile2wp.keys()):
-                if(y in tile2wp[x].keys()):
-                    for wptid in tile2wp[x][y]:
-                        wp_lat = waypoints[wptid]['lat']
-                        wp_lon = waypoints[wptid]['lon']
-
-                        # Calculate the lat/lon of the corners of the tile.
-                        (tile_N, tile_W) = num2deg(x, y, args.zoom_factor)
-                        (tile_S, tile_E) = num2deg(x+1, y+1, args.zoom_factor)
-
-                        # Calculate the x,y pixel within that tile.
-                        x_in_tile = int(256.0 * (wp_lon - tile_W) / (tile_E - tile_W))
-                        y_in_tile = int(256.0 * (wp_lat - tile_N) / (tile_S - tile_N))
-
-                        # Add the offsets from edge of bounding box.
-                        x_in_img = int(offset_x + x_in_tile)
-                        y_in_img = int(offset_y + y_in_tile)
-
-                        cmd += circle_parms + ' -draw "circle %d,%d %d,%d"' % (x_in_img, y_in_img, x_in_img+5, y_in_img)
-                        cmd += text_parms + ' -annotate +%d+%d "%s"' % (x_in_img+10, y_in_img+5, wptid)
+    wp_xy = projected_markers(args.zoom_factor)[0]
+    with profiler.span('waypoints_overlay'):
+        renderer.add_waypoints(window_markers(wp_xy, wp_markers[2], 256 * nw_tile[0], 256 * nw_tile[1],
+                image_width, image_height))
+
+    # Create overlay of points showing location of geo-coded jpg images,
+    # with nearby photos shown as one marker with a count.
+    if(photos is not None):
+        (photo_x, photo_y, photo_count) = projected_markers(args.zoom_factor)[1]
+        with profiler.span('photos_overlay'):
+            renderer.add_photos(window_markers((photo_x, photo_y), photo_count.tolist(), 256 * nw_tile[0],
+                    256 * nw_tile[1], image_width, image_height))
 
-    waypoints_overlay_filename = 'temp_waypoints_overlay.png'
-    overlay_files.append(waypoints_overlay_filename)
-    cmd += ' ' + waypoints_overlay_filename
-    subprocess.call(cmd, shell=True)
-
-    # Generate output file name.
-    (out_file_name, out_file_ext) = args.output_file.split('.')
-    if(args.tiles_per_frame is not None):
-        out_file_name += '-%dx%d' % (frm_x, frm_y)
-    out_file_name += '.%s' % out_file_ext
-
-    # Create composite map with overlay file(s) over base map.
-    # To save resources, applies overlays one at a time.
     print('INFO: Compositing map and layers into one ...')
-    os.rename(base_map_filename, out_file_name)
-    for overlay_filename in overlay_files:
-        print('INFO: Applying overlay "%s".' % overlay_filename)
-        cmd = 'convert -page +0+0 {}'.format(out_file_name)
-        cmd += ' -page +0+0 {}'.format(overlay_filename)
-        cmd += ' -layers flatten {}'.format(out_file_name)
-        subprocess.call(cmd, shell=True)
+    with profiler.span('flatten'):
+        renderer.flatten()
 
     # Add per-trace labels to bottom of composite image.
-    if(args.legend):
-        cc = 0
-        for gps_file in args.gps_file:
-            print('INFO: Appending legend to image for trace {}'.format(gps_file))
-            gt = garmin.garmin(gps_file)
-            start_time = gt.get_activity_start_datestamp()
-            elev_gain_ft = gt.calc_elev_gain() * 3.28084
-            # TODO: <prw>: Add more info to annot string.
-            annotation_str = '{} {} {}'.format(gps_file, start_time, elev_gain_ft) 
-            temp_output_file = 'foobarfiletmp' # TODO: Use temp file module.
-            # TODO: <prw>: Fix transparent bkgnd of annotation lines.
-            cmd = 'convert {} -gravity South -background "{}"'.format(args.output_file, trace_color(cc / num_traces))
-            cmd += ' -splice 0x18 -annotate +0+2 \'{}\' {}'.format(annotation_str, temp_output_file)
-            subprocess.call(cmd, shell=True)
-            os.rename(temp_output_file, args.output_file)
-            cc += 1
-
-    # Clean up overlay files.
-    for overlay_filename in overlay_files:
-        os.remove(overlay_filename)
+    if(args.legend and args.heatmap):
+        renderer.add_legend('{} traces, up to {} per pixel'.format(heat.num_traces, heat.max_count()),
+                'rgba(255,255,255,1)')
+    elif(args.legend):
+        for (i, trace) in enumerate(traces):
+            print('INFO: Appending legend to image for trace {}'.format(trace['gps_file']))
+            renderer.add_legend(trace['legend'], trace_color(i / len(traces)))
+
+    with profiler.span('save', cat='io'):
+        renderer.save()
 
     print('INFO: Completed file "{}" is ready.'.format(out_file_name))
 
+# Render one frame, (args, nw_tile, se_tile, frm_x, frm_y), in a worker.
+@profiler.profiled('render_frame')
+def render_frame(frame):
+    (args, nw_tile, se_tile, frm_x, frm_y) = frame
+    generate_map(args, nw_tile, se_tile, frm_x, frm_y)
+
 
 def main():
     args = parse_cmd_line()
+    if(args.profile is not None):
+        profiler.enable(args.profile)
+    # Pyramid tiles are drawn with Pillow whatever the renderer; say so
+    # before any trace is read.
+    if((args.pyramid is not None) and (map_render.Image is None)):
+        print('ERROR: Writing a tile pyramid (--pyramid) needs Pillow; install it with "pip install Pillow".')
+        return
     rc = read_rc_file()
+    t_cache = trace_cache.from_rc(rc)
     jpg_gps_ex = extract_exif_gps.extract_exif_gps()
     buf = 0
 
@@ -281,7 +446,7 @@ def main():
     if (not os.path.isdir(args.tile_cache)):
         os.mkdir(args.tile_cache)
 
-    # Get all waypoints and figure out which tile each will appear on.
+    # Get all waypoints and their positions on the map.
     if(args.waypoints_file):
         waypoints_file = args.waypoints_file
     else:
@@ -290,7 +455,34 @@ def main():
 
     w_mgr = waypoint_mgr.waypoint_mgr(waypoints_file)
     waypoints = w_mgr.read_waypoints()
-    tile2wp = w_mgr.get_tile_to_waypoint_map(args.zoom_factor)
+    wp_store = w_mgr.get_store()
+
+    # Parse every trace once; all frames, tiles and the legend use these.
+    # A heatmap reads the points again from the trace cache while
+    # accumulating, rather than holding those of every trace; without a
+    # cache that would parse every trace again for each frame.
+    keep_points = (not args.heatmap) or (args.pyramid is not None) or (t_cache is None)
+    with profiler.span('load_traces'):
+        trace_list = load_traces(args.gps_file, t_cache, points=keep_points)
+
+    # Read the positions of all photos at once.
+    photo_ll = None
+    if(args.images):
+        with profiler.span('photos_exif', cat='io'):
+            coords = jpg_gps_ex.get_coords_batch(args.images)
+        located = [c for c in coords if(c[0] is not None)]
+        print('INFO: {} of {} photos have a GPS position'.format(len(located), len(coords)))
+        photo_ll = (np.array([c[0] for c in located]), np.array([c[1] for c in located]))
+
+    init_worker(map_render.resolve_renderer(args.renderer), trace_list,
+            (wp_store.lats, wp_store.lons, wp_store.ids), photo_ll, t_cache)
+
+    if(args.pyramid is not None):
+        min_zoom = args.zoom_factor
+        if(args.min_zoom is not None):
+            min_zoom = args.min_zoom
+        generate_pyramid(args, waypoints_file, min_zoom, args.zoom_factor)
+        return
 
     # Compute bounding box.
     gps_lat_N = None
@@ -321,13 +513,12 @@ def main():
     else:
         # No waypoints given, so look at traces for map extent.
         files_by_start_tile = {}
-        for gps_file in args.gps_file:
-            print('INFO: Processing file {} ...'.format(gps_file))
-            gt = garmin.garmin(gps_file)
+        for trace in trace_list:
+            gps_file = trace['gps_file']
 
             # Get tile of starting coord.
-            try:
-                start_coord = gt.get_starting_coord()
+            start_coord = trace['start_coord']
+            if(start_coord is not None):
                 start_tile = deg2num(start_coord, args.zoom_factor)
                 start_tile_name = '{}-{}-{}.png'.format(args.zoom_factor, start_tile[0], start_tile[1])
                 print('INFO: start coord {} {} on tile {}'.format(start_coord[0], start_coord[1], start_tile_name))
@@ -336,11 +527,9 @@ def main():
                 if (start_tile_name not in files_by_start_tile):
                     files_by_start_tile[start_tile_name] = []
                 files_by_start_tile[start_tile_name].append(gps_file)
-            except IndexError:
-                pass
 
             # Scan through all coords to get bounding box of trace.
-            (bb_n, bb_w, bb_s, bb_e) = gt.get_bbox()
+            (bb_n, bb_w, bb_s, bb_e) = trace['bbox']
             if((gps_lat_N is None) or (bb_n > gps_lat_N)):
                 gps_lat_N = bb_n
             if((gps_lat_S is None) or (bb_s < gps_lat_S)):
@@ -351,8 +540,7 @@ def main():
                 gps_lon_E = bb_e
 
             # TODO: Get stats about run such as start time, elapsed time, distance, etc. for annotation.
-            start_time = gt.get_activity_start_datestamp()
-            print('INFO: start time = {}'.format(start_time))
+            print('INFO: start time = {}'.format(trace['start_time']))
 
         # Print list of files that start on same tiles.
         for tile_name in files_by_start_tile.keys():
@@ -375,6 +563,7 @@ def main():
     se_tile[0] += buf
     se_tile[1] += buf
 
+    frames = []
     if(args.tiles_per_frame is not None):
         # Expand map size to fit into whole number of frames (x and y).
         tiles_x = se_tile[0] - nw_tile[0] + 1
@@ -397,20 +586,50 @@ def main():
             se_tile[1] += int(r/2)
             if(r & 1):
                 se_tile[1] += 1
-        frm_nw_tile = [0, 0]
-        frm_se_tile = [0, 0]
         for frm_y in range(num_frames_y):
             for frm_x in range(num_frames_x):
                 print('DEBUG: frm_x, frm_y = %d, %d' % (frm_x, frm_y))
-                frm_nw_tile[0] = nw_tile[0] + frm_x * tiles_per_frame[0]
-                frm_nw_tile[1] = nw_tile[1] + frm_y * tiles_per_frame[1]
-                frm_se_tile[0] = nw_tile[0] + (frm_x + 1) * tiles_per_frame[0] - 1
-                frm_se_tile[1] = nw_tile[1] + (frm_y + 1) * tiles_per_frame[1] - 1
-                generate_map(rc, args, frm_nw_tile, frm_se_tile, frm_x, frm_y)
+                frm_nw_tile = [nw_tile[0] + frm_x * tiles_per_frame[0], nw_tile[1] + frm_y * tiles_per_frame[1]]
+                frm_se_tile = [nw_tile[0] + (frm_x + 1) * tiles_per_frame[0] - 1,
+                        nw_tile[1] + (frm_y + 1) * tiles_per_frame[1] - 1]
+                frames.append((args, frm_nw_tile, frm_se_tile, frm_x, frm_y))
+    else:
+        frames.append((args, nw_tile, se_tile, None, None))
+
+    # Sanity check number of tiles to be used.  If too many, assume it's an error.
+    tiles_xy = []
+    for (_, frm_nw_tile, frm_se_tile, _, _) in frames:
+        frm_tiles = window_tiles(frm_nw_tile, frm_se_tile)
+        if(len(frm_tiles) > 2500):
+            raise Exception ('ERROR: Too many tiles ({}) required (z={}).'.format(len(frm_tiles), args.zoom_factor))
+        tiles_xy += frm_tiles
+
+    # Download the tiles of all frames, if necessary.
+    mtm = map_tile_mgr.map_tile_mgr(args.tiles_url, args.tile_cache, rc['map_api_key'], args.ignore_cache,
+            max_workers=args.download_threads)
+    with profiler.span('get_tiles', cat='net'):
+        mtm.get_tiles(args.zoom_factor, tiles_xy)
+    print('INFO: {} tiles obtained'.format(len(tiles_xy)))
+
+    # With several frames, frames are rendered in parallel and each renders
+    # its layers serially; a single map renders its layers in parallel.
+    with profiler.span('project'):
+        if(args.heatmap):
+            projected_markers(args.zoom_factor)
+        else:
+            projected(args.zoom_factor)
+    if(len(frames) == 1):
+        generate_map(*frames[0], jobs=args.jobs)
+    elif(args.jobs > 1):
+        initargs = (renderer_name, traces, wp_markers, photos, t_cache)
+        with mp.Pool(min(args.jobs, len(frames)), initializer=init_worker, initargs=initargs) as pool:
+            pool.map(render_frame, frames)
     else:
-        generate_map(rc, args, nw_tile, se_tile)
+        for frame in frames:
+            render_frame(frame)
 
 if(__name__ == '__main__'):
     main()
+    profiler.report()
 
 # vi:set ts=4 et sw=4:
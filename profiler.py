@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import shutil
+import time
+import atexit
+import tempfile
+import threading
+import functools
+import contextlib
+
+# Spans and counters for finding out where the scripts spend their time.
+# Everything is a no-op until enable() is called (scripts do so for
+# --profile), so instrumented code costs one flag test when not profiling.
+#
+#   with profiler.span('parse', file=gps_file):
+#       ...
+#   profiler.count('points', n)
+#
+# Worker processes started after enable() (fork or spawn) profile too: they
+# find the spool directory in the environment and append their events to a
+# file there each time an outermost span ends, and report() merges them.
+
+env_var = 'GTRACE_PROFILE_DIR'
+
+enabled = False
+spool_dir = None
+main_pid = None
+trace_file = None
+
+# Events of this process not yet written out: complete spans as
+# (name, cat, t0, wall, cpu, tid, args) and counter totals by name.  Times
+# are perf_counter() seconds, which all processes of a run share.
+_pid = None
+_spans = []
+_counters = {}
+_lock = threading.Lock()
+_local = threading.local()
+
+def _reset():
+    global _pid, _spans, _counters
+    _pid = os.getpid()
+    _spans = []
+    _counters = {}
+
+# Start profiling this run.  report() will write the Chrome trace to
+# chrome_trace if it is given.
+def enable(chrome_trace=None):
+    global enabled, spool_dir, main_pid, trace_file
+    if(enabled):
+        return
+    trace_file = chrome_trace
+    spool_dir = tempfile.mkdtemp(prefix='gtrace-profile-')
+    os.environ[env_var] = spool_dir
+    main_pid = os.getpid()
+    _reset()
+    enabled = True
+    atexit.register(shutil.rmtree, spool_dir, True)
+
+# Workers started with spawn import this module afresh.
+def _enable_worker():
+    global enabled, spool_dir
+    spool_dir = os.environ[env_var]
+    _reset()
+    enabled = True
+    atexit.register(flush)
+
+if((env_var in os.environ) and os.path.isdir(os.environ[env_var])):
+    _enable_worker()
+
+# Forked workers start with a copy of the parent's events; drop them.
+def _own_events():
+    if(_pid != os.getpid()):
+        _reset()
+
+@contextlib.contextmanager
+def span(name, cat='stage', **args):
+    if(not enabled):
+        yield
+        return
+    # Nesting depth of spans in this thread; a forked worker starts over.
+    if(getattr(_local, 'pid', None) != os.getpid()):
+        _local.pid = os.getpid()
+        _local.depth = 0
+    depth = _local.depth
+    _local.depth = depth + 1
+    t0 = time.perf_counter()
+    c0 = time.thread_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - t0
+        cpu = time.thread_time() - c0
+        _local.depth = depth
+        with _lock:
+            _own_events()
+            _spans.append((name, cat, t0, wall, cpu, threading.get_ident(), args))
+        if((depth == 0) and (os.getpid() != main_pid)):
+            flush()
+
+# Decorator timing every call of a function as a span.  If arg_name is
+# given, the first argument is recorded under that name (e.g. the file a
+# worker was handed).
+def profiled(name, arg_name=None):
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if(not enabled):
+                return(fn(*args, **kwargs))
+            span_args = {arg_name: str(args[0])} if((arg_name is not None) and (len(args) > 0)) else {}
+            with span(name, **span_args):
+                return(fn(*args, **kwargs))
+        return(wrapper)
+    return(decorate)
+
+def count(name, n=1):
+    if(not enabled):
+        return
+    with _lock:
+        _own_events()
+        _counters[name] = _counters.get(name, 0) + n
+
+# Append this process's events to its file in the spool directory.
+def flush():
+    if((not enabled) or (spool_dir is None) or (not os.path.isdir(spool_dir))):
+        return
+    with _lock:
+        _own_events()
+        if((len(_spans) == 0) and (len(_counters) == 0)):
+            return
+        (spans, counters) = (_spans[:], dict(_counters))
+        del _spans[:]
+        _counters.clear()
+    with open(os.path.join(spool_dir, '{}.jsonl'.format(os.getpid())), 'a') as f_spool:
+        for s in spans:
+            f_spool.write(json.dumps({'span': s}) + '\n')
+        f_spool.write(json.dumps({'counters': counters}) + '\n')
+
+# All events of the run: spans as (pid, name, cat, t0, wall, cpu, tid,
+# args) and counter totals.
+def _collect():
+    spans = []
+    counters = {}
+    with _lock:
+        _own_events()
+        for s in _spans:
+            spans.append((_pid,) + tuple(s))
+        for (name, n) in _counters.items():
+            counters[name] = counters.get(name, 0) + n
+    for spool_file in sorted(os.listdir(spool_dir)):
+        pid = int(spool_file.split('.')[0])
+        with open(os.path.join(spool_dir, spool_file), 'r') as f_spool:
+            for l in f_spool:
+                rec = json.loads(l)
+                if('span' in rec):
+                    spans.append((pid,) + tuple(rec['span']))
+                else:
+                    for (name, n) in rec['counters'].items():
+                        counters[name] = counters.get(name, 0) + n
+    return(spans, counters)
+
+def _summary(spans, counters, f_out):
+    stats = {}
+    for (pid, name, cat, t0, wall, cpu, tid, args) in spans:
+        st = stats.setdefault(name, [0, 0.0, 0.0, 0.0])
+        st[0] += 1
+        st[1] += wall
+        st[2] += cpu
+        st[3] = max(st[3], wall)
+    width = max([len(name) for name in list(stats.keys()) + list(counters.keys())] + [5])
+    print('INFO: Profile (wall and CPU time are summed over all processes and threads)', file=f_out)
+    print('  {:{w}s} {:>8s} {:>10s} {:>10s} {:>10s} {:>10s}'.format('stage', 'calls', 'wall s', 'cpu s',
+            'mean ms', 'max ms', w=width), file=f_out)
+    for name in sorted(stats.keys(), key=lambda k: -stats[k][1]):
+        (calls, wall, cpu, wall_max) = stats[name]
+        print('  {:{w}s} {:8d} {:10.3f} {:10.3f} {:10.2f} {:10.2f}'.format(name, calls, wall, cpu,
+                1000.0 * wall / calls, 1000.0 * wall_max, w=width), file=f_out)
+    if(len(counters) > 0):
+        print('  {:{w}s} {:>8s}'.format('counter', 'total', w=width), file=f_out)
+        for name in sorted(counters.keys()):
+            print('  {:{w}s} {:8d}'.format(name, counters[name], w=width), file=f_out)
+
+# Chrome trace-event format, for chrome://tracing or ui.perfetto.dev.
+def _write_trace(spans, counters, out_file):
+    origin = min([s[3] for s in spans]) if(len(spans) > 0) else 0.0
+    events = []
+    for (pid, name, cat, t0, wall, cpu, tid, args) in spans:
+        a = dict(args)
+        a['cpu_ms'] = round(1000.0 * cpu, 3)
+        events.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+                'ts': round(1e6 * (t0 - origin), 3), 'dur': round(1e6 * wall, 3), 'args': a})
+    end = max([s[3] + s[4] for s in spans]) if(len(spans) > 0) else 0.0
+    for (name, n) in sorted(counters.items()):
+        events.append({'name': name, 'ph': 'C', 'pid': main_pid, 'tid': 0,
+                'ts': round(1e6 * (end - origin), 3), 'args': {'total': n}})
+    with open(out_file, 'w') as f_trace:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f_trace)
+
+# Print the summary table and write the Chrome trace, if one was asked
+# for.  Called once by the main process at the end of the run.
+def report(f_out=sys.stderr):
+    global enabled
+    if((not enabled) or (os.getpid() != main_pid)):
+        return
+    (spans, counters) = _collect()
+    _summary(spans, counters, f_out)
+    if(trace_file):
+        _write_trace(spans, counters, trace_file)
+        print('INFO: Profile trace written to {}'.format(trace_file), file=f_out)
+    enabled = False
+    del os.environ[env_var]
+    shutil.rmtree(spool_dir, True)
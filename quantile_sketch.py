@@ -0,0 +1,151 @@
+import bisect
+import math
+
+# Mergeable quantile sketch of non-negative values that also supports
+# removing values.  Up to exact_max values are kept as they are, so small
+# samples give exact quantiles; beyond that values are counted in
+# logarithmic buckets (as in DDSketch), which answers any quantile to
+# within rel_accuracy of the true value in constant space.  Values below
+# min_value (zero, or a negative time from a clock jump) are counted as 0;
+# NaN and infinite values are ignored.
+
+exact_max = 64
+rel_accuracy = 0.01
+min_value = 1e-9
+
+_gamma = (1.0 + rel_accuracy) / (1.0 - rel_accuracy)
+_log_gamma = math.log(_gamma)
+
+def _bucket(x):
+    if(x < min_value):
+        return(None)
+    return(int(math.ceil(math.log(x) / _log_gamma)))
+
+# Value standing for all the values in bucket i.
+def _bucket_value(i):
+    if(i is None):
+        return(0.0)
+    return(2.0 * _gamma ** i / (_gamma + 1.0))
+
+class quantile_sketch(object):
+
+    def __init__(self):
+        self.values = []
+        self.buckets = None
+        self.count = 0
+
+    def _to_buckets(self):
+        self.buckets = {}
+        for x in self.values:
+            i = _bucket(x)
+            self.buckets[i] = self.buckets.get(i, 0) + 1
+        self.values = None
+
+    def add(self, x):
+        x = float(x)
+        if(not math.isfinite(x)):
+            return
+        self.count += 1
+        if(self.buckets is None):
+            bisect.insort(self.values, x)
+            if(len(self.values) > exact_max):
+                self._to_buckets()
+        else:
+            i = _bucket(x)
+            self.buckets[i] = self.buckets.get(i, 0) + 1
+
+    # Remove one value that was added before.
+    def remove(self, x):
+        x = float(x)
+        if(not math.isfinite(x)):
+            return
+        if(self.buckets is None):
+            k = bisect.bisect_left(self.values, x)
+            if((k == len(self.values)) or (self.values[k] != x)):
+                raise ValueError('{} not in sketch'.format(x))
+            del self.values[k]
+        else:
+            i = _bucket(x)
+            if(i not in self.buckets):
+                raise ValueError('{} not in sketch'.format(x))
+            self.buckets[i] -= 1
+            if(self.buckets[i] == 0):
+                del self.buckets[i]
+        self.count -= 1
+
+    def merge(self, other):
+        if((self.buckets is None) and (other.buckets is None) and (self.count + other.count <= exact_max)):
+            for x in other.values:
+                bisect.insort(self.values, x)
+        else:
+            if(self.buckets is None):
+                self._to_buckets()
+            if(other.buckets is None):
+                for x in other.values:
+                    i = _bucket(x)
+                    self.buckets[i] = self.buckets.get(i, 0) + 1
+            else:
+                for (i, n) in other.buckets.items():
+                    self.buckets[i] = self.buckets.get(i, 0) + n
+        self.count += other.count
+
+    # (value, count) of the sorted buckets, or of the values themselves.
+    def _items(self):
+        if(self.buckets is None):
+            return([(x, 1) for x in self.values])
+        keys = sorted(self.buckets.keys(), key=lambda i: -math.inf if(i is None) else i)
+        return([(_bucket_value(i), self.buckets[i]) for i in keys])
+
+    # The value of rank k (0 based) in sorted order.
+    def _at_rank(self, k):
+        if(self.buckets is None):
+            return(self.values[k])
+        seen = 0
+        for (x, n) in self._items():
+            seen += n
+            if(k < seen):
+                return(x)
+        return(x)
+
+    # The q-th quantile (0 <= q <= 1), interpolated like numpy.percentile;
+    # NaN if empty.
+    def quantile(self, q):
+        if(self.count == 0):
+            return(math.nan)
+        pos = (self.count - 1) * q
+        lo = int(math.floor(pos))
+        a = self._at_rank(lo)
+        b = self._at_rank(min(lo + 1, self.count - 1))
+        return(a + (pos - lo) * (b - a))
+
+    # Lower median, a value of the sample itself when exact.
+    def median_low(self):
+        if(self.count == 0):
+            return(math.nan)
+        return(self._at_rank((self.count - 1) // 2))
+
+    # Mean and number of the values in [lo, hi].
+    def mean_between(self, lo, hi):
+        total = 0.0
+        num = 0
+        for (x, n) in self._items():
+            if(lo <= x <= hi):
+                total += x * n
+                num += n
+        return((total / num if(num > 0) else math.nan), num)
+
+    def to_json(self):
+        if(self.buckets is None):
+            return({'values': self.values})
+        return({'buckets': [[i, n] for (i, n) in self.buckets.items()]})
+
+def from_json(d):
+    sketch = quantile_sketch()
+    if('values' in d):
+        sketch.values = sorted([float(x) for x in d['values']])
+        sketch.count = len(sketch.values)
+    else:
+        sketch.values = None
+        sketch.buckets = {i: n for (i, n) in d['buckets']}
+        sketch.count = sum(sketch.buckets.values())
+    return(sketch)
@@ -0,0 +1,228 @@
+import os
+import hashlib
+import tempfile
+import numpy as np
+import path_store
+
+# Statistics of the paths (segments between two waypoints) in a path store,
+# either computed for all segments at once from columnar arrays of the rows,
+# or read from the summaries the store keeps per segment.  The result is a
+# table: a dict of arrays with one entry per segment, in the order the
+# segments first appear in the store.
+#
+#   path_id                    segment 'wA:wB'
+#   count                      number of traversals
+#   {dist_m,time_s}_mean       mean
+#   {dist_m,time_s}_median     lower median (an actual traversal)
+#   {dist_m,time_s}_std        sample standard deviation (0 for one)
+#   {dist_m,time_s}_min/_max
+#   {dist_m,time_s}_pNN        percentiles, linearly interpolated
+#   pace_s_per_m               mean pace of the traversals whose pace isn't
+#   pace_count                 an outlier, and their number
+#
+# Outliers (a stop for coffee, a GPS glitch) are paces outside Tukey's
+# fences, more than outlier_iqr times the interquartile range from the
+# quartiles of the segment's paces.
+#
+# From the summaries, medians, percentiles and pace are exact for segments
+# of up to quantile_sketch.exact_max traversals and within
+# quantile_sketch.rel_accuracy beyond that.
+
+# Bump when the set or meaning of the statistics changes.
+cache_version = 3
+
+default_cache_dir = '{}/.cache/gtrace/segments'.format(os.environ['HOME'])
+
+percentiles = (10, 25, 75, 90)
+outlier_iqr = 1.5
+
+# Returns the directory for cached statistics from the resource file, or
+# None when caching has been disabled with an empty 'segment_cache' entry.
+def cache_dir_from_rc(rc):
+    cache_dir = rc.get('segment_cache', default_cache_dir)
+    if(not cache_dir):
+        return(None)
+    return(cache_dir)
+
+# Columns of path rows (gps_file, activity_datestamp, path_id, dist_m,
+# time_s), as yielded by path_store.iter_paths().  Rows without a usable
+# distance and time are left out, as they are from the store's summaries.
+def columns(rows):
+    rows = [row for row in rows if(path_store.usable(row[3], row[4]))]
+    if(len(rows) == 0):
+        return({'gps_file': np.array([], dtype=str), 'path_id': np.array([], dtype=str),
+                'dist_m': np.zeros(0), 'time_s': np.zeros(0)})
+    (gps_file, date, path_id, dist_m, time_s) = zip(*rows)
+    return({'gps_file': np.array(gps_file, dtype=str), 'path_id': np.array(path_id, dtype=str),
+            'dist_m': np.array(dist_m, dtype=np.float64), 'time_s': np.array(time_s, dtype=np.float64)})
+
+# Group number of each row, with groups numbered in order of first
+# appearance, and the key of each group.
+def _group(keys):
+    (uniq, first, inverse) = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first)
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return(rank[inverse.reshape(-1)], uniq[order])
+
+# Order statistics of values per group: (count, values sorted within their
+# group, start of each group in that order).
+def _sorted_groups(g, values, num_groups):
+    n = np.bincount(g, minlength=num_groups)
+    v = values[np.lexsort((values, g))]
+    start = np.cumsum(n) - n
+    return(n, v, start)
+
+# The q-th percentile of each group, interpolated like numpy.percentile;
+# NaN for empty groups.
+def _percentile(n, v, start, q):
+    if(len(v) == 0):
+        return(np.full(len(n), np.nan))
+    has = n > 0
+    pos = np.where(has, (n - 1) * (q / 100.0), 0.0)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, np.maximum(n - 1, 0))
+    a = v[np.where(has, start + lo, 0)]
+    b = v[np.where(has, start + hi, 0)]
+    return(np.where(has, a + (pos - lo) * (b - a), np.nan))
+
+def _column_stats(g, values, num_groups, name, table):
+    (n, v, start) = _sorted_groups(g, values, num_groups)
+    mean = np.bincount(g, weights=values, minlength=num_groups) / n
+    dev = values - mean[g]
+    table[name + '_mean'] = mean
+    table[name + '_median'] = v[start + (n - 1) // 2]
+    table[name + '_std'] = np.sqrt(np.bincount(g, weights=dev * dev, minlength=num_groups) / np.maximum(n - 1, 1))
+    table[name + '_min'] = v[start]
+    table[name + '_max'] = v[start + n - 1]
+    for q in percentiles:
+        table['{}_p{:02d}'.format(name, q)] = _percentile(n, v, start, q)
+
+# Pace of each segment without its outliers.
+def _pace_stats(g, dist_m, time_s, num_groups, table):
+    valid = dist_m > 0
+    pace = np.full(len(g), np.nan)
+    pace[valid] = time_s[valid] / dist_m[valid]
+    (n, v, start) = _sorted_groups(g[valid], pace[valid], num_groups)
+    q1 = _percentile(n, v, start, 25)
+    q3 = _percentile(n, v, start, 75)
+    fence = outlier_iqr * (q3 - q1)
+    keep = valid & (pace >= (q1 - fence)[g]) & (pace <= (q3 + fence)[g])
+    kept = np.bincount(g[keep], minlength=num_groups)
+    table['pace_count'] = kept
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table['pace_s_per_m'] = np.bincount(g[keep], weights=pace[keep], minlength=num_groups) / kept
+
+# Names of the columns of a table other than path_id and count.
+def _stat_names():
+    names = ['pace_s_per_m', 'pace_count']
+    for name in ('dist_m', 'time_s'):
+        names += [name + s for s in ('_mean', '_median', '_std', '_min', '_max')]
+        names += ['{}_p{:02d}'.format(name, q) for q in percentiles]
+    return(names)
+
+# Table of no segments, with all its columns.
+def _empty_table():
+    table = {'path_id': np.array([], dtype=str), 'count': np.zeros(0, dtype=np.int64)}
+    for name in _stat_names():
+        table[name] = np.zeros(0, dtype=np.int64 if(name == 'pace_count') else np.float64)
+    return(table)
+
+# Statistics table (see above) of the given columns.
+def compute(cols):
+    (g, path_ids) = _group(cols['path_id'])
+    num_groups = len(path_ids)
+    if(num_groups == 0):
+        return(_empty_table())
+    table = {'path_id': path_ids, 'count': np.bincount(g, minlength=num_groups)}
+    _column_stats(g, cols['dist_m'], num_groups, 'dist_m', table)
+    _column_stats(g, cols['time_s'], num_groups, 'time_s', table)
+    _pace_stats(g, cols['dist_m'], cols['time_s'], num_groups, table)
+    return(table)
+
+# Statistics of one column from the summaries, whose attributes for it start
+# with prefix.
+def _summary_column_stats(summaries, prefix, name, table):
+    n = np.array([s.count for s in summaries], dtype=np.float64)
+    total = np.array([getattr(s, prefix + '_sum') for s in summaries], dtype=np.float64)
+    sumsq = np.array([getattr(s, prefix + '_sumsq') for s in summaries], dtype=np.float64)
+    sketches = [getattr(s, prefix + '_sketch') for s in summaries]
+    mean = total / n
+    table[name + '_mean'] = mean
+    table[name + '_median'] = np.array([sk.median_low() for sk in sketches])
+    table[name + '_std'] = np.where(n > 1, np.sqrt(np.maximum(sumsq - total * mean, 0.0) / np.maximum(n - 1, 1)), 0.0)
+    table[name + '_min'] = np.array([getattr(s, prefix + '_min') for s in summaries], dtype=np.float64)
+    table[name + '_max'] = np.array([getattr(s, prefix + '_max') for s in summaries], dtype=np.float64)
+    for q in percentiles:
+        table['{}_p{:02d}'.format(name, q)] = np.array([sk.quantile(q / 100.0) for sk in sketches])
+
+def _summary_pace_stats(summaries, table):
+    pace = []
+    kept = []
+    for s in summaries:
+        q1 = s.pace_sketch.quantile(0.25)
+        q3 = s.pace_sketch.quantile(0.75)
+        fence = outlier_iqr * (q3 - q1)
+        (mean, num) = s.pace_sketch.mean_between(q1 - fence, q3 + fence)
+        pace.append(mean)
+        kept.append(num)
+    table['pace_s_per_m'] = np.array(pace, dtype=np.float64)
+    table['pace_count'] = np.array(kept, dtype=np.int64)
+
+# Statistics table (see above) of path_store.segment_summary objects, in
+# time proportional to the number of segments.
+def from_summaries(summaries):
+    summaries = list(summaries)
+    if(len(summaries) == 0):
+        return(_empty_table())
+    table = {'path_id': np.array([s.path_id for s in summaries], dtype=str),
+            'count': np.array([s.count for s in summaries], dtype=np.int64)}
+    _summary_column_stats(summaries, 'dist', 'dist_m', table)
+    _summary_column_stats(summaries, 'time', 'time_s', table)
+    _summary_pace_stats(summaries, table)
+    return(table)
+
+# Row of each path_id in a table.
+def index(table):
+    return({path_id: i for (i, path_id) in enumerate(table['path_id'].tolist())})
+
+def _cache_key(store_file):
+    st = os.stat(store_file)
+    key = [cache_version, percentiles, outlier_iqr, st.st_size, st.st_mtime_ns]
+    return(hashlib.sha1(repr(key).encode('utf-8')).hexdigest())
+
+# Statistics table of the paths in store_file.  An SQLite store keeps the
+# summaries of its segments up to date itself, so the table comes from
+# those.  A .csv store is loaded in full anyway, so its table is computed
+# exactly from the paths, and cached in cache_dir, one file per store, and
+# recomputed when the file changes.
+def load(store_file, cache_dir=default_cache_dir):
+    cache_file = None
+    if((cache_dir is not None) and store_file.lower().endswith('.csv') and os.path.isfile(store_file)):
+        name = hashlib.sha1(os.path.abspath(store_file).encode('utf-8')).hexdigest()
+        cache_file = os.path.join(cache_dir, name + '.npz')
+        key = _cache_key(store_file)
+        try:
+            with np.load(cache_file) as cached:
+                if(str(cached['key']) == key):
+                    return({name: cached[name] for name in cached.files if(name != 'key')})
+        except (OSError, ValueError, KeyError):
+            pass
+
+    store = path_store.open_store(store_file, read_only=True)
+    if(store_file.lower().endswith('.csv')):
+        table = compute(columns(store.iter_paths()))
+    else:
+        table = from_summaries(store.iter_segments())
+    store.close()
+
+    if(cache_file is not None):
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            (fd, tmp_path) = tempfile.mkstemp(dir=cache_dir, prefix='.tmp-', suffix='.npz')
+            with os.fdopen(fd, 'wb') as f_npz:
+                np.savez(f_npz, key=np.array(key), **table)
+            os.replace(tmp_path, cache_file)
+        except OSError:
+            pass
+    return(table)
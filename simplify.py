@@ -0,0 +1,75 @@
+import numpy as np
+from map_tile_mgr import deg2pixel
+
+# Douglas-Peucker simplification of traces for display at any zoom.  Each
+# point is ranked by its significance: the largest tolerance at which
+# Douglas-Peucker still keeps it, measured in zoom 0 pixels (the whole
+# world is 256 pixels wide).  Simplifying for a zoom is then one compare
+# against that zoom's tolerance, so ranks are computed once per trace and
+# can be kept in the trace cache.
+
+# Largest distance, in pixels, the simplified line may stray from the
+# original.
+default_tol_px = 0.5
+
+# Name of the ranks in the trace cache.
+cache_name = 'dp_significance'
+
+# Distances of points i+1 .. j-1 from the segment from point i to point j.
+def _seg_dist(x, y, i, j):
+    px = x[i+1:j] - x[i]
+    py = y[i+1:j] - y[i]
+    (dx, dy) = (x[j] - x[i], y[j] - y[i])
+    len2 = dx * dx + dy * dy
+    if(len2 == 0.0):
+        return(np.hypot(px, py))
+    t = np.clip((px * dx + py * dy) / len2, 0.0, 1.0)
+    return(np.hypot(px - t * dx, py - t * dy))
+
+# Significance of each point of the polyline (x, y).  The end points are
+# always kept (inf).  A point is never ranked above the point that split
+# its range, so the points kept at any tolerance are exactly what
+# Douglas-Peucker keeps at that tolerance.
+def significance(x, y):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    n = len(x)
+    sig = np.zeros(n)
+    if(n == 0):
+        return(sig)
+    sig[0] = np.inf
+    sig[-1] = np.inf
+    stack = [(0, n - 1, np.inf)]
+    while(len(stack) > 0):
+        (i, j, parent) = stack.pop()
+        if(j - i < 2):
+            continue
+        d = _seg_dist(x, y, i, j)
+        k = int(np.argmax(d))
+        s = min(float(d[k]), parent)
+        sig[i+1+k] = s
+        stack.append((i, i+1+k, s))
+        stack.append((i+1+k, j, s))
+    return(sig)
+
+# Significance of each positioned point of a garmin trace, taken from (and
+# saved to) the trace cache if one is given.
+def trace_significance(gt, cache=None):
+    sig = None
+    if(cache is not None):
+        sig = cache.load_derived(gt.trace_file, cache_name)
+    if(sig is None):
+        pos = gt.has_position()
+        (x, y) = deg2pixel(gt.lat[pos], gt.lon[pos], 0)
+        sig = significance(x, y)
+        if(cache is not None):
+            cache.store_derived(gt.trace_file, cache_name, sig)
+    return(sig)
+
+# Tolerance, in zoom 0 pixels, for drawing at zoom.
+def tolerance(zoom, tol_px=default_tol_px):
+    return(tol_px / 2.0 ** zoom)
+
+# Indices of the points to draw at zoom.
+def select(sig, zoom, tol_px=default_tol_px):
+    return(np.flatnonzero(sig >= tolerance(zoom, tol_px)))
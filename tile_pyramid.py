@@ -0,0 +1,162 @@
+import os
+import json
+import hashlib
+import sqlite3
+import tempfile
+import numpy as np
+
+# Output of overlay tiles as a slippy-map pyramid, either z/x/y.png files
+# under a directory or an MBTiles (SQLite) file.  Tiles are addressed like
+# map_tile_mgr.deg2num().  Each tile is stored with a signature of the
+# inputs it was rendered from, so reruns only render tiles that changed.
+
+tile_size = 256
+
+# Tiles (x, y) that the polyline (x, y), in global pixels, passes within
+# pad pixels of.  Segments are sampled at most pad pixels apart so that
+# long segments don't skip the tiles they cross.
+def touched_tiles(x, y, pad):
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    if(len(x) < 2):
+        return(set())
+    step = np.hypot(np.diff(x), np.diff(y))
+    n = np.maximum(1, np.ceil(step / max(pad, 1))).astype(np.int64)
+    seg = np.repeat(np.arange(len(step)), n)
+    t = (np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)) / np.repeat(n, n)
+    xs = np.append(x[seg] + t * (x[seg+1] - x[seg]), x[-1])
+    ys = np.append(y[seg] + t * (y[seg+1] - y[seg]), y[-1])
+    keys = []
+    for dx in (-pad, 0, pad):
+        for dy in (-pad, 0, pad):
+            tx = np.floor((xs + dx) / tile_size).astype(np.int64)
+            ty = np.floor((ys + dy) / tile_size).astype(np.int64)
+            keys.append(np.stack((tx, ty), axis=1))
+    return(set(map(tuple, np.unique(np.concatenate(keys), axis=0).tolist())))
+
+# Signature of the inputs of one tile, any repr()-able value.
+def signature(inputs):
+    return(hashlib.blake2b(repr(inputs).encode('utf-8'), digest_size=16).hexdigest())
+
+# Tiles as z/x/y.png under out_dir; signatures are kept in
+# out_dir/signatures.json, which is rewritten by close().
+class dir_writer(object):
+
+    def __init__(self, out_dir):
+        self.out_dir = out_dir
+        self.sig_file = os.path.join(out_dir, 'signatures.json')
+        os.makedirs(out_dir, exist_ok=True)
+        self.signatures = {}
+        if(os.path.isfile(self.sig_file)):
+            with open(self.sig_file, 'r') as f_sig:
+                self.signatures = json.load(f_sig)
+
+    def _path(self, zoom, x, y):
+        return(os.path.join(self.out_dir, str(zoom), str(x), '{}.png'.format(y)))
+
+    def set_metadata(self, metadata):
+        pass
+
+    def get_signature(self, zoom, x, y):
+        if(not os.path.isfile(self._path(zoom, x, y))):
+            return(None)
+        return(self.signatures.get('{}/{}/{}'.format(zoom, x, y)))
+
+    # All (x, y) tiles stored at zoom.
+    def tiles(self, zoom):
+        tiles = []
+        prefix = '{}/'.format(zoom)
+        for key in self.signatures.keys():
+            if(key.startswith(prefix)):
+                (x, y) = key[len(prefix):].split('/')
+                tiles.append((int(x), int(y)))
+        return(tiles)
+
+    def write(self, zoom, x, y, data, sig):
+        tile_file = self._path(zoom, x, y)
+        os.makedirs(os.path.dirname(tile_file), exist_ok=True)
+        (fd, tmp_path) = tempfile.mkstemp(dir=os.path.dirname(tile_file), suffix='.part')
+        with os.fdopen(fd, 'wb') as f_img:
+            f_img.write(data)
+        os.replace(tmp_path, tile_file)
+        self.signatures['{}/{}/{}'.format(zoom, x, y)] = sig
+
+    def remove(self, zoom, x, y):
+        tile_file = self._path(zoom, x, y)
+        if(os.path.isfile(tile_file)):
+            os.remove(tile_file)
+        self.signatures.pop('{}/{}/{}'.format(zoom, x, y), None)
+
+    def close(self):
+        tmp_file = self.sig_file + '.tmp'
+        with open(tmp_file, 'w') as f_sig:
+            json.dump(self.signatures, f_sig)
+        os.replace(tmp_file, self.sig_file)
+
+mbtiles_schema = '''
+CREATE TABLE IF NOT EXISTS metadata (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS tiles (
+    zoom_level INTEGER,
+    tile_column INTEGER,
+    tile_row INTEGER,
+    tile_data BLOB,
+    signature TEXT
+);
+CREATE UNIQUE INDEX IF NOT EXISTS tiles_index ON tiles (zoom_level, tile_column, tile_row);
+'''
+
+# Tiles in an MBTiles file.  MBTiles rows count from the south (TMS), so
+# y is flipped on the way in and out.  Writes are committed in batches.
+class mbtiles_writer(object):
+
+    def __init__(self, db_file, batch=256):
+        self.conn = sqlite3.connect(db_file)
+        self.conn.executescript(mbtiles_schema)
+        self.batch = batch
+        self.pending = 0
+
+    def _row(self, zoom, y):
+        return((1 << zoom) - 1 - y)
+
+    def set_metadata(self, metadata):
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO metadata VALUES (?, ?)',
+                    [(k, str(v)) for (k, v) in metadata.items()])
+
+    def get_signature(self, zoom, x, y):
+        cur = self.conn.execute('SELECT signature FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                (zoom, x, self._row(zoom, y)))
+        row = cur.fetchone()
+        if(row is None):
+            return(None)
+        return(row[0])
+
+    def tiles(self, zoom):
+        cur = self.conn.execute('SELECT tile_column, tile_row FROM tiles WHERE zoom_level = ?', (zoom,))
+        return([(x, self._row(zoom, row)) for (x, row) in cur.fetchall()])
+
+    def _written(self):
+        self.pending += 1
+        if(self.pending >= self.batch):
+            self.conn.commit()
+            self.pending = 0
+
+    def write(self, zoom, x, y, data, sig):
+        self.conn.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?)',
+                (zoom, x, self._row(zoom, y), sqlite3.Binary(data), sig))
+        self._written()
+
+    def remove(self, zoom, x, y):
+        self.conn.execute('DELETE FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?',
+                (zoom, x, self._row(zoom, y)))
+        self._written()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+# Open the pyramid in out: an '.mbtiles' file, or else a directory.
+def open_writer(out):
+    if(out.lower().endswith('.mbtiles')):
+        return(mbtiles_writer(out))
+    return(dir_writer(out))
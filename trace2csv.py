@@ -2,16 +2,16 @@
 
 # TODO:
 # Do statistical analysis on segments.
-# Add progress meter.
-# See if parallel processing would be faster.
-# See if storing results in splite3 would be better.
 
 import os
 import argparse
-import dateutil.parser as DP
+import multiprocessing as mp
+import numpy as np
 import garmin
+import path_store
+import profiler
+import trace_cache
 import waypoint_mgr
-from garmin import ns
 
 rc_file = '{}/.trace.rc'.format(os.environ['HOME'])
 
@@ -31,14 +31,18 @@ def parse_cmd_line():
     ap.add_argument('-f', '--gps-files', help='Name of Garmin .tcx file', required=True, nargs='+')
     ap.add_argument('-w', '--waypoints-file', help='Name of waypoint .xml file')
     ap.add_argument('-i', '--waypoints-of-intr', help='Waypoint(s) of interest', nargs='*', default=[])
-    ap.add_argument('-p', '--path-csv-file', help='Name of path csv file')
+    ap.add_argument('-p', '--path-csv-file', help='Name of path store (.csv file or SQLite database)')
+    ap.add_argument('--import-csv', help='Import paths from a .csv file into the path store')
+    ap.add_argument('--export-csv', help='Export the path store to a .csv file')
     ap.add_argument('-j', '--ignore-stored', help='Ignore previously stored data', action='store_true')
+    ap.add_argument('-r', '--visit-radius', help='Distance (m) from a waypoint that counts as a visit',
+            type=float, default=waypoint_mgr.visit_radius_m)
+    ap.add_argument('-n', '--jobs', help='Number of trace files to process in parallel', type=int, default=1)
+    ap.add_argument('--profile', help='Print time spent per stage; also write a Chrome trace to TRACE_JSON if given',
+            nargs='?', const='', metavar='TRACE_JSON')
     args = ap.parse_args()
     return(args)
 
-def iso2epoch(t_iso):
-    return(int(DP.parse(t_iso).strftime('%s')))
-
 def m2mi(d):
     return(d / 1609.0)
 
@@ -47,95 +51,61 @@ def s2minsec(t):
     sec = int(t - 60.0 * min)
     return('{}:{:02d}'.format(min, sec))
 
-if(__name__ == '__main__'):
-    args = parse_cmd_line()
-
-    rc = read_rc_file()
-
-    if(args.waypoints_file):
-        waypoints_file = args.waypoints_file
-    else:
-        if('waypoints_file' in rc.keys()):
-            waypoints_file = rc['waypoints_file']
+# Per-process state used by find_paths(), set up by init_worker().
+w_mgr = None
+wp_index = None
+t_cache = None
+visit_radius = None
+waypoints_of_intr = None
 
+def init_worker(waypoints_file, rc, radius, woi):
+    global w_mgr, wp_index, t_cache, visit_radius, waypoints_of_intr
     w_mgr = waypoint_mgr.waypoint_mgr(waypoints_file)
-
-    gps_file_in_store = []
-    path = {}
-    if(args.path_csv_file):
-        path_csv_file = args.path_csv_file
-    else:
-        if('path_csv_file' in rc.keys()):
-            path_csv_file = rc['path_csv_file']
-    if(os.path.isfile(path_csv_file)):
-        with open(path_csv_file, 'r') as f_csv:
-            for line in f_csv:
-                (gps_file, activity_datestamp, path_id, dist_m, time_s) = line.strip().split(',')
-                if((gps_file in args.gps_files) and args.ignore_stored):
-                    continue
-                (path_start, path_end) = path_id.split(':')
-
-                if(path_start not in path.keys()):
-                    path[path_start] = {}
-                if(path_end not in path[path_start].keys()):
-                    path[path_start][path_end] = []
-                path[path_start][path_end].append({'gps_file': gps_file,
-                        'activity_datestamp': activity_datestamp, 'dist_m': dist_m, 'time_s': time_s})
-
-                if(gps_file not in gps_file_in_store):
-                    gps_file_in_store.append(gps_file)
-
-    for gps_file in args.gps_files:
-        if((gps_file in gps_file_in_store) and not args.ignore_stored):
-            print('Skipping %s because already in stored results.' % gps_file)
-            continue
-
-        print('INFO: Working on %s ...' % gps_file)
-
-        try:
-            gt = garmin.garmin(gps_file)
-        except KeyError:
-            continue
+    wp_index = w_mgr.build_index()
+    t_cache = trace_cache.from_rc(rc)
+    visit_radius = radius
+    waypoints_of_intr = woi
+
+# Parse one trace file and find the paths between the waypoints it visits.
+# Returns a dict describing the outcome; any error is caught and returned
+# so that one bad file doesn't stop the run.
+@profiler.profiled('find_paths', 'file')
+def find_paths(gps_file):
+    result = {'gps_file': gps_file, 'error': None, 'num_waypoints': 0,
+            'num_trackpoints': None, 'activity_datestamp': None, 'paths': []}
+    try:
+        gt = garmin.garmin(gps_file, cache=t_cache)
 
         waypoints = w_mgr.read_waypoints(gt.get_bbox())
-        print('DEBUG: num waypoints = {}'.format(len(waypoints)))
+        result['num_waypoints'] = len(waypoints)
         if(len(waypoints) == 0):
-            continue
+            return(result)
 
         # Check for desired waypoints to exist in the current trace file.
-        if(len(args.waypoints_of_intr) > 0):
+        if(len(waypoints_of_intr) > 0):
             intr_wp_seen = False
-            for woi in args.waypoints_of_intr:
+            for woi in waypoints_of_intr:
                 if(woi in waypoints):
                     intr_wp_seen = True
                     break
             if(not intr_wp_seen):
-                continue
-
-        num_trackpoints = gt.get_trackpoint_count()
-        print('DEBUG: {} track points'.format(num_trackpoints))
+                return(result)
 
-        activity_datestamp = gt.get_activity_start_datestamp()
-        print('DEBUG: Activity date = %s' % activity_datestamp)
+        result['num_trackpoints'] = gt.get_trackpoint_count()
+        result['activity_datestamp'] = gt.get_activity_start_datestamp()
 
         # Go through all track points and check for proximity to points in the waypoint database.
-        wp_visited = {}
-        for tp in gt.iter_position():
-            time = iso2epoch(tp.findall('.//garmin:Time', ns)[0].text)
-            try:
-                lat = float(tp.findall('.//garmin:LatitudeDegrees', ns)[0].text)
-                lon = float(tp.findall('.//garmin:LongitudeDegrees', ns)[0].text)
-            except IndexError:
-                continue
-            dist = float(tp.findall('.//garmin:DistanceMeters', ns)[0].text)
-            for k in waypoints.keys():
-                wp_lat = waypoints[k]['lat']
-                wp_lon = waypoints[k]['lon']
-                wp_id = k
-                wp_name = waypoints[k]['name']
-                sep_m = gt.calc_dist_m([lat, lon], [wp_lat, wp_lon])
-                if(sep_m < 20.0):
-                    wp_visited[dist] = {'id': wp_id, 'name': wp_name, 'time': time}
+        # Points without DistanceMeters (NaN) can't be ordered or measured between.
+        pos = gt.has_position() & np.isfinite(gt.dist)
+        tp_dist = gt.dist[pos]
+        tp_time = gt.time[pos]
+        with profiler.span('waypoint_scan', file=gps_file):
+            (tp_idx, wp_idx, sep_m) = wp_index.query_radius(gt.lat[pos], gt.lon[pos], visit_radius)
+            wp_visited = {}
+            for (i, k) in zip(tp_idx, wp_idx):
+                wp_id = wp_index.ids[k]
+                wp_visited[float(tp_dist[i])] = {'id': wp_id, 'name': wp_index.names[k], 'time': int(tp_time[i])}
+        profiler.count('trackpoints_scanned', len(tp_dist))
 
         prev_name = None
         for dist in sorted(wp_visited.keys()):
@@ -147,37 +117,108 @@ if(__name__ == '__main__'):
                 continue
             if(wp_visited[dist]['name'] != prev_name):
                 path_id = '%s:%s' % (prev_id, wp_visited[dist]['id'])
-
                 dist_m = dist - prev_dist
-
                 time_s = wp_visited[dist]['time'] - prev_time
+                result['paths'].append((path_id, dist_m, time_s))
 
+                prev_id = wp_visited[dist]['id']
+                prev_name = wp_visited[dist]['name']
+                prev_dist = dist
+                prev_time = wp_visited[dist]['time']
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return(result)
+
+if(__name__ == '__main__'):
+    args = parse_cmd_line()
+    if(args.profile is not None):
+        profiler.enable(args.profile)
+
+    rc = read_rc_file()
+
+    if(args.waypoints_file):
+        waypoints_file = args.waypoints_file
+    else:
+        if('waypoints_file' in rc.keys()):
+            waypoints_file = rc['waypoints_file']
+
+    if(args.path_csv_file):
+        path_csv_file = args.path_csv_file
+    else:
+        if('path_csv_file' in rc.keys()):
+            path_csv_file = rc['path_csv_file']
+    store = path_store.open_store(path_csv_file)
+    if(args.import_csv):
+        store.import_csv(args.import_csv)
+    gps_file_in_store = store.traces()
+
+    todo = []
+    for gps_file in args.gps_files:
+        if((gps_file in gps_file_in_store) and not args.ignore_stored):
+            continue
+        todo.append(gps_file)
+
+    # Traces are processed in worker processes when asked to, but results
+    # are merged here strictly in input order so the output is the same as
+    # for a serial run.
+    initargs = (waypoints_file, rc, args.visit_radius, args.waypoints_of_intr)
+    pool = None
+    if(args.jobs > 1):
+        pool = mp.Pool(args.jobs, initializer=init_worker, initargs=initargs)
+        results = pool.imap(find_paths, todo)
+    else:
+        init_worker(*initargs)
+        results = map(find_paths, todo)
+
+    num_done = 0
+    num_errors = 0
+    try:
+        for gps_file in args.gps_files:
+            if((gps_file in gps_file_in_store) and not args.ignore_stored):
+                print('Skipping %s because already in stored results.' % gps_file)
+                continue
+
+            num_done += 1
+            print('INFO: Working on %s (%d of %d) ...' % (gps_file, num_done, len(todo)))
+
+            result = next(results)
+            if(result['error'] is not None):
+                num_errors += 1
+                print('ERROR: %s: %s' % (gps_file, result['error']))
+                continue
+
+            print('DEBUG: num waypoints = {}'.format(result['num_waypoints']))
+            if(result['num_trackpoints'] is None):
+                store.remove_trace(gps_file)
+                continue
+
+            print('DEBUG: {} track points'.format(result['num_trackpoints']))
+
+            activity_datestamp = result['activity_datestamp']
+            print('DEBUG: Activity date = %s' % activity_datestamp)
+
+            for (path_id, dist_m, time_s) in result['paths']:
                 print('%s,%s,%s,%s,%s' %
                         (gps_file, activity_datestamp, path_id, dist_m, time_s))
 
-                (path_start, path_end) = path_id.split(':')
+            with profiler.span('path_store.add', cat='io'):
+                store.add_paths(gps_file, activity_datestamp, result['paths'])
 
-                if(path_start not in path.keys()):
-                    path[path_start] = {}
-                if(path_end not in path[path_start].keys()):
-                    path[path_start][path_end] = []
-                path[path_start][path_end].append({'gps_file': gps_file,
-                        'activity_datestamp': activity_datestamp, 'dist_m': dist_m, 'time_s': time_s})
+    finally:
+        # A .csv store is only written here, so save the traces done so far
+        # even if the run is cut short.
+        with profiler.span('path_store.save', cat='io'):
+            if(path_csv_file.lower().endswith('.csv')):
+                store.export_csv(path_csv_file)
+            if(args.export_csv):
+                store.export_csv(args.export_csv)
+            store.close()
 
-                prev_id = wp_visited[dist]['id']
-                prev_name = wp_visited[dist]['name']
-                prev_dist = dist
-                prev_time = wp_visited[dist]['time']
+    if(pool is not None):
+        pool.close()
+        pool.join()
+
+    if(num_errors > 0):
+        print('INFO: %d of %d file(s) could not be processed.' % (num_errors, len(todo)))
 
-        print(path)
-
-        with open(path_csv_file, 'w') as f_csv:
-            for path_start in path.keys():
-                for path_end in path[path_start].keys():
-                    for path_inst in path[path_start][path_end]:
-                        f_csv.write('%s,%s,%s,%s,%s\n' %
-                            (path_inst['gps_file'],
-                             path_inst['activity_datestamp'],
-                             "%s:%s" % (path_start, path_end),
-                             path_inst['dist_m'],
-                             path_inst['time_s']))
+    profiler.report()
@@ -7,10 +7,11 @@
 import os
 import argparse
 import garmin
+import profiler
+import trace_cache
 import waypoint_mgr
 import multiprocessing as mp
 
-ns = {'garmin': 'http://www.garmin.com/xmlschemas/TrainingCenterDatabase/v2'}
 rc_file = '{}/.trace.rc'.format(os.environ['HOME'])
 
 def read_rc_file():
@@ -28,38 +29,38 @@ def parse_cmd_line():
     ap = argparse.ArgumentParser(description='Get a list of waypoints for each trace file given')
     ap.add_argument('-f', '--gps-files', help='Name of Garmin .tcx file', required=True, nargs='+')
     ap.add_argument('-w', '--waypoints-file', help='Name of waypoint .xml file')
+    ap.add_argument('-r', '--visit-radius', help='Distance (m) from a waypoint that counts as a visit',
+            type=float, default=waypoint_mgr.visit_radius_m)
+    ap.add_argument('--profile', help='Print time spent per stage; also write a Chrome trace to TRACE_JSON if given',
+            nargs='?', const='', metavar='TRACE_JSON')
     args = ap.parse_args()
     return(args)
 
+@profiler.profiled('waypoint_scan')
 def extract_waypoints_from_trace(job):
     gt = job[0]
-    waypoints = job[1]
+    wp_index = job[1]
+    radius_m = job[2]
     wp_chain = []
-    for tp in gt.iter_position():
-        try:
-            lat = float(tp.findall('.//garmin:LatitudeDegrees', ns)[0].text)
-            lon = float(tp.findall('.//garmin:LongitudeDegrees', ns)[0].text)
-        except IndexError:
-            continue
-        for k in waypoints.keys():
-            wp_lat = waypoints[k]['lat']
-            wp_lon = waypoints[k]['lon']
-            wp_id = k
-            wp_name = waypoints[k]['name']
-            sep_m = gt.calc_dist_m([lat, lon], [wp_lat, wp_lon])
-            if(sep_m < 20.0):
-                if(len(wp_chain) == 0):
-                    wp_chain.append(wp_id)
-                else:
-                    if(wp_id != wp_chain[-1]):
-                        wp_chain.append(wp_id)
+    pos = gt.has_position()
+    (tp_idx, wp_idx, sep_m) = wp_index.query_radius(gt.lat[pos], gt.lon[pos], radius_m)
+    for k in wp_idx:
+        wp_id = wp_index.ids[k]
+        if(len(wp_chain) == 0):
+            wp_chain.append(wp_id)
+        else:
+            if(wp_id != wp_chain[-1]):
+                wp_chain.append(wp_id)
     return(wp_chain)
 
 
 if(__name__ == '__main__'):
     args = parse_cmd_line()
+    if(args.profile is not None):
+        profiler.enable(args.profile)
 
     rc = read_rc_file()
+    t_cache = trace_cache.from_rc(rc)
 
     if(args.waypoints_file):
         waypoints_file = args.waypoints_file
@@ -68,11 +69,12 @@ if(__name__ == '__main__'):
             waypoints_file = rc['waypoints_file']
 
     w_mgr = waypoint_mgr.waypoint_mgr(waypoints_file)
+    wp_index = w_mgr.build_index()
 
 #    jobs = []
     for gps_file in args.gps_files:
         try:
-            gt = garmin.garmin(gps_file)
+            gt = garmin.garmin(gps_file, cache=t_cache)
         except KeyError:
             continue
 
@@ -81,11 +83,13 @@ if(__name__ == '__main__'):
 #            jobs.append((gt, waypoints))
 
             print('%s :' % gps_file)
-            wp_chain = extract_waypoints_from_trace((gt, waypoints))
+            wp_chain = extract_waypoints_from_trace((gt, wp_index, args.visit_radius))
             for wp_id in wp_chain:
                 print(wp_id)
             print()
 
+    profiler.report()
+
 
 #    print('DEBUG: Number of jobs = %d' % len(jobs))
 #    with mp.Pool(8) as pool:
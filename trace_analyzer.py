@@ -1,18 +1,19 @@
 #!/usr/bin/env python3
 
 # TODO:
-# Do statistical analysis on segments.
 # Add a .dot output option.
 # Add progress meter.
 
 import os
-import math
 import argparse
 import xml.etree.ElementTree as ET
-import dateutil.parser as DP
+import numpy as np
 import garmin
+import path_store
+import profiler
+import segment_stats
+import trace_cache
 import waypoint_mgr
-from garmin import ns
 
 rc_file = '{}/.trace.rc'.format(os.environ['HOME'])
 
@@ -33,13 +34,14 @@ def parse_cmd_line():
     ap.add_argument('-d', '--dot-file', help='Name of .dot output file')
     ap.add_argument('-p', '--waypoints-file', help='Name of waypoint .xml file')
     ap.add_argument('-w', '--waypoints-of-intr', help='Waypoint(s) of interest', nargs='*', default=[])
-    ap.add_argument('-b', '--path-csv-file', help='Name of path csv file')
+    ap.add_argument('-b', '--path-csv-file', help='Name of path store (.csv file or SQLite database)')
+    ap.add_argument('-r', '--visit-radius', help='Distance (m) from a waypoint that counts as a visit',
+            type=float, default=waypoint_mgr.visit_radius_m)
+    ap.add_argument('--profile', help='Print time spent per stage; also write a Chrome trace to TRACE_JSON if given',
+            nargs='?', const='', metavar='TRACE_JSON')
     args = ap.parse_args()
     return(args)
 
-def iso2epoch(t_iso):
-    return(int(DP.parse(t_iso).strftime('%s')))
-
 def m2mi(d):
     return(d / 1609.0)
 
@@ -50,8 +52,11 @@ def s2minsec(t):
 
 if(__name__ == '__main__'):
     args = parse_cmd_line()
+    if(args.profile is not None):
+        profiler.enable(args.profile)
 
     rc = read_rc_file()
+    t_cache = trace_cache.from_rc(rc)
 
     if(args.waypoints_file):
         waypoints_file = args.waypoints_file
@@ -60,21 +65,31 @@ if(__name__ == '__main__'):
             waypoints_file = rc['waypoints_file']
 
     w_mgr = waypoint_mgr.waypoint_mgr(waypoints_file)
+    wp_index = w_mgr.build_index()
 
+    path_csv_file = None
     if(args.path_csv_file):
         path_csv_file = args.path_csv_file
     else:
         if('path_csv_file' in rc.keys()):
             path_csv_file = rc['path_csv_file']
 
-# TODO: repopulate paths dictionary, if path_csv_file exists.
-    paths = {}
+    # Start from the stored paths of all traces not being analyzed now, if
+    # trace2csv.py has created the store yet.
+    paths = []
+    if((path_csv_file is not None) and os.path.isfile(path_csv_file)):
+        store = path_store.open_store(path_csv_file, read_only=True)
+        with profiler.span('path_store.read', cat='io'):
+            for row in store.iter_paths():
+                if(row[0] not in args.gps_files):
+                    paths.append(row)
+        store.close()
 
     for gps_file in args.gps_files:
         print('INFO: Working on %s ...' % gps_file)
 
         try:
-            gt = garmin.garmin(gps_file)
+            gt = garmin.garmin(gps_file, cache=t_cache)
         except KeyError:
             continue
 
@@ -100,23 +115,16 @@ if(__name__ == '__main__'):
         print('DEBUG: Activity date = %s' % activity_datestamp)
 
         # Go through all track points and check for proximity to points in the waypoint database.
-        wp_visited = {}
-        for tp in gt.iter_position():
-            time = iso2epoch(tp.findall('.//garmin:Time', ns)[0].text)
-            try:
-                lat = float(tp.findall('.//garmin:LatitudeDegrees', ns)[0].text)
-                lon = float(tp.findall('.//garmin:LongitudeDegrees', ns)[0].text)
-            except IndexError:
-                continue
-            dist = float(tp.findall('.//garmin:DistanceMeters', ns)[0].text)
-            for k in waypoints.keys():
-                wp_lat = waypoints[k]['lat']
-                wp_lon = waypoints[k]['lon']
-                wp_id = k
-                wp_name = waypoints[k]['name']
-                sep_m = gt.calc_dist_m([lat, lon], [wp_lat, wp_lon])
-                if(sep_m < 20.0):
-                    wp_visited[dist] = {'id': wp_id, 'name': wp_name, 'time': time}
+        # Points without DistanceMeters (NaN) can't be ordered or measured between.
+        pos = gt.has_position() & np.isfinite(gt.dist)
+        tp_dist = gt.dist[pos]
+        tp_time = gt.time[pos]
+        with profiler.span('waypoint_scan', file=gps_file):
+            (tp_idx, wp_idx, sep_m) = wp_index.query_radius(gt.lat[pos], gt.lon[pos], args.visit_radius)
+            wp_visited = {}
+            for (i, k) in zip(tp_idx, wp_idx):
+                wp_id = wp_index.ids[k]
+                wp_visited[float(tp_dist[i])] = {'id': wp_id, 'name': wp_index.names[k], 'time': int(tp_time[i])}
 
         prev_name = None
         for dist in sorted(wp_visited.keys()):
@@ -127,17 +135,9 @@ if(__name__ == '__main__'):
                 prev_time = wp_visited[dist]['time']
                 continue
             if(wp_visited[dist]['name'] != prev_name):
-                path = {}
                 path_id = '%s:%s' % (prev_id, wp_visited[dist]['id'])
-
                 delta_dist = dist - prev_dist
-                path['dist'] = delta_dist
-
                 delta_time = wp_visited[dist]['time'] - prev_time
-                path['time'] = delta_time
-
-                path['file'] = gps_file
-                path['date'] = activity_datestamp
 
 #                print('{} {:32s} -> {:32s} {:3.2f} mi {:5s} {}'.format(
 #                    path_id, prev_name, wp_visited[dist]['name'], m2mi(delta_dist),
@@ -145,35 +145,38 @@ if(__name__ == '__main__'):
                 print('%s,%s,%s,%s,%s' %
                         (gps_file, activity_datestamp, path_id, delta_dist, delta_time))
 
-                if(path_id not in paths.keys()):
-                    paths[path_id] = []
-                paths[path_id].append(path)
+                paths.append((gps_file, activity_datestamp, path_id, delta_dist, delta_time))
 
                 prev_id = wp_visited[dist]['id']
                 prev_name = wp_visited[dist]['name']
                 prev_dist = dist
                 prev_time = wp_visited[dist]['time']
 
-    for path_id in paths.keys():
-        total_dist = 0.0
-        print('path_id = %s, number of data = %d' % (path_id, len(paths[path_id])), end='')
-        for path in paths[path_id]:
-            total_dist += path['dist']
-        avg_dist = total_dist / len(paths[path_id])
+    # Paths of the traces analyzed now aren't in the store yet, so the
+    # statistics are computed here rather than taken from the cache.
+    with profiler.span('segment_stats'):
+        stats = segment_stats.compute(segment_stats.columns(paths))
+    for (i, path_id) in enumerate(stats['path_id'].tolist()):
+        avg_dist = stats['dist_m_mean'][i]
+        print('path_id = %s, number of data = %d' % (path_id, stats['count'][i]), end='')
         print(' Avg dist = %f m (%3.2f miles)' % (avg_dist, avg_dist / 1609))
+        pace = stats['pace_s_per_m'][i] * 1609
+        print('  time median %s, 10-90%% %s - %s, sd %ds; pace %s/mi over %d of %d' %
+                (s2minsec(stats['time_s_median'][i]), s2minsec(stats['time_s_p10'][i]),
+                s2minsec(stats['time_s_p90'][i]), stats['time_s_std'][i],
+                s2minsec(pace) if(pace == pace) else '-', stats['pace_count'][i], stats['count'][i]))
 
     if(args.dot_file is not None):
         with open(args.dot_file, 'w') as f_dot:
             f_dot.write('digraph G {\n');
-            for path_id in paths.keys():
-                total_dist = 0.0
-                for path in paths[path_id]:
-                    total_dist += path['dist']
-                avg_dist = total_dist / len(paths[path_id])
+            for (i, path_id) in enumerate(stats['path_id'].tolist()):
+                avg_dist = stats['dist_m_mean'][i]
                 ep = path_id.split(':')
                 f_dot.write('%s -> %s [label="%3.2f", len="%d"];\n' %
                         (ep[0], ep[1], avg_dist/1609, int(1+avg_dist)))
             f_dot.write('}\n');
 
+    profiler.report()
+
 # Do some stats on path data (dist and time) and print out.
 
@@ -0,0 +1,192 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import numpy as np
+
+# Bump when the set or meaning of cached columns changes.
+cache_version = 1
+
+default_cache_dir = '{}/.cache/gtrace/traces'.format(os.environ['HOME'])
+default_max_mb = 1024
+
+# Returns a trace_cache configured from the resource file, or None when the
+# cache has been disabled with an empty 'trace_cache' entry.
+def from_rc(rc):
+    cache_dir = rc.get('trace_cache', default_cache_dir)
+    if(not cache_dir):
+        return(None)
+    max_mb = int(rc.get('trace_cache_max_mb', default_max_mb))
+    return(trace_cache(cache_dir, max_mb * 1024 * 1024))
+
+def hash_file(filename):
+    h = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return(h.hexdigest())
+
+def _dir_size(path):
+    size = 0
+    for name in os.listdir(path):
+        size += os.path.getsize(os.path.join(path, name))
+    return(size)
+
+# Sidecar cache of decoded traces.  Each trace gets a directory named after
+# its absolute path holding one .npy file per column plus meta.json with the
+# size, mtime and content hash of the source file.  A changed size or mtime
+# triggers a re-hash; the entry is reused only if the content still matches.
+# Entries are evicted least-recently-used first once the cache exceeds
+# max_bytes.
+class trace_cache(object):
+
+    def __init__(self, cache_dir, max_bytes=default_max_mb * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.total_bytes = None
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _entry_dir(self, trace_file):
+        key = hashlib.sha1(os.path.abspath(trace_file).encode('utf-8')).hexdigest()
+        return(os.path.join(self.cache_dir, key))
+
+    def _read_meta(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, 'meta.json'), 'r') as f_meta:
+                return(json.load(f_meta))
+        except (OSError, ValueError):
+            return(None)
+
+    # Returns (entry_dir, meta) if trace_file has an up-to-date entry.
+    def _valid_entry(self, trace_file):
+        entry_dir = self._entry_dir(trace_file)
+        meta = self._read_meta(entry_dir)
+        if((meta is None) or (meta.get('version') != cache_version)):
+            return(None)
+
+        st = os.stat(trace_file)
+        if((meta['size'] != st.st_size) or (meta['mtime_ns'] != st.st_mtime_ns)):
+            if((meta['size'] != st.st_size) or (meta['hash'] != hash_file(trace_file))):
+                return(None)
+            # Same content, new timestamp: refresh the entry's key.
+            meta['mtime_ns'] = st.st_mtime_ns
+            self._write_meta(entry_dir, meta)
+        return((entry_dir, meta))
+
+    def load(self, trace_file):
+        entry = self._valid_entry(trace_file)
+        if(entry is None):
+            return(None)
+        (entry_dir, meta) = entry
+
+        try:
+            cols = {}
+            for name in meta['columns']:
+                cols[name] = np.load(os.path.join(entry_dir, name + '.npy'), mmap_mode='r')
+        except (OSError, ValueError):
+            return(None)
+
+        # Mark as recently used for eviction.
+        os.utime(entry_dir)
+        return(meta['activity_id'], cols)
+
+    # Arrays derived from a trace's columns (e.g. simplification ranks) are
+    # kept in the trace's entry under their own name, and go away with it.
+    # Returns None unless the trace has an up-to-date entry holding name.
+    def load_derived(self, trace_file, name):
+        entry = self._valid_entry(trace_file)
+        if((entry is None) or (name not in entry[1].get('derived', []))):
+            return(None)
+        try:
+            return(np.load(os.path.join(entry[0], name + '.npy'), mmap_mode='r'))
+        except (OSError, ValueError):
+            return(None)
+
+    # Add a derived array to the trace's entry; does nothing if the trace
+    # isn't cached.
+    def store_derived(self, trace_file, name, values):
+        entry = self._valid_entry(trace_file)
+        if(entry is None):
+            return
+        (entry_dir, meta) = entry
+        is_new = name not in meta.get('derived', [])
+        try:
+            (fd, tmp_path) = tempfile.mkstemp(dir=entry_dir, prefix='.tmp-', suffix='.npy')
+            with os.fdopen(fd, 'wb') as f_npy:
+                np.save(f_npy, np.asarray(values))
+            os.replace(tmp_path, os.path.join(entry_dir, name + '.npy'))
+            if(is_new):
+                meta['derived'] = meta.get('derived', []) + [name]
+                self._write_meta(entry_dir, meta)
+        except OSError:
+            # The entry was evicted or replaced meanwhile.
+            return
+        if(is_new and (self.total_bytes is not None)):
+            self.total_bytes += os.path.getsize(os.path.join(entry_dir, name + '.npy'))
+
+    def store(self, trace_file, activity_id, cols):
+        st = os.stat(trace_file)
+        meta = {'version': cache_version,
+                'path': os.path.abspath(trace_file),
+                'size': st.st_size,
+                'mtime_ns': st.st_mtime_ns,
+                'hash': hash_file(trace_file),
+                'activity_id': activity_id,
+                'columns': list(cols.keys())}
+
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir, prefix='.tmp-')
+        try:
+            for name in cols.keys():
+                np.save(os.path.join(tmp_dir, name + '.npy'), np.asarray(cols[name]))
+            self._write_meta(tmp_dir, meta)
+            entry_dir = self._entry_dir(trace_file)
+            self.remove(trace_file)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process won the race to store this trace.
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        if(self.total_bytes is not None):
+            self.total_bytes += _dir_size(entry_dir)
+        self.evict()
+
+    def remove(self, trace_file):
+        entry_dir = self._entry_dir(trace_file)
+        if(os.path.isdir(entry_dir)):
+            if(self.total_bytes is not None):
+                self.total_bytes -= _dir_size(entry_dir)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+
+    def _write_meta(self, entry_dir, meta):
+        tmp_meta = os.path.join(entry_dir, '.meta.json')
+        with open(tmp_meta, 'w') as f_meta:
+            json.dump(meta, f_meta)
+        os.replace(tmp_meta, os.path.join(entry_dir, 'meta.json'))
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, name)
+            if(name.startswith('.') or not os.path.isdir(entry_dir)):
+                continue
+            entries.append((os.path.getmtime(entry_dir), _dir_size(entry_dir), entry_dir))
+        return(entries)
+
+    def evict(self):
+        if(self.total_bytes is None):
+            self.total_bytes = sum([e[1] for e in self._entries()])
+        if(self.total_bytes <= self.max_bytes):
+            return
+
+        for (atime, size, entry_dir) in sorted(self._entries()):
+            if(self.total_bytes <= self.max_bytes):
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            self.total_bytes -= size
+
+    def clear(self):
+        for (atime, size, entry_dir) in self._entries():
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        self.total_bytes = 0
@@ -2,15 +2,23 @@
 
 import os
 import math
+import queue
 import argparse
+import itertools
+import threading
+import collections
 import tkinter as tk
 import xml.etree.ElementTree as ET
 from PIL import Image, ImageTk
+import numpy as np
+import map_render
 import map_tile_mgr
+import profiler
 import garmin
+import simplify
+import trace_cache
 import waypoint_mgr
-from garmin import ns
-from map_tile_mgr import deg2num, num2deg
+from map_tile_mgr import deg2pixel
 
 # Get gps coords, get tile, display tile with current gps coord highlighted.
 # Have a button user can click to save the current point in a list with a name.
@@ -18,10 +26,14 @@ from map_tile_mgr import deg2num, num2deg
 # between them.
 
 zm = 16
-photoimage_cache = {}
+photoimage_cache = collections.OrderedDict()
+photoimage_cache_size = 64
+prefetch_ahead = 8
+prefetch_behind = 2
 rc_file = '{}/.trace.rc'.format(os.environ['HOME'])
-prev_tile = [None, None]
+prev_tile = None
 wpts_on_disp = []
+trace_on_disp = []
 
 def parse_cmd_line():
     ap = argparse.ArgumentParser(description='Explore GPS trace on opencyclemap.org tiles')
@@ -32,6 +44,8 @@ def parse_cmd_line():
             default='tile-cache')
     ap.add_argument('-j', '--ignore-cache', help='Download tiles, ignoring any in cache', action='store_true')
     ap.add_argument('-w', '--waypoints-file', help='Name of waypoints .xml file')
+    ap.add_argument('--profile', help='Print time spent per stage; also write a Chrome trace to TRACE_JSON if given',
+            nargs='?', const='', metavar='TRACE_JSON')
     args = ap.parse_args()
     return(args)
 
@@ -46,42 +60,138 @@ def read_rc_file():
                 rc[a.strip()] = b.strip()
     return(rc)
 
+# Downloads tiles in a background thread, lowest priority number first, so
+# the Tk main loop never waits on the network.  Tiles in 'ready' are in the
+# tile cache.  Each tile change starts a new generation of requests; those
+# left over from older generations are dropped rather than downloaded, so
+# when scrubbing the tiles around the current position always come first.
+class tile_prefetcher(threading.Thread):
+
+    def __init__(self, mtm, zoom):
+        threading.Thread.__init__(self, daemon=True)
+        self.mtm = mtm
+        self.zoom = zoom
+        self.queue = queue.PriorityQueue()
+        self.seq = itertools.count()
+        self.lock = threading.Lock()
+        self.generation = 0
+        self.requested = {}
+        self.ready = set()
+
+    def new_generation(self):
+        with self.lock:
+            self.generation += 1
+
+    # Queue tile unless it is ready or already queued in this generation.
+    def request(self, tile, priority):
+        with self.lock:
+            if((tile in self.ready) or (self.requested.get(tile) == self.generation)):
+                return
+            self.requested[tile] = self.generation
+            generation = self.generation
+        self.queue.put((priority, next(self.seq), generation, tile))
+
+    def is_ready(self, tile):
+        with self.lock:
+            return(tile in self.ready)
+
+    def run(self):
+        while(True):
+            (priority, seq, generation, tile) = self.queue.get()
+            with self.lock:
+                if((self.requested.get(tile) != generation) or (tile in self.ready)):
+                    # Queued again since, in a newer generation, or fetched.
+                    continue
+                if(generation != self.generation):
+                    del self.requested[tile]
+                    continue
+            try:
+                self.mtm.get_tile(self.zoom, tile[0], tile[1])
+            except Exception as e:
+                print('ERROR: Tile {}-{}-{}: {}'.format(self.zoom, tile[0], tile[1], e))
+                with self.lock:
+                    self.requested.pop(tile, None)
+                continue
+            with self.lock:
+                self.requested.pop(tile, None)
+                self.ready.add(tile)
+
+# Returns the PhotoImage of a tile, keeping the most recently used ones.
+def get_photoimage(tile):
+    if(tile in photoimage_cache):
+        photoimage_cache.move_to_end(tile)
+    else:
+        tile_file = map_tile_mgr.tile_path(tile_cache, zm, tile[0], tile[1])
+        photoimage_cache[tile] = ImageTk.PhotoImage(Image.open(tile_file))
+        if(len(photoimage_cache) > photoimage_cache_size):
+            photoimage_cache.popitem(last=False)
+    return(photoimage_cache[tile])
+
+# Show the tile once it has been fetched, checking back until then unless
+# the user has moved on to another tile.  A tile whose download failed is
+# asked for again.
+def show_tile(tile):
+    if(tile != prev_tile):
+        return
+    if(prefetcher.is_ready(tile)):
+        tile_canvas.itemconfig(cnv_img, image=get_photoimage(tile))
+    else:
+        tile_canvas.itemconfig(cnv_img, image='')
+        prefetcher.request(tile, 0)
+        root.after(50, show_tile, tile)
+
+# Queue the tile of trackpoint i and the tiles next along the route, in a
+# new generation so requests for tiles scrubbed past are dropped.
+def prefetch_route(i):
+    r = route_idx[i]
+    prefetcher.new_generation()
+    prefetcher.request(route_tiles[r], 0)
+    for k in range(1, prefetch_ahead + 1):
+        if(r + k < len(route_tiles)):
+            prefetcher.request(route_tiles[r + k], k)
+    for k in range(1, prefetch_behind + 1):
+        if(r - k >= 0):
+            prefetcher.request(route_tiles[r - k], k)
+
+@profiler.profiled('update_pos')
 def update_pos():
     global prev_tile
     scale_setting = dscale.get()
-    tp = trackpoints[scale_setting]
-    d_m = tp.findall('garmin:DistanceMeters', ns)[0].text
-    lat_d = tp.findall('.//garmin:LatitudeDegrees', ns)[0].text
-    lon_d = tp.findall('.//garmin:LongitudeDegrees', ns)[0].text
-    alt_m = tp.findall('.//garmin:AltitudeMeters', ns)[0].text
-    d_mi = round(0.005 + 0.000621371 * float(d_m), 2)
-    alt_ft = int(0.5 + float(alt_m) * 3.28084)
+    k = pos_idx[scale_setting]
+    (lat_d, lon_d, alt_m, d_m) = (float(gt.lat[k]), float(gt.lon[k]), float(gt.alt[k]), float(gt.dist[k]))
+    d_mi = round(0.005 + 0.000621371 * d_m, 2)
+    alt_ft = int(0.5 + alt_m * 3.28084)
     dist.set(d_mi)
     lat.set(lat_d)
     lon.set(lon_d)
     elev.set(alt_ft)
-    tile = deg2num([float(lat_d), float(lon_d)], zm)
-    if((tile[0] != prev_tile[0]) or (tile[1] != prev_tile[1])):
+    tile = route_tiles[route_idx[scale_setting]]
+    if(tile != prev_tile):
+        prev_tile = tile
         tiledisp.set('{}, {}, {}'.format(zm, tile[0], tile[1]))
-        tile_file = mtm.get_tile(zm, tile[0], tile[1])
-        if(tile_file not in photoimage_cache.keys()):
-            photoimage_cache[tile_file] = ImageTk.PhotoImage(Image.open(tile_file))
-        tile_canvas.itemconfig(cnv_img, image=photoimage_cache[tile_file])
+        prefetch_route(scale_setting)
+        show_tile(tile)
         for w in wpts_on_disp:
             tile_canvas.delete(w)
-        for w in waypoints.keys():
+        for w in tile2wp.get(tile[0], {}).get(tile[1], []):
             (x_in_tile, y_in_tile) = xy_in_tile(waypoints[w]['lat'], waypoints[w]['lon'], tile[0], tile[1], zm)
             tmp = tile_canvas.create_oval(x_in_tile - 2, y_in_tile - 2, x_in_tile + 2, y_in_tile + 2, fill='green')
             wpts_on_disp.append(tmp)
-    (x_in_tile, y_in_tile) = xy_in_tile(lat_d, lon_d, tile[0], tile[1], zm)
+        # Draw the trace, simplified for this zoom, where it crosses the tile.
+        for l in trace_on_disp:
+            tile_canvas.delete(l)
+        for line in map_render.clip_polyline(trace_x, trace_y, 256 * tile[0], 256 * tile[1], 256, 256, 2):
+            tmp = tile_canvas.create_line(*[c for xy in line for c in xy], fill='blue', width=2)
+            trace_on_disp.append(tmp)
+        tile_canvas.tag_raise(cnv_pt)
+    x_in_tile = int(pt_x[scale_setting]) - 256 * tile[0]
+    y_in_tile = int(pt_y[scale_setting]) - 256 * tile[1]
     tile_canvas.coords(cnv_pt, x_in_tile-3, y_in_tile-3, x_in_tile+3, y_in_tile+3)
-    prev_tile = tile
 
 def xy_in_tile(lat, lon, tile_x, tile_y, zm):
-    (tile_N, tile_W) = num2deg(tile_x, tile_y, zm)
-    (tile_S, tile_E) = num2deg(tile_x + 1, tile_y + 1, zm)
-    x_in_tile = int(256.0 * (float(lon) - tile_W) / (tile_E - tile_W))
-    y_in_tile = int(256.0 * (float(lat) - tile_N) / (tile_S - tile_N))
+    (x, y) = deg2pixel(float(lat), float(lon), zm)
+    x_in_tile = int(math.floor(x - 256.0 * tile_x))
+    y_in_tile = int(math.floor(y - 256.0 * tile_y))
     return((x_in_tile, y_in_tile))
 
 def mwheel(event):
@@ -100,6 +210,9 @@ def mwheel(event):
 def slider_release(event):
     update_pos()
 
+def slider_moved(value):
+    update_pos()
+
 def save_point():
     print('{} {} {} {}'.format(dist.get(), elev.get(), lat.get(), lon.get()))
     print('  <wpt id="">')
@@ -111,8 +224,11 @@ def save_point():
 
 if(__name__ == '__main__'):
     args = parse_cmd_line()
+    if(args.profile is not None):
+        profiler.enable(args.profile)
 
     rc = read_rc_file()
+    t_cache = trace_cache.from_rc(rc)
 
     if(args.tile_cache):
         tile_cache = args.tile_cache
@@ -132,6 +248,7 @@ if(__name__ == '__main__'):
 
     w_mgr = waypoint_mgr.waypoint_mgr(waypoints_file)
     waypoints = w_mgr.read_waypoints()
+    tile2wp = w_mgr.get_tile_to_waypoint_map(zm)
     print('DEBUG: num waypoints = {}'.format(len(waypoints)))
 
     mtm = map_tile_mgr.map_tile_mgr(tiles_url, tile_cache, rc['map_api_key'], ignore_cache=args.ignore_cache)
@@ -139,17 +256,29 @@ if(__name__ == '__main__'):
     root = tk.Tk()
     root.title('Trace Explorer')
 
-    gt = garmin.garmin(args.gps_file)
-    trackpoints = gt.get_trackpoints()
-    num_trackpoints = len(trackpoints)
+    # Columns of the trackpoints with a position, their pixel coordinates
+    # and the tiles along the route, computed once so moving the slider is
+    # just a lookup.
+    gt = garmin.garmin(args.gps_file, cache=t_cache)
+    pos = gt.has_position()
+    pos_idx = np.flatnonzero(pos)
+    num_trackpoints = len(pos_idx)
     print('DEBUG: {} track points'.format(num_trackpoints))
+    (pt_x, pt_y) = deg2pixel(gt.lat[pos], gt.lon[pos], zm)
+    pt_x = np.floor(pt_x).astype(np.int64)
+    pt_y = np.floor(pt_y).astype(np.int64)
+    (tile_x, tile_y) = (pt_x // 256, pt_y // 256)
+    new_tile = np.concatenate(([True], (np.diff(tile_x) != 0) | (np.diff(tile_y) != 0)))
+    route_idx = np.cumsum(new_tile) - 1
+    route_tiles = list(zip(tile_x[new_tile].tolist(), tile_y[new_tile].tolist()))
 
-    tp = trackpoints[1]
-    lat_d = tp.findall('.//garmin:LatitudeDegrees', ns)[0].text
-    lon_d = tp.findall('.//garmin:LongitudeDegrees', ns)[0].text
-    tile = deg2num([float(lat_d), float(lon_d)], zm)
-    tile_file = mtm.get_tile(zm, tile[0], tile[1])
-    photoimage_cache[tile_file] = ImageTk.PhotoImage(Image.open(tile_file))
+    # Global pixel coordinates of the trace, simplified for the zoom.
+    keep = simplify.select(simplify.trace_significance(gt, t_cache), zm)
+    (trace_x, trace_y) = (pt_x[keep], pt_y[keep])
+    print('DEBUG: {} of {} points drawn at zoom {}'.format(len(keep), num_trackpoints, zm))
+
+    prefetcher = tile_prefetcher(mtm, zm)
+    prefetcher.start()
 
     dist = tk.StringVar()
     lat = tk.StringVar()
@@ -157,7 +286,8 @@ if(__name__ == '__main__'):
     elev = tk.StringVar()
     tiledisp = tk.StringVar()
 
-    dscale = tk.Scale(root, from_=0, to=num_trackpoints-1, orient=tk.HORIZONTAL, length=400)
+    dscale = tk.Scale(root, from_=0, to=num_trackpoints-1, orient=tk.HORIZONTAL, length=400,
+            command=slider_moved)
     dscale.bind("<Button-4>", mwheel)
     dscale.bind("<Button-5>", mwheel)
     dscale.bind("<ButtonRelease-1>", slider_release)
@@ -168,7 +298,7 @@ if(__name__ == '__main__'):
 
     tile_canvas = tk.Canvas(root, width=256, height=256)
     tile_canvas.pack()
-    cnv_img = tile_canvas.create_image(0, 0, anchor=tk.NW, image=photoimage_cache[tile_file])
+    cnv_img = tile_canvas.create_image(0, 0, anchor=tk.NW)
     cnv_pt = tile_canvas.create_oval(0,0,5,5, fill="red")
 
     dlabel = tk.Label(root, textvariable=dist)
@@ -186,5 +316,7 @@ if(__name__ == '__main__'):
     store_button = tk.Button(root, text='Save Point', command=save_point)
     store_button.pack()
 
+    update_pos()
     root.mainloop()
+    profiler.report()
 
@@ -3,37 +3,45 @@
 # TODO: Determine closest waypoint to starting point of each trace.
 
 import argparse
+import numpy as np
 import garmin
+import geodesy
+import profiler
+import trace_cache
 import waypoint_mgr
 
 def parse_cmd_line():
     ap = argparse.ArgumentParser(description='Show various stats about traces.')
     ap.add_argument('-f', '--gps-files', help='Name of Garmin .tcx file(s) to process', required=True, nargs='+')
     ap.add_argument('-w', '--waypoint', help='Waypoint ID')
+    ap.add_argument('--profile', help='Print time spent per stage; also write a Chrome trace to TRACE_JSON if given',
+            nargs='?', const='', metavar='TRACE_JSON')
     args = ap.parse_args()
     return(args)
 
 if(__name__ == '__main__'):
     args = parse_cmd_line()
+    if(args.profile is not None):
+        profiler.enable(args.profile)
 
+    t_cache = trace_cache.from_rc({})
     w = waypoint_mgr.waypoint_mgr('/home/common/paulw/hobbies/running/garmin-traces/waypoints.xml')
     waypoints = w.read_waypoints()
+    wp_ids = list(waypoints.keys())
+    wp_lats = [waypoints[k]['lat'] for k in wp_ids]
+    wp_lons = [waypoints[k]['lon'] for k in wp_ids]
 
     for gps_file in args.gps_files:
 #        print('INFO: Processing file {} ...'.format(gps_file))
-        gt = garmin.garmin(gps_file)
+        gt = garmin.garmin(gps_file, cache=t_cache)
         starting_pt = gt.get_starting_coord()
-        min_dist = None
-        min_dist_wptid = None
-        for wptid in waypoints.keys():
-            wp_coord = (waypoints[wptid]['lat'], waypoints[wptid]['lon'])
-            dist = gt.calc_dist_m(starting_pt, wp_coord)
-            if((min_dist is None) or (dist < min_dist)):
-                min_dist = dist
-                min_dist_wptid = wptid
+        dists = geodesy.dist_to_many(starting_pt, wp_lats, wp_lons)
+        min_idx = int(np.argmin(dists))
+        min_dist = float(dists[min_idx])
+        min_dist_wptid = wp_ids[min_idx]
         if((args.waypoint) and (args.waypoint == min_dist_wptid)):
             print('INFO: {} min_dist = {} at waypoint {}'.format(gps_file, min_dist, min_dist_wptid))
         else:
             print('INFO: {} min_dist = {} at waypoint {}'.format(gps_file, min_dist, min_dist_wptid))
 
-
+    profiler.report()
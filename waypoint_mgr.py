@@ -1,46 +1,187 @@
+import os
+import math
 import xml.etree.ElementTree as ET
+import numpy as np
+import geodesy
 from map_tile_mgr import deg2num
 
-class waypoint_mgr(object):
+# Trackpoints closer than this to a waypoint count as a visit.
+visit_radius_m = 20.0
 
-    def __init__(self, waypt_file):
-        self.wptfile = waypt_file
+# Uniform grid over waypoints projected to meters, for bulk "waypoints within
+# R meters of these points" queries.  The projection is equirectangular,
+# scaled for the latitude farthest from the equator, so projected distances
+# never exceed true ones and no neighbor can fall outside the searched cells.
+# Candidates are confirmed with an exact haversine distance.
+class waypoint_index(object):
 
-    def read_waypoints(self, bbox=None):
-        root = ET.parse(self.wptfile)
-        data = {}
-        for w in root.findall('.//wpt'):
-            wptid = w.attrib['id']
-            name = w.findall('name')[0].text
-            lat = float(w.findall('lat')[0].text)
-            lon = float(w.findall('lon')[0].text)
-            if(bbox):
-                if(lat > bbox[0]):
-                    continue
-                if(lat < bbox[2]):
-                    continue
-                if(lon < bbox[1]):
-                    continue
-                if(lon > bbox[3]):
+    def __init__(self, ids, names, lats, lons, cell_m=visit_radius_m):
+        self.ids = ids
+        self.names = names
+        self.lats = np.asarray(lats, dtype=np.float64)
+        self.lons = np.asarray(lons, dtype=np.float64)
+        self.cell_m = cell_m
+        max_lat = 0.0
+        if(len(self.ids) > 0):
+            max_lat = float(np.max(np.abs(self.lats)))
+        self.max_lat = max_lat
+        self.x_scale = None
+        self._build(cell_m)
+
+    def _project(self, lats, lons):
+        x = np.radians(lons) * geodesy.R_m * self.x_scale
+        y = np.radians(lats) * geodesy.R_m
+        return(x, y)
+
+    def _keys(self, cx, cy):
+        return((cx << 32) + (cy + (1 << 31)))
+
+    def _build(self, cell_m):
+        # Scale for the farthest latitude a match could lie at.
+        self.x_scale = math.cos(math.radians(min(89.0, self.max_lat + cell_m / 100000.0)))
+        (x, y) = self._project(self.lats, self.lons)
+        cx = np.floor(x / cell_m).astype(np.int64)
+        cy = np.floor(y / cell_m).astype(np.int64)
+        keys = self._keys(cx, cy)
+        self.order = np.argsort(keys, kind='stable')
+        (self.cell_keys, self.cell_start, self.cell_count) = np.unique(keys[self.order],
+                return_index=True, return_counts=True)
+
+    # Returns (pt_idx, wp_idx, sep_m) arrays for every trackpoint/waypoint
+    # pair closer than radius_m, sorted by trackpoint then waypoint order.
+    # wp_idx indexes self.ids.
+    def query_radius(self, lats, lons, radius_m=visit_radius_m):
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0))
+        if((len(self.ids) == 0) or (len(lats) == 0)):
+            return(empty)
+        if(radius_m > self.cell_m):
+            self.cell_m = radius_m
+            self._build(radius_m)
+
+        (x, y) = self._project(lats, lons)
+        cx = np.floor(x / self.cell_m).astype(np.int64)
+        cy = np.floor(y / self.cell_m).astype(np.int64)
+        pt_all = np.arange(len(lats))
+        pt_parts = []
+        wp_parts = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                keys = self._keys(cx + dx, cy + dy)
+                cell = np.searchsorted(self.cell_keys, keys)
+                cell[cell == len(self.cell_keys)] = 0
+                hit = self.cell_keys[cell] == keys
+                if(not np.any(hit)):
                     continue
-            elev = w.findall('elev_ft')[0].text
+                cell = cell[hit]
+                counts = self.cell_count[cell]
+                pt_idx = np.repeat(pt_all[hit], counts)
+                # Offset of each candidate within its cell.
+                first = np.repeat(np.cumsum(counts) - counts, counts)
+                within = np.arange(len(pt_idx)) - first
+                slot = np.repeat(self.cell_start[cell], counts) + within
+                pt_parts.append(pt_idx)
+                wp_parts.append(self.order[slot])
+        if(len(pt_parts) == 0):
+            return(empty)
+
+        pt_idx = np.concatenate(pt_parts)
+        wp_idx = np.concatenate(wp_parts)
+        sep_m = geodesy.haversine_m(lats[pt_idx], lons[pt_idx], self.lats[wp_idx], self.lons[wp_idx])
+        close = sep_m < radius_m
+        (pt_idx, wp_idx, sep_m) = (pt_idx[close], wp_idx[close], sep_m[close])
+        order = np.lexsort((wp_idx, pt_idx))
+        return(pt_idx[order], wp_idx[order], sep_m[order])
+
+# Parsed contents of one waypoints file: ids, names and elevations as lists,
+# coordinates as arrays, all in file order.  Waypoints are also kept sorted
+# by latitude so bbox queries are a binary search plus a longitude filter.
+class waypoint_store(object):
+
+    def __init__(self, waypt_file):
+        self.mtime = os.path.getmtime(waypt_file)
+        self.ids = []
+        self.names = []
+        self.elevs = []
+        lats = []
+        lons = []
+        for w in ET.parse(waypt_file).iter('wpt'):
+            self.ids.append(w.attrib['id'])
+            self.names.append(w.find('name').text)
+            lats.append(float(w.findtext('lat')))
+            lons.append(float(w.findtext('lon')))
+            elev = w.find('elev_ft').text
             if(elev):
                 elev = int(elev)
-            data[wptid] = {'name': name, 'lat': lat, 'lon': lon, 'elev_ft': elev}
-        return(data)
+            self.elevs.append(elev)
+        self.lats = np.array(lats, dtype=np.float64)
+        self.lons = np.array(lons, dtype=np.float64)
+        self.lat_order = np.argsort(self.lats, kind='stable')
+        self.sorted_lats = self.lats[self.lat_order]
+        self.index = None
+        self.tile2wp = {}
+
+    # Indices, in file order, of waypoints inside bbox (N, W, S, E).
+    def query_bbox(self, bbox):
+        lo = np.searchsorted(self.sorted_lats, bbox[2], side='left')
+        hi = np.searchsorted(self.sorted_lats, bbox[0], side='right')
+        idx = self.lat_order[lo:hi]
+        lons = self.lons[idx]
+        idx = idx[(lons >= bbox[1]) & (lons <= bbox[3])]
+        return(np.sort(idx))
 
+    def get_index(self, cell_m):
+        if((self.index is None) or (self.index.cell_m < cell_m)):
+            self.index = waypoint_index(self.ids, self.names, self.lats, self.lons, cell_m)
+        return(self.index)
 
     def get_tile_to_waypoint_map(self, zoom_factor):
-        waypoints = self.read_waypoints()
-        tile2wp = {}
+        if(zoom_factor not in self.tile2wp):
+            tile2wp = {}
+            for i in range(len(self.ids)):
+                tile = deg2num([self.lats[i], self.lons[i]], zoom_factor)
+                if(tile[0] not in tile2wp.keys()):
+                    tile2wp[tile[0]] = {}
+                if(tile[1] not in tile2wp[tile[0]].keys()):
+                    tile2wp[tile[0]][tile[1]] = []
+                tile2wp[tile[0]][tile[1]].append(self.ids[i])
+            self.tile2wp[zoom_factor] = tile2wp
+        return(self.tile2wp[zoom_factor])
 
-        for wptid in waypoints.keys():
-            tile = deg2num([waypoints[wptid]['lat'], waypoints[wptid]['lon']], zoom_factor)
-            if(tile[0] not in tile2wp.keys()):
-                tile2wp[tile[0]] = {}
-            if(tile[1] not in tile2wp[tile[0]].keys()):
-                tile2wp[tile[0]][tile[1]] = []
-            tile2wp[tile[0]][tile[1]].append(wptid)
+# Stores shared by every waypoint_mgr in the process, keyed by file name.
+_stores = {}
 
-        return(tile2wp)
+class waypoint_mgr(object):
+
+    def __init__(self, waypt_file):
+        self.wptfile = waypt_file
+
+    # Returns the parsed store, re-reading the file only if it has changed.
+    def get_store(self):
+        key = os.path.abspath(self.wptfile)
+        store = _stores.get(key)
+        if((store is None) or (store.mtime != os.path.getmtime(self.wptfile))):
+            store = waypoint_store(self.wptfile)
+            _stores[key] = store
+        return(store)
+
+    def read_waypoints(self, bbox=None):
+        store = self.get_store()
+        if(bbox):
+            if(bbox[0] is None):
+                return({})
+            idx = store.query_bbox(bbox)
+        else:
+            idx = range(len(store.ids))
+        data = {}
+        for i in idx:
+            data[store.ids[i]] = {'name': store.names[i], 'lat': float(store.lats[i]),
+                    'lon': float(store.lons[i]), 'elev_ft': store.elevs[i]}
+        return(data)
+
+    def get_tile_to_waypoint_map(self, zoom_factor):
+        return(self.get_store().get_tile_to_waypoint_map(zoom_factor))
 
+    def build_index(self, cell_m=visit_radius_m):
+        return(self.get_store().get_index(cell_m))